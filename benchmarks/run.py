@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+# Benchmark the protocol codec, message parsing and StateKeeper.parse on synthetic traffic.
+#
+# Usage: benchmarks/run.py [--scale N] [--json results.json]
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from optparse import OptionParser
+import json
+import platform
+import timeit
+
+import pycecap
+from traffic import TrafficGenerator
+
+timer = timeit.default_timer
+
+def best_of(function, items, repeat):
+    '''Run function over all items, repeat times, and return the best time per item in seconds.
+
+    Returns None if there are no items to time.
+    '''
+
+    if not items:
+        return None
+
+    best = None
+    for _ in xrange(repeat):
+        start = timer()
+        for item in items:
+            function(item)
+        elapsed = timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / len(items)
+
+def bench_codec(lines, repeat):
+    values = []
+    for line in lines:
+        if line.startswith('<*'):
+            values.extend(param.partition('=')[2] for param in line.split(';')[2:])
+    escaped = [value for value in values if '\\' in value]
+    plain = [value for value in values if '\\' not in value]
+    raw = [pycecap.unescape(value) for value in values]
+
+    return {
+        'unescape (plain)': best_of(pycecap.unescape, plain, repeat),
+        'unescape (escaped)': best_of(pycecap.unescape, escaped, repeat),
+        'escape': best_of(pycecap.escape, raw, repeat),
+    }
+
+def bench_messages(lines, repeat):
+    events = [line[1:] for line in lines if line.startswith('<*')]
+    parsed = [pycecap.Event(event) for event in events]
+
+    return {
+        'Event(line)': best_of(pycecap.Event, events, repeat),
+        'Event(line).params': best_of(lambda event: pycecap.Event(event).params, events, repeat),
+        'Event.__str__': best_of(str, parsed, repeat),
+    }
+
+def bench_statekeeper(lines, repeat):
+    '''Time StateKeeper.parse per event / command name, replaying the whole traffic each round.'''
+
+    best = {}
+    for _ in xrange(repeat):
+        keeper = pycecap.StateKeeper()
+        totals = {}
+        for line in lines:
+            dir, message = line[0], line[1:]
+            if dir == '>':
+                pycecap.replay_line(keeper, line)
+                continue
+
+            if message.startswith('*'):
+                name = message.split(';', 2)[1]
+            else:
+                name = 'reply to ' + keeper._pending_commands[message.partition(';')[0]].command
+
+            start = timer()
+            keeper.parse(message)
+            elapsed = timer() - start
+
+            total = totals.get(name)
+            if total is None:
+                totals[name] = [1, elapsed]
+            else:
+                total[0] += 1
+                total[1] += elapsed
+
+        for (name, (count, elapsed)) in totals.iteritems():
+            if name not in best or elapsed / count < best[name]['per_line']:
+                best[name] = {'count': count, 'per_line': elapsed / count}
+
+    return best
+
+def main(argv):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-s', '--scale', type='float', default=1.0,
+                      help='scale the size of the generated traffic (default: %default)')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='take the best of this many rounds (default: %default)')
+    parser.add_option('--seed', type='int', default=0, help='seed for the traffic generator')
+    parser.add_option('-j', '--json', metavar='FILE', help='also write the results as JSON to FILE')
+    options, _ = parser.parse_args(argv[1:])
+
+    generator = TrafficGenerator(seed=options.seed, presences=int(2000 * options.scale),
+                                 channels=int(max(50 * options.scale, 1)), events=int(20000 * options.scale))
+    lines = list(generator.lines())
+
+    results = {
+        'python': platform.python_version(),
+        'scale': options.scale,
+        'lines': len(lines),
+        'codec': bench_codec(lines, options.repeat),
+        'messages': bench_messages(lines, options.repeat),
+        'statekeeper': bench_statekeeper(lines, options.repeat),
+    }
+
+    print '%i lines of traffic (scale %g), best of %i' % (len(lines), options.scale, options.repeat)
+    for section in ('codec', 'messages'):
+        print
+        for (name, per_item) in sorted(results[section].iteritems()):
+            if per_item is None:
+                print '%-50s %10s' % (name, 'n/a')
+            else:
+                print '%-50s %10.3f us' % (name, per_item * 1e6)
+    print
+    for (name, result) in sorted(results['statekeeper'].iteritems()):
+        print '%-50s %10.3f us  (%i lines)' % ('StateKeeper.parse: ' + name, result['per_line'] * 1e6, result['count'])
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,54 @@
+#!/usr/bin/python
+
+# Compare rebuilding a StateKeeper by replaying a traffic log against restoring a snapshot.
+#
+# Usage: benchmarks/snapshot.py [replay log]
+#
+# Without a log, synthetic traffic from traffic.py is used.
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tempfile
+import time
+
+import pycecap
+from traffic import TrafficGenerator
+
+def main(argv):
+    if len(argv) > 1:
+        with open(argv[1]) as f:
+            lines = [line.rstrip('\n\r') for line in f]
+    else:
+        lines = list(TrafficGenerator(networks=5, presences=20000, channels=200, events=20000).lines())
+
+    keeper = pycecap.StateKeeper()
+    start = time.time()
+    for line in lines:
+        pycecap.replay_line(keeper, line)
+    replay_time = time.time() - start
+
+    fd, path = tempfile.mkstemp(suffix='.snapshot')
+    os.close(fd)
+    try:
+        start = time.time()
+        keeper.snapshot(path)
+        snapshot_time = time.time() - start
+        size = os.path.getsize(path)
+
+        restored = pycecap.StateKeeper()
+        start = time.time()
+        restored.restore(path)
+        restore_time = time.time() - start
+    finally:
+        os.unlink(path)
+
+    presences = sum(len(lp.presences) for lp in restored.local_presences.itervalues())
+    print '%i lines, %i local presences, %i presences' % (len(lines), len(restored.local_presences), presences)
+    print 'replay:   %8.3f s' % replay_time
+    print 'snapshot: %8.3f s (%i bytes)' % (snapshot_time, size)
+    print 'restore:  %8.3f s (%.1fx faster than replay)' % (restore_time, replay_time / max(restore_time, 1e-9))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+
+# Measure the memory used per state entity in a large, synthetic session.
+#
+# Usage: benchmarks/state_memory.py [networks] [presences per network] [channels per network]
+#
+# The session is built twice: directly through the state API, and by parsing synthetic
+# traffic (see traffic.py) with and without interning of entity names.
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import gc
+import types
+
+import pycecap
+from pycecap import state
+from traffic import TrafficGenerator
+
+SKIP_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+
+def deep_sizeof(root, seen=None):
+    '''Sum sys.getsizeof over everything reachable from root (ignoring types, modules & functions).'''
+
+    if seen is None:
+        seen = set()
+
+    size = 0
+    pending = [root]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, SKIP_TYPES):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+
+    return size
+
+def build_session(networks, presences, channels):
+    '''Build a StateKeeper with the given number of networks, presences and channels.
+
+    Each presence is in two channels, and every presence has an address.
+    '''
+
+    keeper = pycecap.StateKeeper()
+    for n in xrange(networks):
+        network = 'network%i' % n
+        keeper.get_network(network)
+
+        local_presence = keeper.get_local_presence(state.Connection(network, 'me'))
+        for c in xrange(channels):
+            local_presence.get_channel('#channel%i' % c)
+
+        for p in xrange(presences):
+            name = 'nick%i' % p
+            presence = local_presence.get_presence(name)
+            presence.info['address'] = 'user%i@host%i.example.org' % (p, p % 1000)
+            for c in (p % channels, (p * 7) % channels):
+                channel = '#channel%i' % c
+                local_presence.channels[channel].presences[name] = ''
+                presence.channels.add(channel)
+
+    return keeper
+
+def main(argv):
+    networks, presences, channels = [int(arg) for arg in argv[1:4]] + [10, 10000, 100][len(argv) - 1:]
+
+    keeper = build_session(networks, presences, channels)
+
+    entities = networks * (1 + 1 + presences + channels)
+    total = deep_sizeof(keeper.networks) + deep_sizeof(keeper.local_presences)
+
+    # Per-entity cost of the objects themselves (no names, info contents or membership).
+    local_presence = keeper.local_presences.values()[0]
+    presence = local_presence.presences.values()[0]
+    channel = local_presence.channels.values()[0]
+    for (name, obj) in (('Network', keeper.networks.values()[0]),
+                        ('Connection', local_presence.connection),
+                        ('LocalPresence', local_presence),
+                        ('Presence', presence),
+                        ('Channel', channel)):
+        own = sys.getsizeof(obj) + (sys.getsizeof(obj.__dict__) if hasattr(obj, '__dict__') else 0)
+        print '%-14s %6i bytes' % (name, own)
+
+    print '%i networks, %i presences, %i channels per network' % (networks, presences, channels)
+    print 'total: %i bytes, %.1f bytes per entity' % (total, total / float(entities))
+
+    print
+    print 'Parsed from traffic:'
+    lines = list(TrafficGenerator(networks=networks, presences=presences, channels=channels,
+                                  events=presences * 2).lines())
+    for intern_limit in (0, pycecap.StateKeeper.DEFAULT_INTERN_LIMIT):
+        keeper = pycecap.StateKeeper(intern_limit=intern_limit)
+        for line in lines:
+            pycecap.replay_line(keeper, line)
+
+        seen = set()
+        total = deep_sizeof(keeper.networks, seen) + deep_sizeof(keeper.local_presences, seen)
+        print 'intern_limit=%-7i total: %i bytes, %.1f bytes per entity' % (intern_limit, total, total / float(entities))
+
+if __name__ == '__main__':
+    main(sys.argv)
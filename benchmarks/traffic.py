@@ -0,0 +1,120 @@
+#!/usr/bin/python
+
+# Deterministic generator of realistic icecap traffic, in the traffic log format
+# written by test.py ('<' for lines from icecapd, '>' for commands sent to it).
+#
+# Usage: benchmarks/traffic.py [networks] [presences per network] [events per network] > log
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import random
+
+from pycecap import escape
+
+WORDS = ['hello', 'there', 'icecap', 'irssi', 'so;what', 'C:\\path', 'lol', 'ok', 'multi\nline',
+         'yes', 'no', 'maybe', 'foo', 'bar', 'a.b', 'nick:', 'http://example.org/?a=b;c=d']
+
+class TrafficGenerator(object):
+    '''Generates the same traffic for the same arguments.
+
+    For every network, this sets up the network, a gateway, our local presence, the
+    channels and the presences, and asks for the names of the busiest channel. That's
+    followed by a mix of messages, nick & address changes, joins & parts.
+    '''
+
+    def __init__(self, seed=0, networks=2, presences=2000, channels=50, events=20000):
+        self.seed = seed
+        self.networks = networks
+        self.presences = presences
+        self.channels = channels
+        self.events = events
+
+    def lines(self):
+        '''Iterate over the lines of the traffic log (without newlines).'''
+
+        rng = random.Random(self.seed)
+        tag = 1
+
+        for n in xrange(self.networks):
+            network = 'network%i' % n
+            conn = 'network=%s;mypresence=me' % network
+
+            yield '<*;network_init;network=%s;protocol=irc' % network
+            yield '<*;gateway_init;network=%s;host=irc%i.example.org;port=6667' % (network, n)
+            yield '<*;local_presence_init;%s;real_name=%s' % (conn, escape('Me; myself & I'))
+
+            channels = ['#channel%i' % c for c in xrange(self.channels)]
+            for channel in channels:
+                yield '<*;channel_init;%s;channel=%s;topic=%s' % (conn, channel, escape(self._text(rng)))
+
+            nicks = ['nick%i' % p for p in xrange(self.presences)]
+            members = dict((channel, set()) for channel in channels)
+            for nick in nicks:
+                yield '<*;presence_init;%s;presence=%s;address=%s' % (conn, nick, self._address(rng, nick))
+                # Channel popularity is skewed, the first channels are the biggest.
+                for _ in xrange(rng.randint(1, 3)):
+                    channel = channels[min(int(rng.expovariate(5.0 / self.channels)), self.channels - 1)]
+                    if nick not in members[channel]:
+                        members[channel].add(nick)
+                        yield '<*;channel_presence_added;%s;channel=%s;presence=%s' % (conn, channel, nick)
+
+            # A 'channel names' for the biggest channel.
+            yield '>%i;channel names;%s;channel=%s' % (tag, conn, channels[0])
+            for nick in sorted(members[channels[0]]):
+                yield '<%i;>;presence=%s;mode=%s' % (tag, nick, rng.choice(['', '', '', '', '@', '+']))
+            yield '<%i;+' % tag
+            tag += 1
+
+            for _ in xrange(self.events):
+                roll = rng.random()
+                if roll < 0.6:
+                    channel = rng.choice(channels)
+                    if not members[channel]:
+                        continue
+                    nick = rng.sample(members[channel], 1)[0]
+                    yield '<*;msg;%s;channel=%s;presence=%s;msg=%s' % (conn, channel, nick, escape(self._text(rng)))
+                elif roll < 0.7:
+                    # Nick change
+                    index = rng.randrange(len(nicks))
+                    old, new = nicks[index], '%s_%i' % (nicks[index].split('_')[0], rng.randrange(1000))
+                    if new in nicks:
+                        continue
+                    nicks[index] = new
+                    for nicks_in_channel in members.itervalues():
+                        if old in nicks_in_channel:
+                            nicks_in_channel.remove(old)
+                            nicks_in_channel.add(new)
+                    yield '<*;presence_changed;%s;presence=%s;name=%s' % (conn, old, new)
+                elif roll < 0.75:
+                    nick = rng.choice(nicks)
+                    yield '<*;presence_changed;%s;presence=%s;address=%s' % (conn, nick, self._address(rng, nick))
+                elif roll < 0.875:
+                    channel, nick = rng.choice(channels), rng.choice(nicks)
+                    if nick not in members[channel]:
+                        members[channel].add(nick)
+                        yield '<*;channel_presence_added;%s;channel=%s;presence=%s' % (conn, channel, nick)
+                else:
+                    channel = rng.choice(channels)
+                    if members[channel]:
+                        nick = rng.sample(members[channel], 1)[0]
+                        members[channel].remove(nick)
+                        yield '<*;channel_presence_removed;%s;channel=%s;presence=%s' % (conn, channel, nick)
+
+    def _text(self, rng):
+        return ' '.join(rng.choice(WORDS) for _ in xrange(rng.randint(1, 12)))
+
+    def _address(self, rng, nick):
+        return '%s@host%i.%s' % (nick.split('_')[0], rng.randrange(500), rng.choice(['example.org', 'example.com', 'isp.net']))
+
+def main(argv):
+    args = [int(arg) for arg in argv[1:4]]
+    generator = TrafficGenerator(networks=args[0] if args else 2,
+                                 presences=args[1] if len(args) > 1 else 2000,
+                                 events=args[2] if len(args) > 2 else 20000)
+    for line in generator.lines():
+        print line
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,37 @@
+#!/usr/bin/python
+
+# Convert traffic logs (as written by test.py) between the text and packed formats.
+#
+# Text logs are packed into <log>.pylog (minus a .log extension), packed logs are
+# unpacked into <log>.log. Prints the sizes before and after.
+
+from pycecap.packedlog import convert_log, is_packed_log
+
+from optparse import OptionParser
+import os
+import sys
+
+parser = OptionParser(usage='%prog [options] log ...')
+parser.add_option('-o', '--output', help='name of the converted log (only with a single log)')
+parser.add_option('-b', '--block-lines', type='int', default=4096,
+                  help='maximum number of lines per packed block (default: %default)')
+parser.add_option('-z', '--level', type='int', default=6, help='zlib compression level (default: %default)')
+options, logs = parser.parse_args()
+
+if not logs:
+    parser.error('no logs given')
+if options.output and len(logs) > 1:
+    parser.error('--output only works with a single log')
+
+for path in logs:
+    base = path[:-len('.log')] if path.endswith('.log') else os.path.splitext(path)[0]
+    if is_packed_log(path):
+        output = options.output or base + '.log'
+        lines = convert_log(path, output)
+    else:
+        output = options.output or base + '.pylog'
+        lines = convert_log(path, output, block_lines=options.block_lines, level=options.level)
+
+    before, after = os.path.getsize(path), os.path.getsize(output)
+    print >>sys.stderr, '%s -> %s: %i lines, %i -> %i bytes (%.1f%%)' % (
+        path, output, lines, before, after, 100.0 * after / before if before else 0)
@@ -1,3 +1,8 @@
 from protocol import *
 from stateful_protocol import *
 from statekeeper import *
+from history import *
+from replay import *
+from logreader import *
+from view import *
+from query import *
@@ -0,0 +1,233 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# pycecap
+# Copyright (c) 2009 Jørgen Tjernø <jorgenpt@gmail.com>
+#
+# This package is free software;  you can redistribute it and/or
+# modify it under the terms of the license found in the file
+# named COPYING that should have accompanied this file.
+#
+# THIS PACKAGE IS PROVIDED ``AS IS'' AND WITHOUT ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, WITHOUT LIMITATION, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE.
+
+'''An on-disk archive of received events, searchable by connection, channel, presence and time.'''
+
+from protocol import Event, unescape_params
+from statekeeper import EVENT
+
+from collections import deque
+import sqlite3
+import threading
+import time
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY,
+        time REAL NOT NULL,
+        event TEXT NOT NULL,
+        network TEXT,
+        mypresence TEXT,
+        channel TEXT,
+        presence TEXT,
+        line TEXT NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS events_time ON events (time)',
+    'CREATE INDEX IF NOT EXISTS events_connection ON events (network, mypresence, time)',
+    'CREATE INDEX IF NOT EXISTS events_channel ON events (network, mypresence, channel, time)',
+    'CREATE INDEX IF NOT EXISTS events_presence ON events (network, mypresence, presence, time)',
+]
+
+class ArchiveError(Exception):
+    '''Writing to the archive failed, see the original exception in args[0].'''
+
+class Archive(object):
+    '''Append events to an SQLite database, from a background thread.
+
+    record() only appends the raw line to a queue (a deque, so there's no lock to take),
+    so parsing never waits for the disk. The writer thread decodes the lines and inserts
+    them in batches, one transaction per batch, into a database in WAL mode, so search()
+    can be used (from any thread) while it's being written.
+    '''
+
+    def __init__(self, path, events=None, batch_size=1000, flush_interval=1.0):
+        '''Open (or create) an archive and start the writer thread.
+
+        Args:
+            path: File name of the SQLite database.
+            events: Optional list of event names to archive (e.g. ['msg']), defaults to all.
+            batch_size: Maximum number of events written in one transaction.
+            flush_interval: Maximum number of seconds an event waits for more to batch with.
+        '''
+
+        self.path = path
+        self.events = frozenset(events) if events is not None else None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.error = None
+
+        connection = self._connect()
+        try:
+            with connection:
+                for statement in SCHEMA:
+                    connection.execute(statement)
+        finally:
+            connection.close()
+
+        # Events (when, line) waiting to be written, and flush() / close() markers. The writer
+        # thread is woken up when a batch is full, or when it's waited for flush_interval.
+        self._queue = deque()
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='pycecap archive')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def attach(self, keeper):
+        '''Archive the events parsed by the given StateKeeper (see StateKeeper.add_hook).'''
+        keeper.add_hook(EVENT, self.record)
+
+    def detach(self, keeper):
+        '''Stop archiving the events of a StateKeeper passed to attach().'''
+        keeper.remove_hook(EVENT, self.record)
+
+    def record(self, event, when=None):
+        '''Queue an event for archiving.
+
+        Args:
+            event: The Event (or StatefulMessage wrapping one).
+            when: Time the event was received, defaults to now.
+        '''
+
+        if self.events is None or event.command in self.events:
+            queue = self._queue
+            queue.append((time.time() if when is None else when, event.message))
+            if len(queue) >= self.batch_size:
+                self._wakeup.set()
+
+    def flush(self):
+        '''Wait until everything recorded so far is written.'''
+
+        done = threading.Event()
+        self._queue.append(done)
+        self._wakeup.set()
+        while not done.wait(0.1):
+            if not self._thread.is_alive():
+                break
+        self._check()
+
+    def close(self):
+        '''Write everything recorded so far, and stop the writer thread.'''
+
+        if self._thread.is_alive():
+            self._queue.append(None)
+            self._wakeup.set()
+            self._thread.join()
+        self._check()
+
+    def search(self, network=None, mypresence=None, channel=None, presence=None, event=None,
+               since=None, until=None, limit=100):
+        '''Find archived events, newest first.
+
+        Events still queued for writing are not included, see flush().
+
+        Args:
+            network: Only events on this network.
+            mypresence: Only events of this local presence (use together with network).
+            channel: Only events in this channel.
+            presence: Only events from/about this presence.
+            event: Only events with this name (e.g. 'msg').
+            since: Only events received at or after this time.
+            until: Only events received before this time.
+            limit: Maximum number of events to return, or None for all of them.
+
+        Returns:
+            A list of (time, Event).
+        '''
+
+        where, args = [], []
+        for (column, value) in (('network', network), ('mypresence', mypresence), ('channel', channel),
+                                ('presence', presence), ('event', event)):
+            if value is not None:
+                where.append('%s = ?' % column)
+                args.append(value)
+        if since is not None:
+            where.append('time >= ?')
+            args.append(since)
+        if until is not None:
+            where.append('time < ?')
+            args.append(until)
+
+        query = 'SELECT time, line FROM events'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY time DESC'
+        if limit is not None:
+            query += ' LIMIT %i' % limit
+
+        connection = self._connect()
+        try:
+            rows = connection.execute(query, args).fetchall()
+        finally:
+            connection.close()
+        return [(when, Event(str(line))) for (when, line) in rows]
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.text_factory = str
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _check(self):
+        if self.error is not None:
+            raise ArchiveError(self.error)
+
+    def _run(self):
+        connection = self._connect()
+        queue = self._queue
+        try:
+            running = True
+            while running:
+                self._wakeup.wait(self.flush_interval)
+                self._wakeup.clear()
+
+                batch, waiting = [], []
+                while queue and running:
+                    item = queue.popleft()
+                    if item is None:
+                        running = False
+                    elif isinstance(item, tuple):
+                        batch.append(item)
+                        if len(batch) < self.batch_size:
+                            continue
+                    else:
+                        waiting.append(item)
+
+                    # Write what we have before a flush() / close() marker, or when the batch is full.
+                    self._write(connection, batch)
+                    batch = []
+                self._write(connection, batch)
+
+                for done in waiting:
+                    done.set()
+        finally:
+            connection.close()
+
+    def _write(self, connection, batch):
+        if not batch or self.error is not None:
+            return
+
+        rows = []
+        for (when, line) in batch:
+            parts = line.split(';')
+            params = unescape_params(parts[2:])
+            rows.append((when, parts[1], params.get('network'), params.get('mypresence'),
+                         params.get('channel'), params.get('presence'), line))
+
+        try:
+            with connection:
+                connection.executemany('INSERT INTO events (time, event, network, mypresence, channel, presence, line) '
+                                       'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        except sqlite3.Error, e:
+            self.error = e
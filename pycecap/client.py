@@ -0,0 +1,366 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# pycecap
+# Copyright (c) 2009 Jørgen Tjernø <jorgenpt@gmail.com>
+#
+# This package is free software;  you can redistribute it and/or
+# modify it under the terms of the license found in the file
+# named COPYING that should have accompanied this file.
+#
+# THIS PACKAGE IS PROVIDED ``AS IS'' AND WITHOUT ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, WITHOUT LIMITATION, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE.
+
+'''A non-blocking icecapd client, and a select() loop to drive any number of them.'''
+
+import errno
+import fcntl
+import os
+import select
+import socket
+import subprocess
+import time
+
+from protocol import Command, Reply
+from statekeeper import StateKeeper, TIMEOUT
+
+READ_SIZE = 65536
+
+class PendingReply(object):
+    '''The outcome of a command sent with IcecapClient.send().
+
+    The command is done once its final ('+' or '-') reply arrives, it times out (the
+    status is then TIMEOUT), or the connection is closed. Callbacks registered with add_callback() are then called with this object.
+    Replies with the '>' status are passed to callbacks registered with add_more_callback()
+    as they arrive.
+    '''
+
+    def __init__(self, command):
+        self.command = command
+        self.status = None
+        self._callbacks = []
+        self._more_callbacks = []
+
+    def done(self):
+        '''True if the command has completed (successfully or not).'''
+        return self.status is not None
+
+    @property
+    def ok(self):
+        '''True if the command has completed successfully.'''
+        return self.status == Reply.OK
+
+    @property
+    def replies(self):
+        '''The replies received for the command so far, or None if the command doesn't keep them.'''
+        return self.command.replies
+
+    def add_callback(self, callback):
+        '''Call callback(pending_reply) once the command is done (right away if it already is).'''
+        if self.done():
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def add_more_callback(self, callback):
+        '''Call callback(pending_reply, reply) for every '>' reply from now on.'''
+        self._more_callbacks.append(callback)
+
+    def _more(self, reply):
+        for callback in self._more_callbacks:
+            callback(self, reply)
+
+    def _finish(self, status):
+        self.status = status
+        callbacks, self._callbacks, self._more_callbacks = self._callbacks, [], []
+        for callback in callbacks:
+            callback(self)
+
+    def __repr__(self):
+        return 'PendingReply(%r, status=%r)' % (self.command, self.status)
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class IcecapClient(StateKeeper):
+    '''A StateKeeper that talks to icecapd itself, without blocking.
+
+    Use one of spawn(), connect_unix() or connect_tcp() to create a client, and run_clients()
+    (from this module) to drive one or more clients from a single select() loop.
+    Clients can also be driven from another event loop by watching fileno() for reading,
+    write_fileno() for writing (when wants_write() is true), and calling handle_read()
+    / handle_write().
+    '''
+
+    def __init__(self, read_fd, write_fd=None, owner=None, **kwargs):
+        '''Create a new client talking to icecapd over the given file descriptors.
+
+        Args:
+            read_fd: File descriptor we read icecapd's output from.
+            write_fd: File descriptor we write commands to, defaults to read_fd (e.g. sockets).
+            owner: The object owning the file descriptors (a Popen or a socket), kept alive
+                as long as the client, and closed by close().
+            kwargs: Passed on to StateKeeper.
+        '''
+
+        StateKeeper.__init__(self, **kwargs)
+
+        if write_fd is None:
+            write_fd = read_fd
+
+        self._read_fd = read_fd
+        self._write_fd = write_fd
+        self._owner = owner
+        self._outbound = bytearray()
+        self._pending_replies = {}
+        self.closed = False
+
+        _set_nonblocking(read_fd)
+        _set_nonblocking(write_fd)
+
+    @classmethod
+    def spawn(cls, argv, **kwargs):
+        '''Start icecapd (e.g. ['icecapd'] or ['ssh', 'host', 'icecapd']) and talk to it over pipes.'''
+
+        process = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        return cls(process.stdout.fileno(), process.stdin.fileno(), owner=process, **kwargs)
+
+    @classmethod
+    def connect_unix(cls, path, **kwargs):
+        '''Connect to icecapd listening on the given UNIX socket.'''
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        return cls(sock.fileno(), owner=sock, **kwargs)
+
+    @classmethod
+    def connect_tcp(cls, host, port, **kwargs):
+        '''Connect to icecapd listening on the given TCP host & port.'''
+
+        sock = socket.create_connection((host, port))
+        return cls(sock.fileno(), owner=sock, **kwargs)
+
+    def fileno(self):
+        return self._read_fd
+
+    def write_fileno(self):
+        return self._write_fd
+
+    def send(self, object_or_command, params=None, timeout=None):
+        '''Send a command to icecapd.
+
+        Takes the same arguments as StateKeeper.presend, and queues the command for writing.
+        Once the client is closed, the command isn't sent (or tagged), and the PendingReply
+        fails right away.
+
+        Returns:
+            A PendingReply for the command.
+        '''
+
+        if self.closed:
+            return self._failed(object_or_command, params)
+
+        command = self.presend(object_or_command, params, timeout)
+        pending = PendingReply(command)
+        self._pending_replies[command.tag] = pending
+        self.write('%s\n' % command)
+        return pending
+
+    def send_many(self, commands, timeout=None):
+        '''Send a batch of commands to icecapd, throttled by max_in_flight.
+
+        Takes the same arguments as StateKeeper.presend_many. The commands are written as
+        the in-flight window allows, as many as possible in a single write.
+
+        Returns:
+            A list of PendingReplies for the commands, in the same order.
+        '''
+
+        if self.closed:
+            result = []
+            for command in commands:
+                if isinstance(command, tuple):
+                    result.append(self._failed(*command))
+                else:
+                    result.append(self._failed(command, None))
+            return result
+
+        result = []
+        for command in self.presend_many(commands, timeout):
+            pending = PendingReply(command)
+            self._pending_replies[command.tag] = pending
+            result.append(pending)
+
+        self._flush_outbound()
+        return result
+
+    def _failed(self, object_or_command, params):
+        # A failed PendingReply for a command that can't be sent anymore.
+        if isinstance(object_or_command, basestring):
+            object_or_command = Command('', object_or_command, params)
+        pending = PendingReply(object_or_command)
+        pending._finish(Reply.FAIL)
+        return pending
+
+    def _flush_outbound(self):
+        if self._queued and not self.closed:
+            data = self.take_outbound()
+            if data:
+                self.write(data)
+
+    def expire(self, now=None):
+        count = StateKeeper.expire(self, now)
+        if count:
+            self._flush_outbound()
+        return count
+
+    def write(self, data):
+        '''Queue raw data to be written to icecapd.'''
+        self._outbound += data
+
+    def wants_write(self):
+        return bool(self._outbound) and not self.closed
+
+    def handle_read(self):
+        '''Read whatever is available from icecapd and parse it.'''
+
+        try:
+            data = os.read(self._read_fd, READ_SIZE)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+
+        if data:
+            self.feed(data)
+            self._flush_outbound()
+        else:
+            self.close()
+
+    def handle_write(self):
+        '''Write as much of the queued data as icecapd will take right now.'''
+
+        try:
+            written = os.write(self._write_fd, self._outbound)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            if e.errno == errno.EPIPE:
+                self.close()
+                return
+            raise
+
+        del self._outbound[:written]
+
+    def close(self):
+        '''Close the connection to icecapd.
+
+        Commands still waiting for a reply fail, and are dropped from the pending table.
+        '''
+
+        if self.closed:
+            return
+        self.closed = True
+
+        if isinstance(self._owner, subprocess.Popen):
+            self._owner.stdin.close()
+            self._owner.stdout.close()
+            if self._owner.poll() is None:
+                self._owner.terminate()
+            self._owner.wait()
+        elif self._owner is not None:
+            self._owner.close()
+        else:
+            os.close(self._read_fd)
+            if self._write_fd != self._read_fd:
+                os.close(self._write_fd)
+
+        # Nothing pending can be answered anymore.
+        self._queued.clear()
+        self._pending_commands.clear()
+        self._staging.clear()
+        self._deadlines = []
+
+        pending_replies, self._pending_replies = self._pending_replies, {}
+        for pending in pending_replies.itervalues():
+            pending._finish(Reply.FAIL)
+
+    def wait(self, pending, timeout=None):
+        '''Drive this client until the given PendingReply is done.
+
+        Returns:
+            True if the command is done, False if we timed out.
+        '''
+
+        run_clients([self], until=pending.done, timeout=timeout)
+        return pending.done()
+
+    def _reply_received(self, command, reply):
+        pending = self._pending_replies.get(command.tag)
+        if pending is None:
+            return
+
+        if reply.command == reply.MORE:
+            pending._more(reply)
+        else:
+            del self._pending_replies[command.tag]
+            pending._finish(reply.command)
+
+    def _command_expired(self, command):
+        pending = self._pending_replies.pop(command.tag, None)
+        if pending is not None:
+            pending._finish(TIMEOUT)
+
+def run_clients(clients, until=None, timeout=None):
+    '''Drive the given IcecapClients from a single select() loop.
+
+    This also times out commands whose deadline has passed (see StateKeeper.expire).
+
+    Args:
+        clients: The clients to drive, closed clients are dropped.
+        until: Optional function, the loop stops as soon as it returns True.
+        timeout: Optional number of seconds after which the loop stops.
+    '''
+
+    clients = list(clients)
+    deadline = None if timeout is None else time.time() + timeout
+
+    while True:
+        now = time.time()
+        for client in clients:
+            if not client.closed:
+                client.expire(now)
+
+        clients = [client for client in clients if not client.closed]
+        if not clients or (until is not None and until()):
+            return
+
+        if deadline is not None and now >= deadline:
+            return
+
+        # Wake up in time for our own deadline, or the first command deadline.
+        wake = deadline
+        for client in clients:
+            next_deadline = client.next_deadline()
+            if next_deadline is not None and (wake is None or next_deadline < wake):
+                wake = next_deadline
+        wait = None if wake is None else max(0, wake - now)
+
+        writers = dict((client.write_fileno(), client) for client in clients if client.wants_write())
+        readers = dict((client.fileno(), client) for client in clients)
+
+        try:
+            readable, writable, _ = select.select(readers.keys(), writers.keys(), [], wait)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        for fd in writable:
+            writers[fd].handle_write()
+        for fd in readable:
+            client = readers[fd]
+            if not client.closed:
+                client.handle_read()
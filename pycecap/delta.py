@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# pycecap
+# Copyright (c) 2009 Jørgen Tjernø <jorgenpt@gmail.com>
+#
+# This package is free software;  you can redistribute it and/or
+# modify it under the terms of the license found in the file
+# named COPYING that should have accompanied this file.
+#
+# THIS PACKAGE IS PROVIDED ``AS IS'' AND WITHOUT ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, WITHOUT LIMITATION, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE.
+
+'''Records describing changes to the state kept by a StateKeeper.'''
+
+from operator import itemgetter
+
+# What happened.
+ADDED = 'added'
+REMOVED = 'removed'
+RENAMED = 'renamed'
+CHANGED = 'changed'
+JOINED = 'joined'
+PARTED = 'parted'
+RESET = 'reset'
+
+# What it happened to.
+NETWORK = 'network'
+GATEWAY = 'gateway'
+LOCAL_PRESENCE = 'local_presence'
+CHANNEL = 'channel'
+PRESENCE = 'presence'
+
+class Delta(tuple):
+    '''A single change to the state, as a (kind, entity, network, mypresence, name, data) tuple.
+
+    The entity is identified by names rather than objects, so a Delta can be stored or
+    sent elsewhere without keeping the state alive:
+
+      kind     entity          network  mypresence  name     data
+      ADDED    NETWORK         network  None        None     info dict
+      ADDED    GATEWAY         network  None        None     gateway dict
+      ADDED    LOCAL_PRESENCE  network  mypresence  None     info dict
+      ADDED    CHANNEL         network  mypresence  channel  info dict
+      ADDED    PRESENCE        network  mypresence  presence info dict
+      REMOVED  (as for ADDED)                                None, or the gateway dict
+      CHANGED  (as for ADDED, not GATEWAY)                   the new info dict
+      RENAMED  PRESENCE        network  mypresence  old name new name
+      JOINED   CHANNEL         network  mypresence  channel  (presence, mode)
+      PARTED   CHANNEL         network  mypresence  channel  presence
+      RESET    None            None     None        None     None
+
+    Removing something implies removing everything that belongs to it: there are no
+    separate Deltas for the channels and presences of a removed local presence, or for
+    the memberships of a removed channel or presence. JOINED is also sent when the mode
+    of a presence already in the channel changes. RESET means the whole state was
+    replaced (e.g. restored from a snapshot), and subscribers should start over from
+    StateKeeper.networks and StateKeeper.local_presences.
+
+    The info dicts are the ones held by the state, and must not be modified.
+    '''
+
+    __slots__ = ()
+
+    def __new__(cls, kind, entity, network=None, mypresence=None, name=None, data=None):
+        return tuple.__new__(cls, (kind, entity, network, mypresence, name, data))
+
+    kind = property(itemgetter(0))
+    entity = property(itemgetter(1))
+    network = property(itemgetter(2))
+    mypresence = property(itemgetter(3))
+    name = property(itemgetter(4))
+    data = property(itemgetter(5))
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    def __repr__(self):
+        return 'Delta(%r, %r, %r, %r, %r, %r)' % self
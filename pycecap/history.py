@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# pycecap
+# Copyright (c) 2009 Jørgen Tjernø <jorgenpt@gmail.com>
+#
+# This package is free software;  you can redistribute it and/or
+# modify it under the terms of the license found in the file
+# named COPYING that should have accompanied this file.
+#
+# THIS PACKAGE IS PROVIDED ``AS IS'' AND WITHOUT ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, WITHOUT LIMITATION, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE.
+
+'''Retention policies for the events a StateKeeper has seen.'''
+
+from collections import deque
+import heapq
+import itertools
+import time
+
+class NoHistory(object):
+    '''Retain no events at all.
+
+    This is also the base class of the other policies - they all support append(event),
+    clear(), len() and iterating over the retained events (oldest first).
+    '''
+
+    def append(self, event):
+        '''Offer a new event to the history, the policy decides whether to keep it.'''
+
+    def clear(self):
+        '''Forget all retained events.'''
+
+    def __iter__(self):
+        return iter(())
+
+    def __len__(self):
+        return 0
+
+    def events(self, name=None):
+        '''Iterate over the retained events (oldest first).
+
+        Args:
+            name: Optional event name, if given only events of that name are returned.
+        '''
+
+        if name is None:
+            return iter(self)
+        return (event for event in self if event.command == name)
+
+    def __repr__(self):
+        return '%s(<%i events>)' % (self.__class__.__name__, len(self))
+
+class RingHistory(NoHistory):
+    '''Retain the last `size` events.'''
+
+    def __init__(self, size):
+        self.size = size
+        self._events = deque(maxlen=size)
+
+    def append(self, event):
+        self._events.append(event)
+
+    def clear(self):
+        self._events.clear()
+
+    def __iter__(self):
+        return iter(self._events)
+
+    def __len__(self):
+        return len(self._events)
+
+class PerEventHistory(NoHistory):
+    '''Retain the last `size` events of each event name.
+
+    This keeps rare events (e.g. network_init) around even when there's a flood
+    of common ones (e.g. msg).
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self._events = {}
+        self._counter = itertools.count()
+
+    def append(self, event):
+        events = self._events.get(event.command)
+        if events is None:
+            events = self._events[event.command] = deque(maxlen=self.size)
+        events.append((next(self._counter), event))
+
+    def clear(self):
+        self._events.clear()
+
+    def events(self, name=None):
+        if name is None:
+            return iter(self)
+        return (event for (_, event) in self._events.get(name, ()))
+
+    def __iter__(self):
+        return (event for (_, event) in heapq.merge(*self._events.itervalues()))
+
+    def __len__(self):
+        return sum(len(events) for events in self._events.itervalues())
+
+class ExpiringHistory(NoHistory):
+    '''Retain the events seen during the last `max_age` seconds.
+
+    Args:
+        max_age: Number of seconds to retain an event.
+        size: Optional upper bound on the number of retained events.
+        clock: Function returning the current time, defaults to time.time.
+    '''
+
+    def __init__(self, max_age, size=None, clock=time.time):
+        self.max_age = max_age
+        self.clock = clock
+        self._events = deque(maxlen=size)
+
+    def _expire(self):
+        cutoff = self.clock() - self.max_age
+        events = self._events
+        while events and events[0][0] < cutoff:
+            events.popleft()
+
+    def append(self, event):
+        self._expire()
+        self._events.append((self.clock(), event))
+
+    def clear(self):
+        self._events.clear()
+
+    def __iter__(self):
+        self._expire()
+        return (event for (_, event) in self._events)
+
+    def __len__(self):
+        self._expire()
+        return len(self._events)
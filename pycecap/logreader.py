@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# pycecap
+# Copyright (c) 2009 Jørgen Tjernø <jorgenpt@gmail.com>
+#
+# This package is free software;  you can redistribute it and/or
+# modify it under the terms of the license found in the file
+# named COPYING that should have accompanied this file.
+#
+# THIS PACKAGE IS PROVIDED ``AS IS'' AND WITHOUT ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, WITHOUT LIMITATION, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE.
+
+'''Fast scanning of (possibly huge) traffic logs through mmap.'''
+
+import mmap
+import os
+
+from replay import replay_line
+
+class LogReader(object):
+    '''Scan a traffic log (see replay.py) without reading it all into memory.
+
+    The log is mapped into memory and split into lines a chunk at a time, so memory
+    use stays flat no matter how big the log is. Lines can be filtered by direction
+    and event name before they're parsed.
+
+    Attributes:
+        lineno: The last line replayed by replay() (e.g. the one that crashed, if it raised).
+    '''
+
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, path, chunk_size=CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.lineno = 0
+
+        self._file = open(path, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+        if self._size:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # Empty files can't be mapped.
+            self._mmap = ''
+
+    def close(self):
+        if self._size:
+            self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _chunks(self):
+        '''Iterate over lists of complete lines (without newlines).'''
+
+        data, size, chunk_size = self._mmap, self._size, self.chunk_size
+        pos = 0
+        tail = ''
+        while pos < size:
+            lines = data[pos:pos + chunk_size].split('\n')
+            pos += chunk_size
+            if tail:
+                lines[0] = tail + lines[0]
+            tail = lines.pop()
+            yield lines
+
+        if tail:
+            yield [tail]
+
+    def lines(self, direction=None, events=None):
+        '''Iterate over (line number, line) of the log, without the newlines.
+
+        Args:
+            direction: '<' or '>' to only get lines received from or sent to icecapd.
+            events: A list of event names, to only get those events.
+        '''
+
+        prefixes = None
+        exact = ()
+        if events is not None:
+            prefixes = tuple('<*;%s;' % name for name in events)
+            exact = set('<*;%s' % name for name in events)
+        elif direction is not None:
+            prefixes = direction
+
+        lineno = 0
+        for lines in self._chunks():
+            if prefixes is None:
+                for line in lines:
+                    lineno += 1
+                    yield (lineno, line.rstrip('\r'))
+                continue
+
+            for line in lines:
+                lineno += 1
+                if line.startswith(prefixes) or (exact and line.rstrip('\r') in exact):
+                    yield (lineno, line.rstrip('\r'))
+
+    def __iter__(self):
+        return (line for (_, line) in self.lines())
+
+    def replay(self, keeper, until=None):
+        '''Replay the log into the given StateKeeper.
+
+        Args:
+            keeper: The StateKeeper to replay into.
+            until: Line number to stop after, or None to replay the whole log.
+
+        Returns:
+            The number of lines replayed.
+        '''
+
+        parse = keeper.parse
+        lineno = 0
+        try:
+            for lines in self._chunks():
+                if until is not None and lineno + len(lines) > until:
+                    lines = lines[:until - lineno]
+
+                for line in lines:
+                    lineno += 1
+                    if line.startswith('<'):
+                        message = line[1:].rstrip('\r')
+                        if message:
+                            parse(message)
+                    else:
+                        replay_line(keeper, line.rstrip('\r'))
+
+                if keeper._subscribers:
+                    keeper.flush_deltas()
+
+                if until is not None and lineno >= until:
+                    break
+        finally:
+            self.lineno = lineno
+
+        return lineno
@@ -0,0 +1,369 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# pycecap
+# Copyright (c) 2009 Jørgen Tjernø <jorgenpt@gmail.com>
+#
+# This package is free software;  you can redistribute it and/or
+# modify it under the terms of the license found in the file
+# named COPYING that should have accompanied this file.
+#
+# THIS PACKAGE IS PROVIDED ``AS IS'' AND WITHOUT ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, WITHOUT LIMITATION, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE.
+
+'''Compact, compressed traffic logs.
+
+A packed log holds the same lines as a text traffic log (see replay.py), in blocks of
+zlib-compressed, length-prefixed records:
+
+    header   MAGIC, VERSION
+    block    compressed length, number of the first line, line count, uncompressed length
+             zlib(length of every record in the block, followed by the records)
+    ...
+    index    number of the first line & file offset of every block
+    footer   offset of the index, number of blocks, flags, MAGIC
+
+The only flag says that the last line had no newline, so converting a text log to a packed
+log and back gives back the same bytes.
+
+The index and footer are written by close(). Logs that were never closed (e.g. the
+client crashed) are still readable: without a footer, the block headers are scanned
+instead, and a partially written last block is ignored.
+'''
+
+from statekeeper import RECEIVED, SENT
+
+import os
+import struct
+import time
+import zlib
+
+MAGIC = 'PYCECAPL'
+VERSION = 2
+HEADER = struct.Struct('!8sB')
+BLOCK = struct.Struct('!IQII')
+INDEX_ENTRY = struct.Struct('!QQ')
+FOOTER = struct.Struct('!QIB8s')
+
+# Footer flags.
+NO_FINAL_NEWLINE = 1
+
+def is_packed_log(path):
+    '''Check whether the given file is a packed log (rather than a text log).'''
+
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+    return len(header) == HEADER.size and header[:len(MAGIC)] == MAGIC
+
+class PackedLogWriter(object):
+    '''Write a packed log, a block at a time.
+
+    Lines are collected until there are block_lines of them (or block_size bytes), then
+    compressed and written as one block. Use attach() to log the traffic of a live
+    StateKeeper or IcecapClient, and call close() when done.
+
+    Attributes:
+        lineno: Number of lines written so far.
+        final_newline: Whether the last line ends with a newline when converted back to
+            a text log (see convert_log).
+    '''
+
+    def __init__(self, path, block_lines=4096, block_size=1 << 18, flush_interval=None, level=6):
+        '''Create a new packed log, replacing any existing file.
+
+        Args:
+            path: File name of the log.
+            block_lines: Maximum number of lines in a block.
+            block_size: Maximum uncompressed size of a block, in bytes.
+            flush_interval: If set, write a block (even a short one) once its first line
+                is this many seconds old, so a live log doesn't lag behind by much. This
+                is only checked when a line is written, so when traffic stops, call flush()
+                (e.g. from your event loop) to write the lines still held back.
+            level: zlib compression level.
+        '''
+
+        self.path = path
+        self.block_lines = block_lines
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.level = level
+        self.lineno = 0
+        self.final_newline = True
+
+        self._file = open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION))
+        # Lines of the current block, their total length and when the first one was written.
+        self._lines = []
+        self._size = 0
+        self._started = None
+        # (first line number, offset) of every block written.
+        self._index = []
+
+    def write(self, line):
+        '''Append a line (as in a text log, with the direction prefix and without the newline).'''
+
+        lines = self._lines
+        if not lines and self.flush_interval is not None:
+            self._started = time.time()
+        lines.append(line)
+        self._size += len(line)
+        self.lineno += 1
+
+        if (len(lines) >= self.block_lines or self._size >= self.block_size or
+                (self._started is not None and time.time() - self._started >= self.flush_interval)):
+            self._write_block()
+
+    def received(self, message):
+        '''Append a line received from icecapd.'''
+        self.write('<' + message)
+
+    def sent(self, command):
+        '''Append a command sent to icecapd (a Command or its string).'''
+        self.write('>%s' % command)
+
+    def attach(self, keeper):
+        '''Log the traffic of the given StateKeeper (or IcecapClient), see StateKeeper.add_hook.
+
+        Every line parsed is logged as received, and every command handed out for
+        sending (by presend() or take_outbound()) as sent.
+        '''
+
+        keeper.add_hook(RECEIVED, self.received)
+        keeper.add_hook(SENT, self.sent)
+
+    def detach(self, keeper):
+        '''Stop logging the traffic of a StateKeeper passed to attach().'''
+
+        keeper.remove_hook(RECEIVED, self.received)
+        keeper.remove_hook(SENT, self.sent)
+
+    def flush(self):
+        '''Write the current block (if any), and flush the file.'''
+
+        self._write_block()
+        self._file.flush()
+
+    def close(self):
+        '''Write the current block and the index, and close the file.'''
+
+        if self._file.closed:
+            return
+
+        self._write_block()
+        index_offset = self._file.tell()
+        self._file.write(''.join(INDEX_ENTRY.pack(lineno, offset) for (lineno, offset) in self._index))
+        flags = 0 if self.final_newline else NO_FINAL_NEWLINE
+        self._file.write(FOOTER.pack(index_offset, len(self._index), flags, MAGIC))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write_block(self):
+        lines = self._lines
+        if not lines:
+            return
+
+        raw = struct.pack('!%dI' % len(lines), *[len(line) for line in lines]) + ''.join(lines)
+        data = zlib.compress(raw, self.level)
+        first_lineno = self.lineno - len(lines) + 1
+
+        self._index.append((first_lineno, self._file.tell()))
+        self._file.write(BLOCK.pack(len(data), first_lineno, len(lines), len(raw)))
+        self._file.write(data)
+
+        self._lines = []
+        self._size = 0
+        self._started = None
+
+class PackedLogReader(object):
+    '''Read a packed log, decompressing a block at a time.
+
+    This has the same lines() interface as LogReader, but can start at any line
+    without decompressing the blocks before it.
+
+    Attributes:
+        blocks: List of (number of the first line, line count, offset) of every block.
+        line_count: Number of lines in the log.
+        complete: Whether the log was closed properly (i.e. has an index).
+        final_newline: Whether the last line ends with a newline in the text log.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+
+        header = self._file.read(HEADER.size)
+        if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+            self._file.close()
+            raise ValueError('%s is not a packed log' % path)
+        if HEADER.unpack(header)[1] != VERSION:
+            self._file.close()
+            raise ValueError('%s: unsupported packed log version %i' % (path, HEADER.unpack(header)[1]))
+
+        self.complete = self._load_index()
+        if not self.complete:
+            self._scan_blocks()
+
+        if self.blocks:
+            lineno, count, _ = self.blocks[-1]
+            self.line_count = lineno + count - 1
+        else:
+            self.line_count = 0
+
+    def _load_index(self):
+        if self._size < HEADER.size + FOOTER.size:
+            return False
+
+        f = self._file
+        f.seek(self._size - FOOTER.size)
+        index_offset, count, flags, magic = FOOTER.unpack(f.read(FOOTER.size))
+        if magic != MAGIC or index_offset + count * INDEX_ENTRY.size != self._size - FOOTER.size:
+            return False
+        self.final_newline = not flags & NO_FINAL_NEWLINE
+
+        f.seek(index_offset)
+        data = f.read(count * INDEX_ENTRY.size)
+        entries = [INDEX_ENTRY.unpack_from(data, i * INDEX_ENTRY.size) for i in xrange(count)]
+
+        # The index doesn't store the line counts, they follow from the next block's first line.
+        self.blocks = []
+        for (i, (lineno, offset)) in enumerate(entries):
+            if i + 1 < count:
+                end = entries[i + 1][0]
+            else:
+                f.seek(offset)
+                end = lineno + BLOCK.unpack(f.read(BLOCK.size))[2]
+            self.blocks.append((lineno, end - lineno, offset))
+        return True
+
+    def _scan_blocks(self):
+        self.final_newline = True
+        f = self._file
+        self.blocks = []
+        offset = HEADER.size
+        while offset + BLOCK.size <= self._size:
+            f.seek(offset)
+            length, lineno, count, _ = BLOCK.unpack(f.read(BLOCK.size))
+            if offset + BLOCK.size + length > self._size:
+                # Cut short while it was being written.
+                break
+            self.blocks.append((lineno, count, offset))
+            offset += BLOCK.size + length
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _read_block(self, offset):
+        '''Get the lines of the block at the given offset.'''
+
+        f = self._file
+        f.seek(offset)
+        length, _, count, raw_length = BLOCK.unpack(f.read(BLOCK.size))
+        raw = zlib.decompress(f.read(length))
+        if len(raw) != raw_length:
+            raise ValueError('%s: corrupt block at offset %i' % (self.path, offset))
+
+        lines = []
+        append = lines.append
+        position = 4 * count
+        for length in struct.unpack_from('!%dI' % count, raw):
+            end = position + length
+            append(raw[position:end])
+            position = end
+        return lines
+
+    def _chunks(self, start=1):
+        '''Iterate over (number of the first line, list of lines), from the block holding start.'''
+
+        for (lineno, count, offset) in self.blocks:
+            if lineno + count <= start:
+                continue
+            lines = self._read_block(offset)
+            if lineno < start:
+                lines = lines[start - lineno:]
+                lineno = start
+            yield (lineno, lines)
+
+    def lines(self, direction=None, events=None, start=1):
+        '''Iterate over (line number, line) of the log, see LogReader.lines.
+
+        Args:
+            direction: '<' or '>' to only get lines received from or sent to icecapd.
+            events: A list of event names, to only get those events.
+            start: Number of the first line to get.
+        '''
+
+        prefixes = None
+        exact = ()
+        if events is not None:
+            prefixes = tuple('<*;%s;' % name for name in events)
+            exact = set('<*;%s' % name for name in events)
+        elif direction is not None:
+            prefixes = direction
+
+        for (lineno, lines) in self._chunks(start):
+            for line in lines:
+                if prefixes is None or line.startswith(prefixes) or (exact and line.rstrip('\r') in exact):
+                    yield (lineno, line.rstrip('\r'))
+                lineno += 1
+
+    def __iter__(self):
+        return (line for (_, line) in self.lines())
+
+    def raw_lines(self, start=1):
+        '''Iterate over the lines exactly as they were written, from the given line on.'''
+
+        for (_, lines) in self._chunks(start):
+            for line in lines:
+                yield line
+
+def convert_log(source, dest, **kwargs):
+    '''Convert a text log to a packed log, or a packed log back to a text log.
+
+    The direction is picked by looking at source. Converting both ways gives back the
+    original text log, byte for byte.
+
+    Args:
+        source: File name of the log to convert.
+        dest: File name of the converted log, replaced if it exists.
+        kwargs: Passed on to PackedLogWriter, when writing a packed log.
+
+    Returns:
+        The number of lines converted.
+    '''
+
+    if is_packed_log(source):
+        with PackedLogReader(source) as reader:
+            with open(dest, 'wb') as f:
+                count = 0
+                for (_, lines) in reader._chunks():
+                    lines.append('')
+                    f.write('\n'.join(lines))
+                    count += len(lines) - 1
+                if count and not reader.final_newline:
+                    f.seek(-1, os.SEEK_END)
+                    f.truncate()
+        return count
+
+    with open(source, 'rb') as f:
+        with PackedLogWriter(dest, **kwargs) as writer:
+            write = writer.write
+            for line in f:
+                if line.endswith('\n'):
+                    write(line[:-1])
+                else:
+                    write(line)
+                    writer.final_newline = False
+            return writer.lineno
@@ -14,11 +14,20 @@
 
 '''A set of classes and functions to parse & generate icecap messages.'''
 
+import re
+
 class InvalidMessageException(Exception):
     '''Attempted to parse an icecap message that was not understood.'''
 
 ESCAPE_LOOKUP = {'.': ';', 'r': "\r", 'n': "\n"}
 
+UNESCAPE_PATTERN = re.compile(r'\\(.?)', re.DOTALL)
+ESCAPE_PATTERN = re.compile(r'[\\;\r\n]')
+
+def _unescape_match(match, lookup=ESCAPE_LOOKUP):
+    c = match.group(1)
+    return lookup.get(c, c)
+
 def unescape(s):
     '''Unescape a icecap protocol message part.
 
@@ -26,20 +35,39 @@ def unescape(s):
     back, typically used after splitting a protocol message into its separate
     parts.'''
 
-    unesc = ''
+    s = str(s)
+    if '\\' not in s:
+        return s
+    return UNESCAPE_PATTERN.sub(_unescape_match, s)
 
-    escape = False
-    for c in str(s):
-        if escape:
-            c = ESCAPE_LOOKUP.get(c, c)
-        else:
-            escape = (c == '\\')
-            if escape:
-                c = ''
+def unescape_params(params):
+    '''Unescape a list of 'key=value' message parts into a dict.
+
+    Parts without a '=' are flags, and get the value True. Empty parts are skipped.
+    This is the bulk version of unescape(), used when parsing a whole message.
+
+    The keys are interned, since the same few keys are used over and over, and end up
+    in the info dicts of the state. Unicode keys (which can't be interned) are kept as
+    they are.
+    '''
 
-        unesc += c
+    result = {}
+    sub = UNESCAPE_PATTERN.sub
+    for param in params:
+        if not param:
+            continue
+
+        key, sep, value = param.partition('=')
+        if key.__class__ is str:
+            key = intern(key)
+        if not sep:
+            result[key] = True
+        elif '\\' in value:
+            result[key] = sub(_unescape_match, value)
+        else:
+            result[key] = value
 
-    return unesc
+    return result
 
 def escape(s):
     '''Escape a icecap protocol message part.
@@ -47,41 +75,61 @@ def escape(s):
     Icecap requires ';' to be escaped as '\\.', and since the protocol is line-
     based, CR & LF are also escaped. For a literal '\\', it's replaced with '\\\\'.
     '''
-    return str(s).replace('\\', '\\\\').replace(';', '\\.').replace('\n', '\\n').replace('\r', '\\r')
+
+    s = str(s)
+    if ESCAPE_PATTERN.search(s) is None:
+        return s
+    return s.replace('\\', '\\\\').replace(';', '\\.').replace('\n', '\\n').replace('\r', '\\r')
 
 class Message(object):
     '''Represent an icecap protocol message (any type).
 
     These are general parts that *all* icecap messages have. Look at Command, Reply 
     and Event for specifics of those messages.
+
+    Messages parsed lazily (the default) only split out the tag and command up front,
+    the params are decoded from the original line the first time they're accessed.
     '''
+
+    __slots__ = ('message', 'command', 'tag', '_params')
+
     def __init__(self):
         '''Create a new, empty message.'''
         self.message = None
         self.command = ''
         self.tag = ''
-        self.params = {}
+        self._params = {}
 
-    def parse(self, message):
-        '''Populate this message with data from the given string.'''
-        parts = message.split(';')
-        if len(parts) < 2:
-            raise InvalidMessageException('Not at least two parts in the message.')
+    def parse(self, message, lazy=True):
+        '''Populate this message with data from the given string.
 
-        params = filter(len, parts[2:])
+        Args:
+            message: The protocol line to parse.
+            lazy: If True, the params are not decoded until they're first accessed.
+        '''
+        tag, sep, rest = message.partition(';')
+        if not sep:
+            raise InvalidMessageException('Not at least two parts in the message.')
 
         self.message = message
-        self.tag, self.command = parts[:2]
-        self.params = {}
+        self.tag = tag
+        self.command = rest.partition(';')[0]
 
-        for param in params:
-            parts = param.split('=', 1)
-            key = parts[0]
+        if lazy:
+            self._params = None
+        else:
+            self._params = unescape_params(message.split(';')[2:])
 
-            if len(parts) > 1:
-                self.params[key] = unescape(parts[1])
-            else:
-                self.params[key] = True
+    @property
+    def params(self):
+        '''Dict of the parameters of this message, decoded on first access.'''
+        if self._params is None:
+            self._params = unescape_params(self.message.split(';')[2:])
+        return self._params
+
+    @params.setter
+    def params(self, params):
+        self._params = params
 
     def __str__(self):
         '''Get a protocol-compliant textual representation of this message.'''
@@ -106,7 +154,9 @@ class Command(Message):
     http://icecap.irssi2.org/IcecapProtocol/Introduction#Commands
     '''
 
-    def __init__(self, message_or_tag, command=None, params=None):
+    __slots__ = ('replies',)
+
+    def __init__(self, message_or_tag, command=None, params=None, lazy=True):
         '''Create a new Command from the given data.
 
         Args:
@@ -114,21 +164,26 @@ class Command(Message):
             command: Defaults to None, which means we treat message_or_tag as a message, otherwise
                 a tag. Defines the name of the command we're sending.
             params: A dict of parameters or None if no params / parse from message.
+            lazy: Only used when parsing, see Message.parse.
         '''
         Message.__init__(self)
 
         self.replies = []
 
         if command is None:
-            self.parse(message_or_tag)
+            self.parse(message_or_tag, lazy)
         else:
             self.tag = message_or_tag
             self.params = params or {}
             self.command = command
 
     def received_reply(self, reply):
-        '''Register a reply received for this specific command.'''
-        self.replies.append(reply)
+        '''Register a reply received for this specific command.
+
+        Replies are only collected if self.replies is a list, set it to None to not keep them.
+        '''
+        if self.replies is not None:
+            self.replies.append(reply)
 
 class Reply(Message):
     '''Represent a reply to a command, sent from the server to the client.
@@ -136,6 +191,8 @@ class Reply(Message):
     http://icecap.irssi2.org/IcecapProtocol/Introduction#Command_replies
     '''
 
+    __slots__ = ()
+
     OK = 0
     FAIL = 1
     MORE = 2
@@ -147,7 +204,7 @@ class Reply(Message):
     }
     STATUS_REVERSE = dict(((v, k) for k, v in STATUS.iteritems()))
 
-    def __init__(self, message_or_tag, status=None, params=None):
+    def __init__(self, message_or_tag, status=None, params=None, lazy=True):
         '''Create a new Reply from the given data.
 
         Args:
@@ -155,11 +212,12 @@ class Reply(Message):
             status: Defaults to None, which means we treat message_or_tag as a message, otherwise
                 a tag. Defines the status code of the reply (see Reply.STATUS's values for valid ones).
             params: A dict of parameters or None if no params / parse from message.
+            lazy: Only used when parsing, see Message.parse.
         '''
         Message.__init__(self)
 
         if status is None:
-            self.parse(message_or_tag)
+            self.parse(message_or_tag, lazy)
             if not self.command in self.STATUS:
                 raise InvalidMessageException("Reply status '%s' is not known" % self.command)
             self.command = self.STATUS[self.command]
@@ -177,17 +235,20 @@ class Event(Message):
     http://icecap.irssi2.org/IcecapProtocol/Introduction#Command_replies
     '''
 
-    def __init__(self, message_or_name, params=None):
+    __slots__ = ()
+
+    def __init__(self, message_or_name, params=None, lazy=True):
         '''Create a new Event from the given data.
 
         Args:
             message_or_name: Either a string (from the network) we parse or the name of the event.
             params: A dict of parameters or None if message_or_name is a message.
+            lazy: Only used when parsing, see Message.parse.
         '''
         Message.__init__(self)
 
         if params is None:
-            self.parse(message_or_name)
+            self.parse(message_or_name, lazy)
         else:
             self.tag = None
             self.command = message_or_name
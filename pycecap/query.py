@@ -0,0 +1,268 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# pycecap
+# Copyright (c) 2009 Jørgen Tjernø <jorgenpt@gmail.com>
+#
+# This package is free software;  you can redistribute it and/or
+# modify it under the terms of the license found in the file
+# named COPYING that should have accompanied this file.
+#
+# THIS PACKAGE IS PROVIDED ``AS IS'' AND WITHOUT ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, WITHOUT LIMITATION, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE.
+
+'''Secondary indexes over the state of a StateKeeper, for fast lookups across connections.'''
+
+import delta
+import state
+
+from fnmatch import fnmatchcase
+
+WILDCARDS = '*?['
+
+def _host(info):
+    # The host part of a presence's address ('user@host'), lowercased, or None.
+    address = info.get('address') if info else None
+    if not address:
+        return None
+    return address.rpartition('@')[2].lower()
+
+def _suffixes(host):
+    # The proper domain suffixes of a host: a.example.org -> example.org, org
+    parts = host.split('.')
+    return ['.'.join(parts[i:]) for i in xrange(1, len(parts))]
+
+def _discard(index, key, entry):
+    # Remove entry from the set index[key], dropping the set when it's empty.
+    entries = index.get(key)
+    if entries is not None:
+        entries.discard(entry)
+        if not entries:
+            del index[key]
+
+class StateIndex(object):
+    '''Indexes of presences by host, by name and by channel mode, over all connections.
+
+    The indexes are kept up to date from the Deltas of the StateKeeper (see subscribe),
+    so every change costs a few dict operations, and queries don't have to look at
+    every presence. Results are (Connection, name, ...) tuples, look them up with
+    StateKeeper.find if you need the state objects.
+    '''
+
+    def __init__(self, keeper):
+        '''Start indexing the given StateKeeper, including the state it already has.'''
+
+        self.keeper = keeper
+        self.rebuild()
+        keeper.subscribe(self._changed)
+
+    def close(self):
+        '''Stop updating the indexes.'''
+        self.keeper.unsubscribe(self._changed)
+
+    def rebuild(self):
+        '''Index the current state of the StateKeeper from scratch.'''
+
+        # Connection -> {presence name: host or None}, for every known presence.
+        self._presences = {}
+        # Presence name -> set of Connections it's known on.
+        self._by_name = {}
+        # Host -> set of (Connection, presence name), and the same by proper domain suffix.
+        self._by_host = {}
+        self._by_suffix = {}
+        # Connection -> {channel name: {presence name: mode}}, for non-empty modes only.
+        self._modes = {}
+        # Mode character -> set of (Connection, channel name, presence name).
+        self._by_mode = {}
+
+        for (connection, local_presence) in self.keeper.local_presences.iteritems():
+            for (name, presence) in local_presence.presences.iteritems():
+                self._add_presence(connection, name, _host(presence._info))
+            for (name, channel) in local_presence.channels.iteritems():
+                for (presence, mode) in channel.presences.iteritems():
+                    self._set_mode(connection, name, presence, mode)
+
+    def presences_by_host(self, pattern):
+        '''Find the presences whose host matches the given pattern.
+
+        Args:
+            pattern: A host name ('host.example.org'), a domain ('*.example.org'), or
+                any other shell-style pattern. Matching is case insensitive.
+
+        Returns:
+            A list of (Connection, presence name).
+        '''
+
+        pattern = pattern.lower()
+        if not any(c in pattern for c in WILDCARDS):
+            return list(self._by_host.get(pattern, ()))
+        if pattern.startswith('*.') and not any(c in pattern[2:] for c in WILDCARDS):
+            return list(self._by_suffix.get(pattern[2:], ()))
+
+        result = []
+        for (host, entries) in self._by_host.iteritems():
+            if fnmatchcase(host, pattern):
+                result.extend(entries)
+        return result
+
+    def presences_named(self, name):
+        '''Find every connection that knows a presence with the given name.
+
+        Returns:
+            A list of (Connection, presence name).
+        '''
+
+        return [(connection, name) for connection in self._by_name.get(name, ())]
+
+    def common_channels(self, presence, other, connection=None):
+        '''Find the channels that two presences are both in.
+
+        Args:
+            presence: Name of a presence.
+            other: Name of another presence.
+            connection: Optional Connection to look on, defaults to all of them.
+
+        Returns:
+            A list of (Connection, channel name).
+        '''
+
+        if connection is not None:
+            connections = [connection]
+        else:
+            connections = self._by_name.get(presence, set()) & self._by_name.get(other, set())
+
+        result = []
+        for connection in connections:
+            local_presence = self.keeper.local_presences.get(connection)
+            if local_presence is None:
+                continue
+            first = local_presence.presences.get(presence)
+            second = local_presence.presences.get(other)
+            if first is not None and second is not None:
+                result.extend((connection, channel) for channel in first.channels & second.channels)
+        return result
+
+    def presences_with_mode(self, mode, connection=None, channel=None):
+        '''Find the presences that have the given mode (e.g. '@') in a channel.
+
+        Args:
+            mode: A single mode character.
+            connection: Optional Connection to limit the search to.
+            channel: Optional channel name to limit the search to (requires connection).
+
+        Returns:
+            A list of (Connection, channel name, presence name).
+        '''
+
+        if connection is not None:
+            channels = self._modes.get(connection, {})
+            if channel is not None:
+                channels = {channel: channels.get(channel, {})}
+            return [(connection, channel_name, presence)
+                    for (channel_name, modes) in channels.iteritems()
+                    for (presence, presence_mode) in modes.iteritems() if mode in presence_mode]
+
+        return list(self._by_mode.get(mode, ()))
+
+    def _add_presence(self, connection, name, host):
+        presences = self._presences.get(connection)
+        if presences is None:
+            presences = self._presences[connection] = {}
+        elif name in presences:
+            self._unindex_host(connection, name, presences[name])
+        presences[name] = host
+
+        self._by_name.setdefault(name, set()).add(connection)
+        if host is not None:
+            entry = (connection, name)
+            self._by_host.setdefault(host, set()).add(entry)
+            for suffix in _suffixes(host):
+                self._by_suffix.setdefault(suffix, set()).add(entry)
+
+    def _remove_presence(self, connection, name):
+        presences = self._presences.get(connection)
+        if presences is None or name not in presences:
+            return
+        self._unindex_host(connection, name, presences.pop(name))
+
+        connections = self._by_name[name]
+        connections.discard(connection)
+        if not connections:
+            del self._by_name[name]
+
+        for channel in self._modes.get(connection, {}).keys():
+            self._set_mode(connection, channel, name, '')
+
+    def _unindex_host(self, connection, name, host):
+        if host is None:
+            return
+        entry = (connection, name)
+        _discard(self._by_host, host, entry)
+        for suffix in _suffixes(host):
+            _discard(self._by_suffix, suffix, entry)
+
+    def _set_mode(self, connection, channel, presence, mode):
+        channels = self._modes.get(connection)
+        modes = channels.get(channel) if channels is not None else None
+        old_mode = modes.get(presence, '') if modes is not None else ''
+        if mode == old_mode:
+            return
+
+        for char in old_mode:
+            _discard(self._by_mode, char, (connection, channel, presence))
+        for char in mode:
+            self._by_mode.setdefault(char, set()).add((connection, channel, presence))
+
+        if mode:
+            if modes is None:
+                modes = self._modes.setdefault(connection, {}).setdefault(channel, {})
+            modes[presence] = mode
+        else:
+            del modes[presence]
+            if not modes:
+                del channels[channel]
+                if not channels:
+                    del self._modes[connection]
+
+    def _remove_connection(self, connection):
+        for name in self._presences.get(connection, {}).keys():
+            self._remove_presence(connection, name)
+        self._presences.pop(connection, None)
+
+    def _changed(self, change):
+        kind, entity, network, mypresence, name, data = change
+
+        if kind == delta.RESET:
+            self.rebuild()
+        elif entity == delta.PRESENCE:
+            connection = state.Connection(network, mypresence)
+            if kind == delta.ADDED or kind == delta.CHANGED:
+                self._add_presence(connection, name, _host(data))
+            elif kind == delta.REMOVED:
+                self._remove_presence(connection, name)
+            elif kind == delta.RENAMED:
+                host = self._presences.get(connection, {}).get(name)
+                modes = [(channel, channel_modes[name])
+                         for (channel, channel_modes) in self._modes.get(connection, {}).iteritems()
+                         if name in channel_modes]
+                self._remove_presence(connection, name)
+                self._add_presence(connection, data, host)
+                for (channel, mode) in modes:
+                    self._set_mode(connection, channel, data, mode)
+        elif entity == delta.CHANNEL:
+            connection = state.Connection(network, mypresence)
+            if kind == delta.JOINED:
+                self._set_mode(connection, name, data[0], data[1])
+            elif kind == delta.PARTED:
+                self._set_mode(connection, name, data, '')
+            elif kind == delta.REMOVED:
+                for presence in self._modes.get(connection, {}).get(name, {}).keys():
+                    self._set_mode(connection, name, presence, '')
+        elif entity == delta.LOCAL_PRESENCE:
+            if kind == delta.REMOVED:
+                self._remove_connection(state.Connection(network, mypresence))
+        elif entity == delta.NETWORK and kind == delta.REMOVED:
+            for connection in self._presences.keys():
+                if connection[0] == network:
+                    self._remove_connection(connection)
@@ -0,0 +1,303 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# pycecap
+# Copyright (c) 2009 Jørgen Tjernø <jorgenpt@gmail.com>
+#
+# This package is free software;  you can redistribute it and/or
+# modify it under the terms of the license found in the file
+# named COPYING that should have accompanied this file.
+#
+# THIS PACKAGE IS PROVIDED ``AS IS'' AND WITHOUT ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, WITHOUT LIMITATION, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE.
+
+'''Replay traffic logs (as written by test.py) into a StateKeeper.
+
+A traffic log has one protocol line per line, prefixed with '<' for lines received from
+icecapd and '>' for commands sent to it. It's either a plain text file, or a packed log
+with the same lines (see packedlog.py).
+
+Replayer can keep state checkpoints in a sidecar file next to the log (<log>.ckpt), so
+getting the state at a given line only replays the lines after the nearest checkpoint.
+'''
+
+import os
+import struct
+import time
+import zlib
+
+from packedlog import PackedLogReader, is_packed_log
+from protocol import Command
+from statekeeper import StateKeeper
+import snapshot
+
+def replay_line(keeper, line):
+    '''Replay a single (newline-stripped) line of a traffic log into the given StateKeeper.'''
+
+    dir, message = line[:1], line[1:]
+    if not message:
+        return
+
+    if dir == '<':
+        keeper.parse(message)
+    else:
+        command = Command(message)
+        keeper._next_tag = int(command.tag)
+        keeper.presend(command)
+
+class CheckpointIndex(object):
+    '''The checkpoints of a traffic log, stored in a sidecar file.
+
+    The file starts with a header (magic string & version), followed by a record per
+    checkpoint: the line number, the byte offset of the line following it (always 0 for
+    packed logs, which are indexed by line number), a CRC32 of the log up to that line
+    and the length of the snapshot, followed by the snapshot itself (see snapshot.py).
+    The checkpoint for line N holds the state after replaying lines 1 through N.
+
+    The CRC is taken over the text of the log (every line followed by a newline, for
+    packed logs too), so the log it was made from can be told from one that was replaced
+    or rewritten. It's up to the user of the index to check it, see Replayer.
+    '''
+
+    MAGIC = 'PYCECAPI'
+    VERSION = 2
+    HEADER = struct.Struct('!8sB')
+    RECORD = struct.Struct('!QQII')
+
+    def __init__(self, path):
+        self.path = path
+        # Sorted list of (lineno, offset, crc, position of the snapshot in the sidecar file, length)
+        self.checkpoints = []
+
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as f:
+            header = f.read(self.HEADER.size)
+            if len(header) == self.HEADER.size and self.HEADER.unpack(header) == (self.MAGIC, self.VERSION):
+                while True:
+                    record = f.read(self.RECORD.size)
+                    if len(record) < self.RECORD.size:
+                        break
+
+                    lineno, offset, crc, length = self.RECORD.unpack(record)
+                    position = f.tell()
+                    f.seek(length, os.SEEK_CUR)
+                    if f.tell() > size:
+                        break
+                    self.checkpoints.append((lineno, offset, crc, position, length))
+                return
+
+        # Unknown or broken index (e.g. an older version), start over. It's removed
+        # right away, so new checkpoints aren't appended to it.
+        self.clear()
+
+    def nearest(self, lineno):
+        '''Get the last checkpoint at or before the given line, or None.'''
+
+        best = None
+        for checkpoint in self.checkpoints:
+            if checkpoint[0] > lineno:
+                break
+            best = checkpoint
+        return best
+
+    @property
+    def last_lineno(self):
+        if self.checkpoints:
+            return self.checkpoints[-1][0]
+        return 0
+
+    def load(self, checkpoint, keeper):
+        '''Restore the state of the given checkpoint into keeper.'''
+
+        _, _, _, position, length = checkpoint
+        with open(self.path, 'rb') as f:
+            f.seek(position)
+            snapshot.loads(keeper, f.read(length))
+
+    def add(self, lineno, offset, crc, keeper):
+        '''Append a checkpoint of keeper's state after the given line.'''
+
+        data = snapshot.dumps(keeper)
+        with open(self.path, 'ab') as f:
+            if f.tell() == 0:
+                f.write(self.HEADER.pack(self.MAGIC, self.VERSION))
+            f.write(self.RECORD.pack(lineno, offset, crc, len(data)))
+            position = f.tell()
+            f.write(data)
+        self.checkpoints.append((lineno, offset, crc, position, len(data)))
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.checkpoints = []
+
+class Replayer(object):
+    '''Replays a traffic log file, writing and using checkpoints.
+
+    Checkpoints are only used after checking them against the log (see CheckpointIndex),
+    which means reading the log up to the checkpoint once, and the whole index is thrown
+    away if they don't match, e.g. because the log was replaced.
+
+    Attributes:
+        lineno: The last line replayed (e.g. the one that crashed, if replay raised).
+        lines: The number of lines replayed by the last call to replay().
+        elapsed: The time spent by the last call to replay(), in seconds.
+    '''
+
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(self, path, keeper_factory=StateKeeper, interval=100000, index_path=None):
+        '''Create a new replayer.
+
+        Args:
+            path: Name of the traffic log.
+            keeper_factory: Function returning a new, empty StateKeeper to replay into.
+            interval: Number of lines between checkpoints, or None to not write any.
+            index_path: Name of the sidecar checkpoint file, defaults to <path>.ckpt.
+        '''
+
+        self.path = path
+        self.keeper_factory = keeper_factory
+        self.interval = interval
+        self.index = CheckpointIndex(index_path or path + '.ckpt')
+
+        self.lineno = 0
+        self.lines = 0
+        self.elapsed = 0.0
+
+    def replay(self, until=None, use_checkpoints=True):
+        '''Get the state after the given line (or the whole log).
+
+        Args:
+            until: Line number to stop after, or None to replay the whole log.
+            use_checkpoints: If False, replay from the start of the log.
+
+        Returns:
+            A StateKeeper (from keeper_factory) with the state after the given line.
+        '''
+
+        keeper = self.keeper_factory()
+        index = self.index
+        self._packed = is_packed_log(self.path)
+
+        if index.checkpoints and self._past_end(index.checkpoints[-1]):
+            index.clear()
+
+        # The last point (line number, offset, CRC) known to match the index.
+        verified = (0, 0, 0)
+        if use_checkpoints:
+            checkpoint = index.nearest(until if until is not None else float('inf'))
+            if checkpoint is not None:
+                if self._checksums(verified, [checkpoint[:2]]) == [checkpoint[2]]:
+                    index.load(checkpoint, keeper)
+                    verified = checkpoint[:3]
+                else:
+                    index.clear()
+        lineno, offset = verified[:2]
+
+        start, first_lineno = time.time(), lineno
+        self.lineno = lineno
+        lines = self._lines(lineno, offset)
+        try:
+            for (lineno, offset, line) in lines:
+                if until is not None and lineno > until:
+                    break
+                self.lineno = lineno
+
+                replay_line(keeper, line.rstrip('\n\r'))
+
+                # Only checkpoint between commands, since the partial replies of
+                # multi-line replies aren't part of snapshots.
+                if (self.interval and lineno >= index.last_lineno + self.interval
+                        and not keeper._staging):
+                    verified = self._add_checkpoint(verified, lineno, offset, keeper)
+        finally:
+            lines.close()
+            self.elapsed = time.time() - start
+            self.lines = self.lineno - first_lineno
+
+        keeper.flush_deltas()
+        return keeper
+
+    def _add_checkpoint(self, verified, lineno, offset, keeper):
+        # The checkpoints replayed past since the last verified point get checked on the way.
+        index = self.index
+        unverified = [checkpoint for checkpoint in index.checkpoints if checkpoint[0] > verified[0]]
+        crcs = self._checksums(verified, [checkpoint[:2] for checkpoint in unverified] + [(lineno, offset)])
+        if crcs[:-1] != [checkpoint[2] for checkpoint in unverified]:
+            index.clear()
+
+        index.add(lineno, offset, crcs[-1], keeper)
+        return (lineno, offset, crcs[-1])
+
+    def _past_end(self, checkpoint):
+        # Whether the checkpoint is further into the log than the log goes.
+        if self._packed:
+            with PackedLogReader(self.path) as reader:
+                return checkpoint[0] > reader.line_count
+        return checkpoint[1] > os.path.getsize(self.path)
+
+    def _checksums(self, start, points):
+        '''Get the CRCs of the log at the given points, see CheckpointIndex.
+
+        Args:
+            start: (line number, offset, CRC) to continue from.
+            points: Sorted list of (line number, offset).
+
+        Returns:
+            A list with a CRC for each point, or None for points past the end of the log.
+        '''
+
+        lineno, offset, crc = start
+        result = []
+
+        if self._packed:
+            with PackedLogReader(self.path) as reader:
+                lines = reader.raw_lines(lineno + 1)
+                for (target, _) in points:
+                    if lineno < target:
+                        for line in lines:
+                            crc = zlib.crc32('\n', zlib.crc32(line, crc))
+                            lineno += 1
+                            if lineno >= target:
+                                break
+                    result.append(crc & 0xffffffff if lineno >= target else None)
+            return result
+
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            for (_, target) in points:
+                while offset < target:
+                    data = f.read(min(target - offset, self.CHUNK_SIZE))
+                    if not data:
+                        break
+                    crc = zlib.crc32(data, crc)
+                    offset += len(data)
+                result.append(crc & 0xffffffff if offset >= target else None)
+        return result
+
+    def _lines(self, lineno, offset):
+        # Iterate over (line number, offset of the next line, line) after the given line.
+        if self._packed:
+            with PackedLogReader(self.path) as reader:
+                for line in reader.raw_lines(lineno + 1):
+                    lineno += 1
+                    yield (lineno, 0, line)
+            return
+
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                lineno += 1
+                offset += len(line)
+                yield (lineno, offset, line)
+
+    @property
+    def throughput(self):
+        '''Lines per second replayed by the last call to replay().'''
+        return self.lines / self.elapsed if self.elapsed else 0.0
@@ -0,0 +1,375 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# pycecap
+# Copyright (c) 2009 Jørgen Tjernø <jorgenpt@gmail.com>
+#
+# This package is free software;  you can redistribute it and/or
+# modify it under the terms of the license found in the file
+# named COPYING that should have accompanied this file.
+#
+# THIS PACKAGE IS PROVIDED ``AS IS'' AND WITHOUT ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, WITHOUT LIMITATION, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE.
+
+'''Spread many icecapd sessions over worker processes, with a merged view of their state.
+
+Every worker process owns the IcecapClients of its sessions, and does all the parsing.
+It sends the changes to the state (see delta.py) to the supervisor over a socket, as
+length-prefixed marshal frames, and the supervisor applies them to a mirror StateKeeper
+per session. Messages without state changes (the bulk of the traffic) never leave the worker.
+'''
+
+from client import IcecapClient, READ_SIZE, run_clients
+from history import NoHistory
+from statekeeper import StateKeeper
+import delta
+import snapshot
+import state
+
+from multiprocessing import Process, cpu_count
+import errno
+import marshal
+import socket
+import struct
+
+FRAME = struct.Struct('!I')
+
+# Worker -> supervisor: (_DELTAS, session, [delta tuple, ...]), (_SNAPSHOT, session, snapshot
+# data) and (_CLOSED, session, reason). Supervisor -> worker: (_SEND, session, command, params)
+# and (_STOP,).
+_DELTAS, _SNAPSHOT, _CLOSED, _SEND, _STOP = range(5)
+
+# The IcecapClient constructors a session can be described with.
+CONNECTORS = ('spawn', 'connect_unix', 'connect_tcp')
+
+class _Link(object):
+    '''One end of the socket between the supervisor and a worker.
+
+    This has the same interface as an IcecapClient as far as run_clients() is concerned,
+    so it can be driven from the same select() loop as the clients.
+    '''
+
+    def __init__(self, sock, handler):
+        self._sock = sock
+        self._sock.setblocking(False)
+        self._handler = handler
+        self._inbound = bytearray()
+        self._outbound = bytearray()
+        self.closed = False
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def write_fileno(self):
+        return self._sock.fileno()
+
+    def send(self, message):
+        if not self.closed:
+            data = marshal.dumps(message)
+            self._outbound += FRAME.pack(len(data))
+            self._outbound += data
+
+    def wants_write(self):
+        return bool(self._outbound) and not self.closed
+
+    def handle_read(self):
+        try:
+            data = self._sock.recv(READ_SIZE)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ''
+
+        if not data:
+            self.close()
+            return
+
+        buf = self._inbound
+        buf += data
+        start = 0
+        while len(buf) - start >= FRAME.size:
+            (length,) = FRAME.unpack_from(buf, start)
+            end = start + FRAME.size + length
+            if len(buf) < end:
+                break
+            self._handler(marshal.loads(str(buf[start + FRAME.size:end])))
+            start = end
+        del buf[:start]
+
+    def handle_write(self):
+        try:
+            written = self._sock.send(self._outbound)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            self.close()
+            return
+        del self._outbound[:written]
+
+    def flush(self):
+        '''Block until everything queued with send() has been written.'''
+
+        if self._outbound and not self.closed:
+            self._sock.setblocking(True)
+            try:
+                self._sock.sendall(self._outbound)
+            except socket.error:
+                pass
+            del self._outbound[:]
+
+    def expire(self, now=None):
+        return 0
+
+    def next_deadline(self):
+        return None
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._sock.close()
+
+class _Worker(object):
+    '''The worker process side: drives the clients of a shard, and reports their changes.'''
+
+    def __init__(self, sock, sessions, options):
+        self.link = _Link(sock, self._received)
+        self.clients = {}
+        self.stopping = False
+
+        # Deltas not yet sent to the supervisor, by session.
+        self._deltas = {}
+
+        for (session, connector) in sessions:
+            try:
+                client = getattr(IcecapClient, connector[0])(*connector[1:], **options)
+            except EnvironmentError, e:
+                self.link.send((_CLOSED, session, str(e)))
+                continue
+
+            self.clients[session] = client
+            self._deltas[session] = []
+            client.subscribe(self._subscriber(session, client))
+
+    def _subscriber(self, session, client):
+        deltas = self._deltas[session]
+        def changed(change):
+            if change[0] == delta.RESET:
+                # The state was replaced wholesale, ship all of it instead.
+                del deltas[:]
+                self.link.send((_SNAPSHOT, session, snapshot.dumps(client)))
+            else:
+                deltas.append(tuple(change))
+        return changed
+
+    def _received(self, message):
+        if message[0] == _SEND:
+            client = self.clients.get(message[1])
+            if client is not None and not client.closed:
+                client.send(message[2], message[3])
+        elif message[0] == _STOP:
+            self.stopping = True
+
+    def _flush(self):
+        # Called by run_clients after every round of reads: send on what they changed.
+        for (session, deltas) in self._deltas.iteritems():
+            if deltas:
+                self.link.send((_DELTAS, session, deltas[:]))
+                del deltas[:]
+
+        for (session, client) in self.clients.items():
+            if client.closed:
+                self.link.send((_CLOSED, session, None))
+                del self.clients[session]
+
+        return self.stopping or self.link.closed or not self.clients
+
+    def run(self):
+        try:
+            run_clients([self.link] + self.clients.values(), until=self._flush)
+        finally:
+            for client in self.clients.itervalues():
+                client.close()
+            self._flush()
+            self.link.flush()
+            self.link.close()
+
+def _worker_main(sock, inherited, sessions, options):
+    # Don't hold on to the supervisor's ends of the other workers' sockets, or they won't
+    # notice when the supervisor goes away.
+    for other in inherited:
+        other.close()
+    _Worker(sock, sessions, options).run()
+
+class ShardView(object):
+    '''A read-only view of the state of all sessions of a Supervisor.
+
+    Attributes:
+        sessions: Dict of session name to a StateKeeper mirroring the state of that session.
+        networks: Dict of network name to Network, merged over all sessions.
+        local_presences: LocalPresenceMap of Connection to LocalPresence, merged over all
+            sessions. If several sessions know the same network or connection, the one
+            that comes first in sorted session order is shown.
+        closed: Dict of session name to the reason (or None) for sessions that have ended.
+
+    Nothing here should be modified, changes are not sent back to the sessions.
+    '''
+
+    def __init__(self, sessions):
+        self.sessions = {}
+        self._order = sorted(sessions)
+        for session in self._order:
+            mirror = self.sessions[session] = StateKeeper(history=NoHistory())
+            mirror.subscribe(self._merge)
+
+        self.networks = {}
+        self.local_presences = state.LocalPresenceMap()
+        self.closed = {}
+
+    def find(self, network, mypresence, channel=None, presence=None):
+        '''Look up a LocalPresence, Channel or Presence by name, see StateKeeper.find.'''
+
+        for session in self._order:
+            found = self.sessions[session].find(network, mypresence, channel, presence)
+            if found is not None:
+                return found
+        return None
+
+    def received(self, message):
+        '''Apply a message from a worker.'''
+
+        kind, session = message[0], message[1]
+        mirror = self.sessions[session]
+        if kind == _DELTAS:
+            apply_delta = mirror.apply_delta
+            for change in message[2]:
+                apply_delta(change)
+        elif kind == _SNAPSHOT:
+            snapshot.loads(mirror, message[2])
+            mirror._emit(delta.RESET, None)
+        elif kind == _CLOSED:
+            self.closed[session] = message[2]
+
+    def _merge(self, change):
+        # Keep the merged networks / local_presences in sync with the mirrors. Only changes to
+        # whole networks and local presences matter here, everything else is shared.
+        kind, entity, network, mypresence = change[:4]
+        if kind == delta.RESET:
+            self.networks.clear()
+            self.local_presences.clear()
+            for session in reversed(self._order):
+                mirror = self.sessions[session]
+                self.networks.update(mirror.networks)
+                self.local_presences.update(mirror.local_presences)
+        elif entity == delta.NETWORK:
+            self._merge_network(network)
+            if kind == delta.REMOVED:
+                for local_presence in self.local_presences.on_network(network).values():
+                    self._merge_local_presence(*local_presence.connection)
+        elif entity == delta.LOCAL_PRESENCE:
+            self._merge_local_presence(network, mypresence)
+
+    def _merge_network(self, network):
+        for session in self._order:
+            network_obj = self.sessions[session].networks.get(network)
+            if network_obj is not None:
+                self.networks[network] = network_obj
+                return
+        self.networks.pop(network, None)
+
+    def _merge_local_presence(self, network, mypresence):
+        connection = state.Connection(network, mypresence)
+        for session in self._order:
+            local_presence = self.sessions[session].local_presences.lookup(network, mypresence)
+            if local_presence is not None:
+                self.local_presences[connection] = local_presence
+                return
+        self.local_presences.pop(connection, None)
+
+class Supervisor(object):
+    '''Run many icecapd sessions, spread over a number of worker processes.
+
+    Each session is described by the IcecapClient constructor to use, and its arguments:
+    ('spawn', argv), ('connect_unix', path) or ('connect_tcp', host, port). The sessions
+    are parsed in the workers, and view (a ShardView) is kept up to date as the changes
+    arrive. Drive the supervisor with run(), or pass links to run_clients() together
+    with your own clients.
+    '''
+
+    def __init__(self, sessions, workers=None, **kwargs):
+        '''Create a supervisor for the given sessions. Call start() to start the workers.
+
+        Args:
+            sessions: Dict of session name (a string or number) to connector tuple.
+            workers: Number of worker processes, defaults to the number of CPUs.
+            kwargs: Passed on to the IcecapClients (and StateKeepers) in the workers.
+        '''
+
+        for (session, connector) in sessions.iteritems():
+            if not connector or connector[0] not in CONNECTORS:
+                raise ValueError('Session %r: unknown connector %r' % (session, connector))
+
+        if workers is None:
+            workers = cpu_count()
+        workers = max(1, min(workers, len(sessions)))
+
+        # Round-robin the sessions over the workers.
+        self.shards = [[] for _ in xrange(workers)]
+        for (index, session) in enumerate(sorted(sessions)):
+            self.shards[index % workers].append((session, sessions[session]))
+
+        self.options = kwargs
+        self.view = ShardView(sessions.keys())
+        self.links = []
+        self.processes = []
+        self._session_link = {}
+
+    def start(self):
+        '''Start the worker processes.'''
+
+        socks = []
+        for shard in self.shards:
+            parent_sock, child_sock = socket.socketpair()
+            process = Process(target=_worker_main, args=(child_sock, socks + [parent_sock], shard, self.options))
+            process.daemon = True
+            process.start()
+            child_sock.close()
+
+            socks.append(parent_sock)
+            link = _Link(parent_sock, self.view.received)
+            self.links.append(link)
+            self.processes.append(process)
+            for (session, _) in shard:
+                self._session_link[session] = link
+
+    def send(self, session, command, params=None):
+        '''Send a command to icecapd in the given session.
+
+        The replies are not passed back, but the changes they cause show up in view.
+
+        Args:
+            session: Name of the session.
+            command: Name of the command.
+            params: Optional dict of parameters to the command.
+        '''
+
+        self._session_link[session].send((_SEND, session, command, params))
+
+    def run(self, until=None, timeout=None):
+        '''Receive changes from the workers, see run_clients for the arguments.'''
+
+        run_clients(self.links, until, timeout)
+
+    def stop(self, timeout=None):
+        '''Stop the workers, applying any changes they send on the way out.'''
+
+        for link in self.links:
+            link.send((_STOP,))
+        run_clients(self.links, timeout=timeout)
+
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        for link in self.links:
+            link.close()
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# pycecap
+# Copyright (c) 2009 Jørgen Tjernø <jorgenpt@gmail.com>
+#
+# This package is free software;  you can redistribute it and/or
+# modify it under the terms of the license found in the file
+# named COPYING that should have accompanied this file.
+#
+# THIS PACKAGE IS PROVIDED ``AS IS'' AND WITHOUT ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, WITHOUT LIMITATION, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE.
+
+'''Serialize the state of a StateKeeper to a compact binary snapshot, and back.
+
+A snapshot is the magic string 'PYCECAP', a version byte, and the zlib compressed,
+marshalled state as plain tuples, lists, dicts and strings.
+'''
+
+from collections import deque
+import gc
+import marshal
+import struct
+import zlib
+
+from protocol import Command
+from stateful_protocol import StatefulMessage
+import state
+
+MAGIC = 'PYCECAP'
+VERSION = 2
+HEADER = struct.Struct('!7sB')
+
+class InvalidSnapshotException(Exception):
+    '''Attempted to load data that isn't a snapshot of a version we understand.'''
+
+def dumps(keeper, level=1):
+    '''Get a snapshot of the state of the given StateKeeper as a string.
+
+    This includes the networks, local presences (with their channels and presences),
+    the next tag, the commands pending a reply and the commands queued by presend_many().
+    Commands in the middle of a multi-line reply are left out, since their partial replies
+    are not part of the snapshot.
+
+    Args:
+        keeper: The StateKeeper to snapshot.
+        level: zlib compression level.
+    '''
+
+    networks = [(network.network, network.info, network.gateways)
+                for network in keeper.networks.itervalues()]
+
+    local_presences = []
+    for local_presence in keeper.local_presences.itervalues():
+        channels = [(channel.name, channel._info, channel.presences)
+                    for channel in local_presence.channels.itervalues()]
+        presences = [(presence.name, presence._info, presence.channels)
+                     for presence in local_presence.presences.itervalues()]
+        local_presences.append((local_presence.connection.network, local_presence.connection.mypresence,
+                                local_presence.info, channels, presences))
+
+    deadlines = dict((tag, deadline) for (deadline, tag, _) in keeper._deadlines)
+    pending = [(tag, str(command), command.replies is not None, deadlines.get(tag))
+               for (tag, command) in keeper._pending_commands.iteritems()
+               if tag not in keeper._staging]
+
+    # The queued commands already have their tags, so they have to be kept along with _next_tag.
+    queued = [(str(command), command.replies is not None, timeout) for (command, timeout) in keeper._queued]
+
+    data = (keeper._next_tag, networks, local_presences, pending, queued)
+    return HEADER.pack(MAGIC, VERSION) + zlib.compress(marshal.dumps(data, 2), level)
+
+def loads(keeper, data):
+    '''Replace the state of the given StateKeeper with the one in the snapshot string.'''
+
+    if len(data) < HEADER.size:
+        raise InvalidSnapshotException('Snapshot is truncated.')
+
+    magic, version = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise InvalidSnapshotException('Not a pycecap snapshot.')
+    # Version 1 snapshots are the same, without the queued commands.
+    if version not in (1, VERSION):
+        raise InvalidSnapshotException('Snapshot version %i is not supported.' % version)
+
+    # We create lots of objects here, and none of them are garbage - don't let the
+    # cyclic GC walk them over and over.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        _load(keeper, marshal.loads(zlib.decompress(data[HEADER.size:])))
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def _load(keeper, data):
+    if len(data) == 4:
+        data += ([],)
+    next_tag, networks, local_presences, pending, queued = data
+
+    # The names in the state were interned when the snapshot was taken, so marshal has
+    # restored them as shared strings. Register them with the keeper's intern table.
+    name = keeper.intern
+
+    keeper.networks = {}
+    for (network_name, info, gateways) in networks:
+        network = keeper.networks[name(network_name)] = state.Network(name(network_name), info)
+        network.gateways = gateways
+
+    keeper.local_presences = state.LocalPresenceMap()
+    Channel, Presence = state.Channel, state.Presence
+    for (network, mypresence, info, channels, presences) in local_presences:
+        connection = state.Connection(name(network), name(mypresence))
+        local_presence = keeper.local_presences[connection] = state.LocalPresence(connection, info)
+
+        channel_objs = local_presence.channels
+        for (channel_name, info, channel_presences) in channels:
+            channel = channel_objs[channel_name] = Channel(local_presence, name(channel_name), info)
+            channel.presences = channel_presences
+
+        presence_objs = local_presence.presences
+        for (presence_name, info, presence_channels) in presences:
+            presence = presence_objs[presence_name] = Presence(local_presence, name(presence_name), info)
+            presence.channels = presence_channels
+
+    keeper._next_tag = next_tag
+    keeper._pending_commands = {}
+    keeper._staging = {}
+    keeper._deadlines = []
+    for (tag, message, keep_replies, deadline) in pending:
+        command = StatefulMessage(keeper, Command(message))
+        keeper._pending_commands[tag] = command
+        command.replies = [] if keep_replies else None
+        if deadline is not None:
+            keeper._deadlines.append((deadline, tag, command))
+    keeper._deadlines.sort()
+
+    keeper._queued = deque()
+    for (message, keep_replies, timeout) in queued:
+        command = StatefulMessage(keeper, Command(message))
+        command.replies = [] if keep_replies else None
+        keeper._queued.append((command, timeout))
+
+def dump(keeper, f, level=1):
+    '''Write a snapshot of the given StateKeeper to a file (object or name).'''
+
+    data = dumps(keeper, level)
+    if isinstance(f, basestring):
+        with open(f, 'wb') as f:
+            f.write(data)
+    else:
+        f.write(data)
+
+def load(keeper, f):
+    '''Replace the state of the given StateKeeper with the snapshot in a file (object or name).'''
+
+    if isinstance(f, basestring):
+        with open(f, 'rb') as f:
+            data = f.read()
+    else:
+        data = f.read()
+    loads(keeper, data)
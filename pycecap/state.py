@@ -14,11 +14,14 @@
 
 '''A set of classes to represent the state of an icecap session.'''
 
+from operator import itemgetter
 import weakref
 
 class Network(object):
     '''This is just a name and a set of gateways to connect to that network.'''
 
+    __slots__ = ('network', 'info', 'gateways')
+
     def __init__(self, network, info, old_me=None):
         '''Create a new network.
 
@@ -39,13 +42,16 @@ class Network(object):
     def __repr__(self):
         return 'Network(%r, %r, <gateways=%r>)' % (self.network, self.info, self.gateways)
 
-class Connection(object):
+class Connection(tuple):
     '''This is a (unique) mypresence/network name pair (identifier) representing a connection to a service (e.g. IRC).
     
-    This is similar to a two-tuple - it hashes and compares properly, so it can be used as a hash key or in a set.
+    This is a two-tuple of (network, mypresence) with named accessors - it hashes and compares
+    properly, so it can be used as a hash key or in a set.
     '''
 
-    def __init__(self, network_or_dict, mypresence=None):
+    __slots__ = ()
+
+    def __new__(cls, network_or_dict, mypresence=None):
         '''Create a new connection identifier.
 
         Args:
@@ -55,26 +61,113 @@ class Connection(object):
         '''
 
         if mypresence is None:
-            self.network = network_or_dict['network']
-            self.mypresence = network_or_dict['mypresence']
+            return tuple.__new__(cls, (network_or_dict['network'], network_or_dict['mypresence']))
         else:
-            self.network = network_or_dict
-            self.mypresence = mypresence
+            return tuple.__new__(cls, (network_or_dict, mypresence))
+
+    network = property(itemgetter(0))
+    mypresence = property(itemgetter(1))
+
+    def __getnewargs__(self):
+        return tuple(self)
+
+    def __repr__(self):
+        return 'Connection(%r, %r)' % self
+
+class LocalPresenceMap(dict):
+    '''A dict of Connection to LocalPresence, indexed by network and mypresence name.
+
+    This behaves like a plain dict keyed by Connection, but also keeps a nested
+    network -> mypresence -> LocalPresence index up to date, so that a LocalPresence
+    can be looked up straight from the network/mypresence strings in a message without
+    building a Connection, and all connections on a network can be found without a scan.
+    '''
+
+    __slots__ = ('networks',)
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self.networks = {}
+        self.update(*args, **kwargs)
+
+    def lookup(self, network, mypresence):
+        '''Get the LocalPresence for the given network and mypresence names, or None.'''
+
+        local_presences = self.networks.get(network)
+        if local_presences is None:
+            return None
+        return local_presences.get(mypresence)
+
+    def on_network(self, network):
+        '''Get a dict of mypresence name to LocalPresence for every connection to a network.
 
-    def __hash__(self):
-        return hash((self.network, self.mypresence))
+        The returned dict is the index itself, and must not be modified.
+        '''
+
+        return self.networks.get(network, {})
 
-    def __cmp__(self, other):
-        if type(self) != type(other):
-            return cmp(type(self), type(other))
-        return cmp((self.network, self.mypresence), (self.network, other.mypresence))
+    def remove_network(self, network):
+        '''Remove all connections to the given network.
+
+        Returns:
+            A list of the removed LocalPresences.
+        '''
+
+        local_presences = self.networks.pop(network, None)
+        if local_presences is None:
+            return []
+        for local_presence in local_presences.itervalues():
+            dict.__delitem__(self, local_presence.connection)
+        return local_presences.values()
+
+    def __setitem__(self, connection, local_presence):
+        dict.__setitem__(self, connection, local_presence)
+        self.networks.setdefault(connection[0], {})[connection[1]] = local_presence
+
+    def __delitem__(self, connection):
+        dict.__delitem__(self, connection)
+        self._unindex(connection)
+
+    def _unindex(self, connection):
+        local_presences = self.networks[connection[0]]
+        del local_presences[connection[1]]
+        if not local_presences:
+            del self.networks[connection[0]]
+
+    def pop(self, connection, *default):
+        if connection in self:
+            self._unindex(connection)
+        return dict.pop(self, connection, *default)
+
+    def popitem(self):
+        item = dict.popitem(self)
+        self._unindex(item[0])
+        return item
+
+    def setdefault(self, connection, default=None):
+        if connection not in self:
+            self[connection] = default
+        return self[connection]
+
+    def update(self, *args, **kwargs):
+        for (connection, local_presence) in dict(*args, **kwargs).iteritems():
+            self[connection] = local_presence
+
+    def clear(self):
+        dict.clear(self)
+        self.networks.clear()
+
+    def copy(self):
+        return LocalPresenceMap(self)
 
     def __repr__(self):
-        return 'Connection(%r, %r)' % (self.network, self.mypresence)
+        return 'LocalPresenceMap(%s)' % dict.__repr__(self)
 
 class LocalPresence(object):
     '''This is all the information associated with a Connection.'''
 
+    __slots__ = ('connection', 'info', 'channels', 'presences', '__weakref__')
+
     def __init__(self, connection, info, old_me=None):
         '''Create a new local presence.
 
@@ -107,7 +200,7 @@ class LocalPresence(object):
         '''
 
         if channel not in self.channels:
-            self.channels[channel] = Channel(self, channel, {})
+            self.channels[channel] = Channel(self, channel, None)
         return self.channels[channel]
 
     def get_presence(self, presence):
@@ -122,7 +215,7 @@ class LocalPresence(object):
         '''
 
         if presence not in self.presences:
-            self.presences[presence] = Presence(self, presence, {})
+            self.presences[presence] = Presence(self, presence, None)
         return self.presences[presence]
 
     def __repr__(self):
@@ -134,20 +227,36 @@ class LocalPresenceObject(object):
     LocalPresenceObject is the parent class for classes that represent information
     that's associated with one (and only one) LocalPresence (Connection). It takes
     care of knowing which LocalPresence that is, and reparenting if needed.
+
+    There can be a lot of these in a large session, so the info dict is not allocated
+    until it's first accessed.
     '''
 
+    __slots__ = ('local_presence', 'name', '_info')
+
     def __init__(self, local_presence, name, info):
         '''Create a new local presence info blob.
 
         Args:
             local_presence: The LocalPresence we belong to.
             name: The name of this info blob.
-            info: Dict of arbitrary information about the network (from e.g. a 'presence list' reply)
+            info: Dict of arbitrary information about the network (from e.g. a 'presence list' reply),
+                or None for an empty one.
         '''
 
         self.local_presence = weakref.ref(local_presence)
         self.name = name
-        self.info = info
+        self._info = info
+
+    @property
+    def info(self):
+        if self._info is None:
+            self._info = {}
+        return self._info
+
+    @info.setter
+    def info(self, info):
+        self._info = info
 
     def reparent(self, new_lp):
         '''Reparent this info blob to belong to a different LocalPresence object.'''
@@ -157,6 +266,8 @@ class LocalPresenceObject(object):
 class Presence(LocalPresenceObject):
     '''This represents a presence (self or someone else) that we've been told about, and information about it.'''
 
+    __slots__ = ('channels',)
+
     def __init__(self, local_presence, name, info, old_me=None):
         '''Create a new presence info blob.
 
@@ -180,6 +291,8 @@ class Presence(LocalPresenceObject):
 class Channel(LocalPresenceObject):
     '''This represents a channel that we've been told about, and information about it.'''
 
+    __slots__ = ('presences',)
+
     def __init__(self, local_presence, name, info, old_me=None):
         '''Create a new channel info blob.
 
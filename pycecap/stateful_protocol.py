@@ -14,63 +14,144 @@
 
 import weakref
 
-from state import Connection
-from protocol import Reply
+_setattr = object.__setattr__
 
 class StatefulMessage(object):
     '''Wrapper for icecap protocol messages (see protocol.py).
     
     This wraps a protocol Message of some kind and allows transparent access to it directly
-    on this object (statefulmessage.params -> statefulmessage.message.params, etc).
+    on this object (statefulmessage.params -> statefulmessage.message.params, etc). Setting
+    attributes (other than private ones) also sets them on the wrapped message.
     In addition, it adds the properties local_presence, connection, channel and presence that
     look up the referenced entity from the message in the current state (or returns None if
-    the message doesn't refer to an entity of the kind).
+    the message doesn't refer to an entity of the kind). Replies refer to the entities of
+    the command they're a reply to, unless they name their own. Entities that aren't known
+    yet are created, through the StateKeeper so its subscribers hear about them.
+
+    Each entity is looked up once, on first access, and cached. Code that has already
+    looked up the entities (like the StateKeeper's built-in handlers) can bind() them.
     '''
 
+    __slots__ = ('_state', '_message', '_command', '_local_presence', '_connection', '_channel', '_presence')
+
     def __init__(self, state, message):
-        self._state = weakref.ref(state)
-        self._message = message
+        # This is created for every message, so skip our own __setattr__. The other slots
+        # are left unset until the entity is resolved or bound.
+        _setattr(self, '_state', weakref.ref(state))
+        _setattr(self, '_message', message)
 
     def __getattr__(self, name):
         return getattr(self._message, name)
 
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._message, name, value)
+
+    def __str__(self):
+        return str(self._message)
+
+    def __repr__(self):
+        return 'StatefulMessage(%r)' % self._message
+
+    def bind(self, command=None, local_presence=None, channel=None, presence=None):
+        '''Bind entities to this message, so they're not looked up on access.
+
+        Args:
+            command: The command this message is a reply to.
+            local_presence: The LocalPresence (and its connection) the message refers to.
+            channel: The Channel the message refers to.
+            presence: The Presence the message refers to.
+        '''
+
+        if command is not None:
+            _setattr(self, '_command', command)
+        if local_presence is not None:
+            _setattr(self, '_local_presence', local_presence)
+            _setattr(self, '_connection', local_presence.connection)
+        if channel is not None:
+            _setattr(self, '_channel', channel)
+        if presence is not None:
+            _setattr(self, '_presence', presence)
+
+    def _reply_to(self):
+        # The command this is a reply to, as a StatefulMessage (or None).
+        try:
+            command = object.__getattribute__(self, '_command')
+        except AttributeError:
+            return None
+        if not isinstance(command, StatefulMessage):
+            command = self._command = StatefulMessage(self._state(), command)
+        return command
+
+    def _names_connection(self):
+        params = self._message.params
+        return 'network' in params and 'mypresence' in params
+
     @property
     def local_presence(self):
-        if 'network' in self._message.params and 'mypresence' in self._message.params:
-            return self._state().get_local_presence(self._message.params)
-        elif isinstance(self._message, Reply):
-            return self._message.command.local_presence
+        try:
+            return object.__getattribute__(self, '_local_presence')
+        except AttributeError:
+            pass
+
+        if self._names_connection():
+            self._local_presence = self._state().get_local_presence(self._message.params)
+        elif self._reply_to() is not None:
+            self._local_presence = self._reply_to().local_presence
         else:
-            return None
+            self._local_presence = None
+        return self._local_presence
 
     @property
     def connection(self):
-        if 'network' in self._message.params and 'mypresence' in self._message.params:
-            return Connection(self._message.params['network'], self._message.params['mypresence'])
-        elif isinstance(self._message, Reply):
-            return self._message.command.connection
+        try:
+            return object.__getattribute__(self, '_connection')
+        except AttributeError:
+            pass
+
+        if self._names_connection():
+            self._connection = self.local_presence.connection
+        elif self._reply_to() is not None:
+            self._connection = self._reply_to().connection
         else:
-            return None
+            self._connection = None
+        return self._connection
 
     @property
     def channel(self):
+        try:
+            return object.__getattribute__(self, '_channel')
+        except AttributeError:
+            pass
+
         local_presence = self.local_presence
-        if local_presence and 'channel' in self._message.params:
-            return local_presence.get_channel(self._message.params['channel'])
-        elif isinstance(self._message, Reply):
-            return self._message.command.channel
+        params = self._message.params
+        if local_presence and 'channel' in params:
+            self._channel = self._state()._get_channel(local_presence, params['channel'])
+        elif self._reply_to() is not None:
+            self._channel = self._reply_to().channel
         else:
-            return None
+            self._channel = None
+        return self._channel
 
     @property
     def presence(self):
+        try:
+            return object.__getattribute__(self, '_presence')
+        except AttributeError:
+            pass
+
         local_presence = self.local_presence
-        if local_presence and 'presence' in self._message.params:
-            return local_presence.get_presence(self._message.params['presence'])
-        elif isinstance(self._message, Reply):
-            return self._message.command.presence
+        params = self._message.params
+        if local_presence and 'presence' in params:
+            self._presence = self._state()._get_presence(local_presence, params['presence'])
+        elif self._reply_to() is not None:
+            self._presence = self._reply_to().presence
         else:
-            return None
+            self._presence = None
+        return self._presence
 
     @property
     def nonstate_params(self):
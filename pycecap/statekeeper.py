@@ -14,15 +14,59 @@
 
 from protocol import Command, Event, Reply
 from stateful_protocol import StatefulMessage
+from history import RingHistory
+from stats import Stats
+import delta
+import snapshot
 import state
 
+from collections import deque
+import heapq
 import sys
 import re
+import time
+from timeit import default_timer
 
 NAME_CLEANUP = re.compile('[^a-z_]+')
 def name_cleanup(name):
     return NAME_CLEANUP.sub('', name.lower().replace(' ', '_'))
 
+HANDLER_PREFIXES = ('on_', 'command_')
+
+# Params naming state entities, their values are interned (see StateKeeper.intern).
+ENTITY_KEYS = ('network', 'mypresence', 'channel', 'presence')
+
+# Hooks, see StateKeeper.add_hook.
+RECEIVED = 'received'
+SENT = 'sent'
+EVENT = 'event'
+HOOKS = (RECEIVED, SENT, EVENT)
+
+# Status of a command that got no final reply before its deadline. It follows the
+# Reply statuses, and is used as an index into the dispatch tables.
+TIMEOUT = len(Reply.STATUS)
+
+class HandlerWatcher(type):
+    '''Metaclass that notices callbacks being added to or removed from a class.
+
+    Every time an on_* or command_* attribute is set or deleted on a class using
+    this metaclass, the global generation counter is bumped. StateKeeper compares
+    this counter against the one its dispatch tables were built for, and throws
+    away the tables when they're stale.
+    '''
+
+    generation = 0
+
+    def __setattr__(cls, name, value):
+        type.__setattr__(cls, name, value)
+        if name.startswith(HANDLER_PREFIXES):
+            HandlerWatcher.generation += 1
+
+    def __delattr__(cls, name):
+        type.__delattr__(cls, name)
+        if name.startswith(HANDLER_PREFIXES):
+            HandlerWatcher.generation += 1
+
 class StateKeeper(object):
     '''A class to keep information about the current state.
 
@@ -38,29 +82,88 @@ class StateKeeper(object):
             called when the given command fails. (Specialized command_fail())
         * def command_%%s_more(self, command, reply): Where %%s is a command name, this is 
             called when the given command gets a new reply. (Specialized command_more())
+        * def command_%%s_timeout(self, command): Where %%s is a command name, this is
+            called when the given command times out. (Specialized command_timeout())
 
     A note on %%s in the above lines: Names are lower-cased, spaces replaced with underscores
     and any non a-z & _ are removed.
+
+    Received events are kept in self.history, according to the retention policy given to
+    the constructor. Iterate over it (or use self.history.events(name)) to look at them.
+
+    The callbacks are resolved once per event / command name and cached in a dispatch table.
+    Adding or removing callbacks at runtime (on the instance or on the class) invalidates the
+    table, so the next message of that name picks up the change.
+
+    Commands can be given a deadline when they're presend()ed. Call expire() regularly, and
+    commands that haven't received a final reply by their deadline are dropped from the
+    pending table and passed to command_timeout().
+
+    enable_stats() turns on timing of the parse, state update and callback dispatch stages of
+    every message, see stats(). While disabled, parse() does no extra work.
+
+    Code that watches the traffic (rather than the state), like logs and archives, can get
+    the lines received, commands sent and events parsed through add_hook().
     '''
 
-    def __init__(self):
-        '''Create a new statekeeper.'''
+    __metaclass__ = HandlerWatcher
+
+    DEFAULT_HISTORY = 1000
+    DEFAULT_INTERN_LIMIT = 100000
+
+    def __init__(self, history=None, reply_timeout=None, keep_replies=False, intern_limit=None,
+                 max_in_flight=None):
+        '''Create a new statekeeper.
+
+        Args:
+            history: Retention policy for received events (see history.py), defaults to
+                keeping the last DEFAULT_HISTORY events. Pass a NoHistory() to keep none.
+            reply_timeout: Default number of seconds a command may wait for its final reply,
+                or None to wait forever.
+            keep_replies: Default for whether presend()ed commands collect their replies in
+                Command.replies. If False, replies are only passed to the callbacks.
+            intern_limit: Maximum number of names in the intern table, see intern().
+            max_in_flight: Maximum number of pending commands before commands queued with
+                presend_many() are held back, or None for no limit.
+        '''
+
+        self.invalidate_handlers()
 
         self.unhandled = (set(), set())
         self._next_tag = 1
 
-        self._events = []
+        if history is None:
+            history = RingHistory(self.DEFAULT_HISTORY)
+        self.history = history
         self._pending_commands = {}
 
+        # Heap of (deadline, tag, command) for pending commands that have a deadline.
+        # Entries for commands that have completed are dropped lazily.
+        self.reply_timeout = reply_timeout
+        self._deadlines = []
+
+        self.keep_replies = keep_replies
+
+        # Commands queued by presend_many(), as (command, timeout), that haven't been
+        # handed out by take_outbound() yet.
+        self.max_in_flight = max_in_flight
+        self._queued = deque()
+
         # Default handlers to update self._{gateways,networks,presences,channels}.
+        # Each is a (staging factory, '>' handler, '+' handler) triple: every '>' reply is applied
+        # to a staging object as it arrives, and the staging object is committed to the state
+        # when the command succeeds (or thrown away if it fails).
         self._reply_handlers = {
-            'network list': self._network_list,
-            'gateway list': self._gateway_list,
-            'presence list': self._local_presence_list,
-            'channel list': self._channel_list,
-            'channel names': self._channel_presence_list,
+            'network list': (dict, self._network_list_more, self._network_list),
+            'gateway list': (dict, self._gateway_list_more, self._gateway_list),
+            'presence list': (dict, self._local_presence_list_more, self._local_presence_list),
+            'channel list': (dict, self._channel_list_more, self._channel_list),
+            'channel names': (dict, self._channel_presence_list_more, self._channel_presence_list),
         }
 
+        # Staging objects of the pending commands with a reply handler, by tag.
+        self._staging = {}
+
         self._event_handlers = {
             'network_init': self._network_add,
             'gateway_init': self._gateway_add,
@@ -77,9 +180,66 @@ class StateKeeper(object):
 
         # Blank state.
         self.networks = {}
-        self.local_presences = {}
+        self.local_presences = state.LocalPresenceMap()
+
+        # Incomplete line from the last call to feed().
+        self._feed_buffer = bytearray()
+
+        # Timing statistics, and Stats.record while they're enabled, see enable_stats().
+        self._stats = None
+        self._record = None
+
+        # Callbacks by hook name, see add_hook().
+        self._hooks = dict((name, []) for name in HOOKS)
+
+        # (callback, batch size, collected deltas) for every subscriber, see subscribe().
+        self._subscribers = []
+
+        # Intern table for entity names, see intern().
+        if intern_limit is None:
+            intern_limit = self.DEFAULT_INTERN_LIMIT
+        self.intern_limit = intern_limit
+        self._names = {}
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name.startswith(HANDLER_PREFIXES):
+            self.invalidate_handlers()
+
+    def __delattr__(self, name):
+        object.__delattr__(self, name)
+        if name.startswith(HANDLER_PREFIXES):
+            self.invalidate_handlers()
+
+    def invalidate_handlers(self):
+        '''Forget all resolved callbacks, they'll be looked up again when next needed.'''
+
+        self._event_dispatch = {}
+        self._command_dispatch = {}
+        self._dispatch_generation = HandlerWatcher.generation
+
+    def _event_handler(self, name):
+        '''Resolve (and cache) the on_* callback for the given raw event name.'''
+
+        handler = getattr(self, 'on_%s' % name_cleanup(name), None)
+        self._event_dispatch[name] = handler
+        return handler
 
-    def presend(self, object_or_command, params=None):
+    def _command_handlers(self, name):
+        '''Resolve (and cache) the command_*_{ok,fail,more} callbacks for the given raw command name.
+
+        The callbacks are returned as a tuple indexed by the Reply status (Reply.OK, Reply.FAIL
+        and Reply.MORE) or TIMEOUT.
+        '''
+
+        handlers = [None] * (TIMEOUT + 1)
+        for (status, suffix) in ((Reply.OK, 'ok'), (Reply.FAIL, 'fail'), (Reply.MORE, 'more'), (TIMEOUT, 'timeout')):
+            handlers[status] = getattr(self, 'command_%s_%s' % (name_cleanup(name), suffix), None)
+
+        handlers = self._command_dispatch[name] = tuple(handlers)
+        return handlers
+
+    def presend(self, object_or_command, params=None, timeout=None, keep_replies=None):
         '''Notify the statekeeper that you're intending to send this.
 
         This causes the statekeeper to keep this command in it's "commands pending reply"
@@ -89,23 +249,161 @@ class StateKeeper(object):
             object_or_command: Either a command name or a Command instance.
             params: Only looked at if object_or_command is a command name - parameters
                 to this command.
+            timeout: Number of seconds to wait for the final reply, defaults to reply_timeout.
+            keep_replies: Whether to collect replies in Command.replies, defaults to keep_replies.
 
         Returns:
             A Command instance - either the one passed in with updated values, or a new
             one created from the passed values.
         '''
 
+        command = self._tag_command(object_or_command, params, keep_replies)
+        self._add_pending(command, timeout)
+        return command
+
+    def presend_many(self, commands, timeout=None, keep_replies=None):
+        '''Queue a batch of commands for sending.
+
+        The commands are tagged right away, but they're only added to the "commands pending
+        reply" queue when take_outbound() hands them out, which it does as long as there
+        are fewer than max_in_flight pending commands.
+
+        Args:
+            commands: A list of command names, (command name, params) pairs or Command instances.
+            timeout: Number of seconds to wait for each final reply, counted from when the
+                command is handed out. Defaults to reply_timeout.
+            keep_replies: Whether to collect replies in Command.replies, defaults to keep_replies.
+
+        Returns:
+            A list of Command instances, in the same order.
+        '''
+
+        result = []
+        for command in commands:
+            if isinstance(command, tuple):
+                command = self._tag_command(command[0], command[1], keep_replies)
+            else:
+                command = self._tag_command(command, None, keep_replies)
+            self._queued.append((command, timeout))
+            result.append(command)
+
+        return result
+
+    def take_outbound(self):
+        '''Hand out as many queued commands as the in-flight window allows.
+
+        The commands are added to the "commands pending reply" queue. Call this again when
+        replies arrive (or commands time out) to send more.
+
+        Returns:
+            A string with the handed out commands, one per line (including a final newline),
+            ready to be written to icecapd in one go. Empty if no commands were handed out.
+        '''
+
+        queued = self._queued
+        if self.max_in_flight is None:
+            count = len(queued)
+        else:
+            count = min(len(queued), self.max_in_flight - len(self._pending_commands))
+
+        lines = []
+        for _ in xrange(count):
+            command, timeout = queued.popleft()
+            self._add_pending(command, timeout)
+            lines.append(str(command))
+
+        if not lines:
+            return ''
+        lines.append('')
+        return '\n'.join(lines)
+
+    def queued(self):
+        '''Get the number of commands queued by presend_many() that haven't been handed out yet.'''
+        return len(self._queued)
+
+    def _tag_command(self, object_or_command, params, keep_replies):
         if isinstance(object_or_command, basestring):
             command = StatefulMessage(self, Command(str(self._next_tag), object_or_command, params))
         else:
             command = object_or_command
             command.tag = str(self._next_tag)
-
         self._next_tag += 1
-        self._pending_commands[command.tag] = command
+
+        if keep_replies is None:
+            keep_replies = self.keep_replies
+        command.replies = [] if keep_replies else None
 
         return command
 
+    def _add_pending(self, command, timeout):
+        self._pending_commands[command.tag] = command
+
+        for hook in self._hooks[SENT]:
+            hook(command)
+
+        if timeout is None:
+            timeout = self.reply_timeout
+        if timeout is not None:
+            heapq.heappush(self._deadlines, (time.time() + timeout, command.tag, command))
+
+            # Don't let entries for completed commands pile up.
+            if len(self._deadlines) > 2 * len(self._pending_commands) + 64:
+                pending = self._pending_commands
+                self._deadlines = [entry for entry in self._deadlines if pending.get(entry[1]) is entry[2]]
+                heapq.heapify(self._deadlines)
+
+    def next_deadline(self):
+        '''Get the earliest deadline of a pending command, or None if there is none.
+
+        The deadline might belong to a command that has already completed, so this is
+        only useful to decide when expire() should be called next.
+        '''
+
+        if self._deadlines:
+            return self._deadlines[0][0]
+        return None
+
+    def expire(self, now=None):
+        '''Time out all pending commands whose deadline has passed.
+
+        Args:
+            now: The current time, defaults to time.time().
+
+        Returns:
+            The number of commands that timed out.
+        '''
+
+        if now is None:
+            now = time.time()
+
+        if self._dispatch_generation != HandlerWatcher.generation:
+            self.invalidate_handlers()
+
+        deadlines = self._deadlines
+        pending = self._pending_commands
+        count = 0
+        while deadlines and deadlines[0][0] <= now:
+            _, tag, command = heapq.heappop(deadlines)
+            if pending.get(tag) is not command:
+                continue
+
+            del pending[tag]
+            self._staging.pop(tag, None)
+            count += 1
+
+            try:
+                handlers = self._command_dispatch[command.command]
+            except KeyError:
+                handlers = self._command_handlers(command.command)
+            handler = handlers[TIMEOUT]
+            if handler:
+                handler(command)
+
+            self.command_timeout(command)
+            self._command_expired(command)
+
+        return count
+
     def event(self, event):
         '''This can be overwritten in derived classes.
 
@@ -133,6 +431,16 @@ class StateKeeper(object):
             command: A Command object that has failed.
         '''
 
+    def command_timeout(self, command):
+        '''This can be overwritten in derived classes.
+
+        This method is called for *all* commands that didn't get a final reply before their
+        deadline. Return value is ignored.
+
+        Arguments:
+            command: A Command object that has timed out.
+        '''
+
     def command_more(self, command, reply):
         '''This can be overwritten in derived classes.
 
@@ -144,6 +452,59 @@ class StateKeeper(object):
             reply: The new reply we've received (also contained in command)
         '''
 
+    def feed(self, data):
+        '''Feed a chunk of data received from the server.
+
+        The data does not need to line up with line boundaries - any trailing partial line
+        is kept until the rest of it is fed, and every complete line is passed to parse().
+        If parse() raises, the lines after the one it raised on are kept too, and parsed by
+        the next call to feed() (which may be given an empty string).
+
+        Args:
+            data: A string, bytearray, buffer or memoryview of any length, as read from the
+                socket or pipe.
+
+        Returns:
+            The number of lines parsed.
+        '''
+
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        elif not isinstance(data, str):
+            data = bytes(data)
+
+        buf = self._feed_buffer
+        if buf:
+            # Rarely more than a partial line, unless parse() raised during the last call.
+            buf += data
+            data = str(buf)
+            del buf[:]
+
+        lines = data.split('\n')
+        tail = lines.pop()
+
+        parse = self.parse
+        count = 0
+        done = 0
+        try:
+            for line in lines:
+                done += 1
+                if line.endswith('\r'):
+                    line = line[:-1]
+                if line:
+                    parse(line)
+                    count += 1
+        except:
+            rest = lines[done:]
+            rest.append(tail)
+            buf += '\n'.join(rest)
+            raise
+        buf += tail
+
+        if self._subscribers:
+            self.flush_deltas()
+        return count
+
     def parse(self, message):
         '''Parse a received message.
 
@@ -153,54 +514,366 @@ class StateKeeper(object):
             message: A string (line) received from the server.
         '''
 
+        if self._dispatch_generation != HandlerWatcher.generation:
+            self.invalidate_handlers()
+
+        for hook in self._hooks[RECEIVED]:
+            hook(message)
+
+        # The stages are the same with and without statistics, only the timing differs.
+        record = self._record
         if message.startswith('*'):
+            if record is None:
+                event = StatefulMessage(self, Event(message))
+                self._update_event(event)
+                self._dispatch_event(event)
+                return
+
+            start = default_timer()
             event = StatefulMessage(self, Event(message))
-            self._events.append(event)
+            event.params
+            parsed = default_timer()
+            self._update_event(event)
+            updated = default_timer()
+            self._dispatch_event(event)
+            done = default_timer()
+
+            record('event', event.command, 'parse', parsed - start)
+            record('event', event.command, 'state', updated - parsed)
+            record('event', event.command, 'dispatch', done - updated)
+        else:
+            if record is None:
+                reply = StatefulMessage(self, Reply(message))
+                command = self._pending_command(reply)
+                if command is not None:
+                    self._update_reply(command, reply)
+                    self._dispatch_reply(command, reply)
+                return
 
-            if event.command in self._event_handlers:
-                self._event_handlers[event.command](event)
-            else:
-                self.unhandled[0].add(event.command)
+            start = default_timer()
+            reply = StatefulMessage(self, Reply(message))
+            reply.params
+            parsed = default_timer()
+            command = self._pending_command(reply)
+            if command is None:
+                return
+            self._update_reply(command, reply)
+            updated = default_timer()
+            self._dispatch_reply(command, reply)
+            done = default_timer()
+
+            record('reply', command.command, 'parse', parsed - start)
+            record('reply', command.command, 'state', updated - parsed)
+            record('reply', command.command, 'dispatch', done - updated)
+
+    def _update_event(self, event):
+        # State stage of an event: keep it, and apply the built-in handler.
+        self.history.append(event)
+
+        if event.command in self._event_handlers:
+            self._intern_params(event.params)
+            self._event_handlers[event.command](event)
+        else:
+            self.unhandled[0].add(event.command)
+
+    def _dispatch_event(self, event):
+        # Dispatch stage of an event: the callbacks and hooks.
+        try:
+            handler = self._event_dispatch[event.command]
+        except KeyError:
+            handler = self._event_handler(event.command)
+        if handler:
+            handler(event)
+
+        self.event(event)
+
+        for hook in self._hooks[EVENT]:
+            hook(event)
+
+    def _pending_command(self, reply):
+        # The pending command a reply belongs to, or None.
+        command = self._pending_commands.get(reply.tag)
+        if command is None:
+            print >>sys.stderr, "Got reply for non-pending tag '%s'" % reply.tag
+        return command
 
-            handler = getattr(self, 'on_%s' % name_cleanup(event.command), None)
+    def _update_reply(self, command, reply):
+        # State stage of a reply: stage or commit it with the built-in handler, and retire
+        # the command on its final reply.
+        command.received_reply(reply)
+        reply.bind(command=command)
+
+        if reply.command == reply.OK:
+            if command.command in self._reply_handlers:
+                factory, _, commit = self._reply_handlers[command.command]
+                staging = self._staging.pop(reply.tag, None)
+                if staging is None:
+                    staging = factory()
+                self._intern_params(command.params)
+                commit(command, staging)
+            else:
+                self.unhandled[1].add(command.command)
+            del self._pending_commands[reply.tag]
+        elif reply.command == reply.FAIL:
+            del self._pending_commands[reply.tag]
+            self._staging.pop(reply.tag, None)
+        elif reply.command == reply.MORE:
+            if command.command in self._reply_handlers:
+                factory, apply, _ = self._reply_handlers[command.command]
+                staging = self._staging.get(reply.tag)
+                if staging is None:
+                    staging = self._staging[reply.tag] = factory()
+                self._intern_params(reply.params)
+                apply(command, reply, staging)
+
+    def _dispatch_reply(self, command, reply):
+        # Dispatch stage of a reply: the callbacks.
+        try:
+            handlers = self._command_dispatch[command.command]
+        except KeyError:
+            handlers = self._command_handlers(command.command)
+        handler = handlers[reply.command]
+
+        if reply.command == reply.OK:
+            if handler:
+                handler(command)
+            self.command_ok(command)
+        elif reply.command == reply.FAIL:
             if handler:
-                handler(event)
+                handler(command)
+            self.command_fail(command)
+        elif reply.command == reply.MORE:
+            if handler:
+                handler(command, reply)
+            self.command_more(command, reply)
 
-            self.event(event)
-        else:
-            reply = StatefulMessage(self, Reply(message))
+        self._reply_received(command, reply)
 
-            if not reply.tag in self._pending_commands:
-                print >>sys.stderr, "Got reply for non-pending tag '%s'" % reply.tag
-                return
+    def enable_stats(self):
+        '''Start collecting timing statistics for parse(), see stats().'''
+
+        if self._stats is None:
+            self._stats = Stats()
+        self._record = self._stats.record
+
+    def disable_stats(self):
+        '''Stop collecting timing statistics. The statistics collected so far are kept.'''
+
+        self._record = None
+
+    def stats(self):
+        '''Get a snapshot of the timing statistics, see Stats.snapshot.
+
+        Returns an empty dict if statistics were never enabled.
+        '''
+
+        if self._stats is None:
+            return {}
+        return self._stats.snapshot()
+
+    def prometheus_stats(self):
+        '''Get the timing statistics in the Prometheus text exposition format.'''
+
+        if self._stats is None:
+            return ''
+        return self._stats.prometheus()
+
+    def add_hook(self, name, callback):
+        '''Watch the traffic going through this statekeeper, e.g. to log or archive it.
+
+        Hooks see the messages themselves rather than the state (see subscribe() for that):
+            * RECEIVED: callback(line) for every line passed to parse(), before it's parsed.
+            * SENT: callback(command) for every command handed out for sending, by presend()
+                or take_outbound().
+            * EVENT: callback(event) for every received event, after it's been handled.
+
+        Args:
+            name: One of RECEIVED, SENT or EVENT (from this module).
+            callback: The function to call.
+        '''
+
+        if name not in HOOKS:
+            raise ValueError('Unknown hook %r' % (name,))
+        self._hooks[name].append(callback)
+
+    def remove_hook(self, name, callback):
+        '''Stop calling a callback added with add_hook().'''
+
+        self._hooks[name].remove(callback)
+
+    def _reply_received(self, command, reply):
+        '''Called after a reply has been fully handled.
+
+        This is for subclasses in pycecap that track commands themselves (e.g. IcecapClient),
+        clients should use the command_* callbacks.
+        '''
+
+    def _command_expired(self, command):
+        '''Called after a command has timed out, see _reply_received.'''
+
+    def snapshot(self, f):
+        '''Write a snapshot of the current state to a file (object or name).
+
+        See snapshot.dumps for what is included.
+        '''
+
+        snapshot.dump(self, f)
 
-            command = self._pending_commands[reply.tag]
-            command.received_reply(reply)
+    def restore(self, f):
+        '''Replace the current state with a snapshot from a file (object or name).'''
 
-            if reply.command == reply.OK:
-                if command.command in self._reply_handlers:
-                    self._reply_handlers[command.command](command)
-                else:
-                    self.unhandled[1].add(command.command)
-                del self._pending_commands[reply.tag]
+        snapshot.load(self, f)
+        self._emit(delta.RESET, None)
 
-                handler = getattr(self, 'command_%s_ok' % name_cleanup(command.command), None)
-                if handler:
-                    handler(command)
+    def subscribe(self, callback, batch=None):
+        '''Get told about every change to the state, as delta.Delta records.
 
-                self.command_ok(command)
-            elif reply.command == reply.FAIL:
-                handler = getattr(self, 'command_%s_fail' % name_cleanup(command.command), None)
-                if handler:
-                    handler(command)
+        Deltas are produced by the built-in handlers as they update the state, so a
+        subscriber can keep a copy of (part of) the state up to date without looking at
+        the events, or at the whole state after every event.
 
-                self.command_fail(command)
-            elif reply.command == reply.MORE:
-                handler = getattr(self, 'command_%s_more' % name_cleanup(command.command), None)
-                if handler:
-                    handler(command, reply)
+        Args:
+            callback: Called with every Delta, or with a list of Deltas if batch is given.
+            batch: If given, Deltas are collected and passed on in lists of at most this
+                many. Any collected Deltas are also passed on by flush_deltas(), which
+                feed() calls after every chunk of data.
+        '''
+
+        self._subscribers.append((callback, batch, []))
+
+    def unsubscribe(self, callback):
+        '''Stop telling the given callback about changes, after passing on any collected Deltas.'''
+
+        for (subscriber, batch, pending) in self._subscribers:
+            if subscriber == callback and pending:
+                subscriber(pending)
+        self._subscribers = [entry for entry in self._subscribers if entry[0] != callback]
+
+    def flush_deltas(self):
+        '''Pass on the Deltas collected for subscribers with a batch size.'''
+
+        for (callback, batch, pending) in self._subscribers:
+            if pending:
+                deltas = pending[:]
+                del pending[:]
+                callback(deltas)
+
+    def apply_delta(self, change):
+        '''Make the change described by a Delta from another StateKeeper to this state.
+
+        This lets a StateKeeper mirror one that lives elsewhere (e.g. in another process),
+        as long as the Deltas are applied in order, starting from the same state. The Delta
+        is then passed on to this StateKeeper's own subscribers.
+
+        Args:
+            change: A delta.Delta, or the equivalent plain tuple.
+        '''
 
-                self.command_more(command, reply)
+        kind, entity, network, mypresence, name, data = change
+
+        if entity == delta.NETWORK:
+            if kind == delta.REMOVED:
+                self.networks.pop(network, None)
+                self.local_presences.remove_network(network)
+            else:
+                self.networks[network] = state.Network(network, data, self.networks.get(network))
+        elif entity == delta.GATEWAY:
+            gateways = self.get_network(network).gateways
+            if kind == delta.ADDED:
+                gateways.append(data)
+            elif data in gateways:
+                gateways.remove(data)
+        elif entity == delta.LOCAL_PRESENCE:
+            connection = state.Connection(network, mypresence)
+            if kind == delta.REMOVED:
+                self.local_presences.pop(connection, None)
+            else:
+                old_me = self.local_presences.get(connection)
+                local_presence = state.LocalPresence(connection, data, old_me)
+                for child in local_presence.channels.values() + local_presence.presences.values():
+                    child.reparent(local_presence)
+                self.local_presences[connection] = local_presence
+        elif entity == delta.CHANNEL:
+            local_presence = self.get_local_presence((network, mypresence))
+            channels, presences = local_presence.channels, local_presence.presences
+            if kind == delta.ADDED or kind == delta.CHANGED:
+                channels[name] = state.Channel(local_presence, name, data, channels.get(name))
+            elif kind == delta.REMOVED:
+                channel_obj = channels.pop(name, None)
+                if channel_obj is not None:
+                    for presence in channel_obj.presences.iterkeys():
+                        if presence in presences:
+                            presences[presence].channels.discard(name)
+            elif kind == delta.JOINED:
+                presence, mode = data
+                local_presence.get_channel(name).presences[presence] = mode
+                local_presence.get_presence(presence).channels.add(name)
+            elif kind == delta.PARTED:
+                if name in channels:
+                    channels[name].presences.pop(data, None)
+                if data in presences:
+                    presences[data].channels.discard(name)
+        elif entity == delta.PRESENCE:
+            local_presence = self.get_local_presence((network, mypresence))
+            channels, presences = local_presence.channels, local_presence.presences
+            if kind == delta.ADDED or kind == delta.CHANGED:
+                presences[name] = state.Presence(local_presence, name, data, presences.get(name))
+            elif kind == delta.REMOVED:
+                presence_obj = presences.pop(name, None)
+                if presence_obj is not None:
+                    for channel in presence_obj.channels:
+                        if channel in channels:
+                            channels[channel].presences.pop(name, None)
+            elif kind == delta.RENAMED and name in presences:
+                presence_obj = presences.pop(name)
+                presence_obj.name = data
+                presences[data] = presence_obj
+                for channel in presence_obj.channels:
+                    if channel in channels:
+                        channel_presences = channels[channel].presences
+                        channel_presences[data] = channel_presences.pop(name, '')
+
+        self._emit(kind, entity, network, mypresence, name, data)
+
+    def _emit(self, kind, entity, network=None, mypresence=None, name=None, data=None):
+        if not self._subscribers:
+            return
+
+        change = delta.Delta(kind, entity, network, mypresence, name, data)
+        for (callback, batch, pending) in self._subscribers:
+            if batch is None:
+                callback(change)
+            else:
+                pending.append(change)
+                if len(pending) >= batch:
+                    deltas = pending[:]
+                    del pending[:]
+                    callback(deltas)
+
+    def intern(self, name):
+        '''Get the shared string object for the given entity name.
+
+        The names of networks, local presences, channels and presences are repeated in
+        millions of messages. Storing the same string object for every occurrence saves
+        memory, and lets dict lookups succeed on identity. The table holds at most
+        intern_limit names, names seen after that are returned as is.
+
+        The shared strings are also interned with the builtin intern(), so they're shared
+        in (and restored from) snapshots too.
+        '''
+
+        try:
+            return self._names[name]
+        except KeyError:
+            if len(self._names) >= self.intern_limit or type(name) is not str:
+                return name
+            name = self._names[name] = intern(name)
+            return name
+
+    def _intern_params(self, params):
+        for key in ENTITY_KEYS:
+            if key in params:
+                params[key] = self.intern(params[key])
 
     def get_network(self, network):
         '''Get a Network instance for the given network name.
@@ -211,6 +884,7 @@ class StateKeeper(object):
 
         if network not in self.networks:
             self.networks[network] = state.Network(network, {})
+            self._emit(delta.ADDED, delta.NETWORK, network, data=self.networks[network].info)
         return self.networks[network]
 
     def get_local_presence(self, connection):
@@ -218,29 +892,91 @@ class StateKeeper(object):
 
         This method creates a new LocalPresence and associates it with the given connection 
         if none is found.
+
+        Args:
+            connection: A Connection, or a params dict with 'network' and 'mypresence' keys.
         '''
 
-        if not isinstance(connection, state.Connection):
-            connection = state.Connection(connection)
-        if connection not in self.local_presences:
-            self.local_presences[connection] = state.LocalPresence(connection, {})
-        return self.local_presences[connection]
-
-    def _network_list(self, command):
-        # Get a list of new networks from this reply,
-        # retaining info from previous definitions (gateways)
-        new_networks = {}
-        for reply in command.replies:
-            if reply.command == reply.MORE:
-                network = reply.params.pop('network')
-                new_networks[network] = state.Network(network, reply.params, self.networks.get(network))
+        if isinstance(connection, tuple):
+            network, mypresence = connection
+        else:
+            network = connection['network']
+            mypresence = connection['mypresence']
+
+        local_presences = self.local_presences.networks.get(network)
+        if local_presences is not None:
+            local_presence = local_presences.get(mypresence)
+            if local_presence is not None:
+                return local_presence
+
+        connection = state.Connection(network, mypresence)
+        local_presence = self.local_presences[connection] = state.LocalPresence(connection, {})
+        self._emit(delta.ADDED, delta.LOCAL_PRESENCE, network, mypresence, data=local_presence.info)
+        return local_presence
 
+    def find(self, network, mypresence, channel=None, presence=None):
+        '''Look up a known LocalPresence, Channel or Presence by name without creating it.
+
+        Args:
+            network: Name of the network.
+            mypresence: Name of the local presence.
+            channel: Optional name of a channel to look up on that connection.
+            presence: Optional name of a presence to look up on that connection.
+
+        Returns:
+            The Channel if channel is given, else the Presence if presence is given,
+            else the LocalPresence. None if it isn't known.
+        '''
+
+        local_presence = self.local_presences.lookup(network, mypresence)
+        if local_presence is None:
+            return None
+        if channel is not None:
+            return local_presence.channels.get(channel)
+        if presence is not None:
+            return local_presence.presences.get(presence)
+        return local_presence
+
+    def _get_channel(self, local_presence, channel):
+        # LocalPresence.get_channel, telling subscribers if the channel is new.
+        channel_obj = local_presence.channels.get(channel)
+        if channel_obj is None:
+            channel_obj = local_presence.get_channel(channel)
+            if self._subscribers:
+                network, mypresence = local_presence.connection
+                self._emit(delta.ADDED, delta.CHANNEL, network, mypresence, channel, channel_obj.info)
+        return channel_obj
+
+    def _get_presence(self, local_presence, presence):
+        # LocalPresence.get_presence, telling subscribers if the presence is new.
+        presence_obj = local_presence.presences.get(presence)
+        if presence_obj is None:
+            presence_obj = local_presence.get_presence(presence)
+            if self._subscribers:
+                network, mypresence = local_presence.connection
+                self._emit(delta.ADDED, delta.PRESENCE, network, mypresence, presence, presence_obj.info)
+        return presence_obj
+
+    def _network_list_more(self, command, reply, new_networks):
+        # Collect the new networks, retaining info from previous definitions (gateways)
+        network = reply.params.pop('network')
+        new_networks[network] = state.Network(network, reply.params, self.networks.get(network))
+
+    def _network_list(self, command, new_networks):
         # Remove all local presences that refer to the no longer existing networks.
-        old_networks = set(self.networks.iterkeys())
-        removed_networks = old_networks - set(new_networks.iterkeys())
-        for connection in self.local_presences.iterkeys():
-            if connection.network in removed_networks:
-                del self.local_presences[connection]
+        for network in self.networks.iterkeys():
+            if network not in new_networks:
+                for local_presence in self.local_presences.remove_network(network):
+                    self._emit(delta.REMOVED, delta.LOCAL_PRESENCE, *local_presence.connection)
+                self._emit(delta.REMOVED, delta.NETWORK, network)
+
+        if self._subscribers:
+            for (network, network_obj) in new_networks.iteritems():
+                old_network = self.networks.get(network)
+                if old_network is None:
+                    self._emit(delta.ADDED, delta.NETWORK, network, data=network_obj.info)
+                elif old_network.info != network_obj.info:
+                    self._emit(delta.CHANGED, delta.NETWORK, network, data=network_obj.info)
 
         # And instate new networks.
         self.networks = new_networks
@@ -248,32 +984,47 @@ class StateKeeper(object):
     def _network_add(self, event):
         network = event.params.pop('network')
         # Add network - if network already exist, retain gateways associated with it.
-        self.networks[network] = state.Network(network, event.params, self.networks.get(network))
+        old_network = self.networks.get(network)
+        self.networks[network] = state.Network(network, event.params, old_network)
+        self._emit(delta.ADDED if old_network is None else delta.CHANGED, delta.NETWORK, network, data=event.params)
 
-    def _gateway_list(self, command):
-        # Clear list of gateways for all networks, this is a "fresh start"
-        for network in self.networks.iterkeys():
-            self.networks[network].gateways = []
+    def _gateway_list_more(self, command, reply, new_gateways):
+        network = reply.params.pop('network')
+        new_gateways.setdefault(network, []).append(reply.params)
 
-        for reply in command.replies:
-            if reply.command == reply.MORE:
-                network = reply.params.pop('network')
-                # Add gateway to specified network, create network if needed.
-                self.get_network(network).gateways.append(reply.params)
+    def _gateway_list(self, command, new_gateways):
+        # Clear list of gateways for all networks, this is a "fresh start"
+        old_gateways = {}
+        for (network, network_obj) in self.networks.iteritems():
+            old_gateways[network] = network_obj.gateways
+            network_obj.gateways = []
+
+        for (network, gateways) in new_gateways.iteritems():
+            # Add gateways to specified network, create network if needed.
+            self.get_network(network).gateways = gateways
+
+        if self._subscribers:
+            for (network, gateways) in old_gateways.iteritems():
+                if gateways != new_gateways.get(network, []):
+                    for gateway in gateways:
+                        self._emit(delta.REMOVED, delta.GATEWAY, network, data=gateway)
+            for (network, gateways) in new_gateways.iteritems():
+                if gateways != old_gateways.get(network, []):
+                    for gateway in gateways:
+                        self._emit(delta.ADDED, delta.GATEWAY, network, data=gateway)
 
     def _gateway_add(self, event):
         network = event.params.pop('network')
         # Add gateway to specified network, create network if needed.
         self.get_network(network).gateways.append(event.params)
+        self._emit(delta.ADDED, delta.GATEWAY, network, data=event.params)
 
-    def _local_presence_list(self, command):
-        # Get a list of new presences
-        new_presences = {}
-        for reply in command.replies:
-            if reply.command == reply.MORE:
-                connection = state.Connection(reply.params)
-                new_presences[connection] = state.LocalPresence(connection, reply.params, self.local_presences.get(connection))
+    def _local_presence_list_more(self, command, reply, new_presences):
+        connection = state.Connection(reply.params)
+        old_me = self.local_presences.lookup(*connection)
+        new_presences[connection] = state.LocalPresence(connection, reply.params, old_me)
 
+    def _local_presence_list(self, command, new_presences):
         # Update all Channels and Users to refer to the right local_presence
         for local_presence in new_presences.itervalues():
             for channel in local_presence.channels.itervalues():
@@ -281,25 +1032,51 @@ class StateKeeper(object):
             for presence in local_presence.presences.itervalues():
                 presence.reparent(local_presence)
 
-        self.local_presences = new_presences
+        if self._subscribers:
+            for connection in self.local_presences.iterkeys():
+                if connection not in new_presences:
+                    self._emit(delta.REMOVED, delta.LOCAL_PRESENCE, *connection)
+            for (connection, local_presence) in new_presences.iteritems():
+                old_me = self.local_presences.get(connection)
+                if old_me is None:
+                    self._emit(delta.ADDED, delta.LOCAL_PRESENCE, data=local_presence.info, *connection)
+                elif old_me.info != local_presence.info:
+                    self._emit(delta.CHANGED, delta.LOCAL_PRESENCE, data=local_presence.info, *connection)
+
+        self.local_presences = state.LocalPresenceMap(new_presences)
 
     def _local_presence_add(self, event):
         # Add a new local presence, overwriting any existing ones (retaining any channels & presences known by it)
         connection = state.Connection(event.params)
-        self.local_presences[connection] = state.LocalPresence(connection, event.params, self.local_presences.get(connection))
+        old_me = self.local_presences.lookup(*connection)
+        local_presence = state.LocalPresence(connection, event.params, old_me)
+        self.local_presences[connection] = local_presence
+        event.bind(local_presence=local_presence)
+        self._emit(delta.ADDED if old_me is None else delta.CHANGED, delta.LOCAL_PRESENCE,
+                   data=event.params, *connection)
 
     def _local_presence_remove(self, event):
         # Delete the given local presence, if it exists.
         connection = state.Connection(event.params)
-        if connection in self.local_presences:
-            del self.local_presences[connection]
+        local_presence = self.local_presences.pop(connection, None)
+        if local_presence is not None:
+            event.bind(local_presence=local_presence)
+            self._emit(delta.REMOVED, delta.LOCAL_PRESENCE, *connection)
 
     def _presence_add(self, event):
         # Add a new presence, overwriting any existing ones, but retaining any channel membership info.
         local_presence = self.get_local_presence(event.params)
         presence = event.params.pop('presence')
 
-        local_presence.presences[presence] = state.Presence(local_presence, presence, event.params, local_presence.presences.get(presence))
+        old_me = local_presence.presences.get(presence)
+        presence_obj = state.Presence(local_presence, presence, event.params, old_me)
+        local_presence.presences[presence] = presence_obj
+        event.bind(local_presence=local_presence, presence=presence_obj)
+
+        if self._subscribers:
+            network, mypresence = local_presence.connection
+            self._emit(delta.ADDED if old_me is None else delta.CHANGED, delta.PRESENCE,
+                       network, mypresence, presence, event.params)
 
     def _presence_remove(self, event):
         # Removes a presence, if it's there, and removes all channels that contain it.
@@ -307,16 +1084,22 @@ class StateKeeper(object):
         presence = event.params.pop('presence')
 
         presence_obj = local_presence.presences.pop(presence, None)
+        event.bind(local_presence=local_presence, presence=presence_obj)
 
         if presence_obj is not None:
             for channel in presence_obj.channels:
                 if channel in local_presence.channels:
-                    local_presence.channels[channel].pop(presence, None)
+                    local_presence.channels[channel].presences.pop(presence, None)
+
+            if self._subscribers:
+                network, mypresence = local_presence.connection
+                self._emit(delta.REMOVED, delta.PRESENCE, network, mypresence, presence)
 
     def _presence_changed(self, event):
         local_presence = self.get_local_presence(event.params)
         presence = event.params.pop('presence')
-        presence_obj = local_presence.get_presence(presence)
+        presence_obj = self._get_presence(local_presence, presence)
+        event.bind(local_presence=local_presence, presence=presence_obj)
 
         # The name param in presence_changed means the user changed nick / name,
         # and we need to update all references to the old name.
@@ -333,40 +1116,84 @@ class StateKeeper(object):
 
             # Then finally, delete the old entry.
             del local_presence.presences[presence]
+            presence_obj.name = new_presence
+
+            if self._subscribers:
+                network, mypresence = local_presence.connection
+                self._emit(delta.RENAMED, delta.PRESENCE, network, mypresence, presence, new_presence)
             presence = new_presence
 
         # Otherwise, these are attributes where we just update the info-dict for the presence.
         INFO_KEYS = ['address'] # TODO: More keys?
+        changed = False
         for key in INFO_KEYS:
             if key in event.params:
                 new_info = event.params.pop(key)
                 presence_obj.info[key] = new_info
+                changed = True
+
+        if changed and self._subscribers:
+            network, mypresence = local_presence.connection
+            self._emit(delta.CHANGED, delta.PRESENCE, network, mypresence, presence, presence_obj.info)
 
-    def _channel_list(self, command):
-        # Build a dict of Connection-to-<name-to-Channel> from this reply.
-        new_channels = {}
-        for reply in command.replies:
-            if reply.command == reply.MORE:
-                connection = state.Connection(reply.params)
-                local_presence = self.get_local_presence(connection)
-                if connection not in new_channels:
-                    new_channels[connection] = {}
+    def _channel_list_more(self, command, reply, new_channels):
+        # Build a dict of Connection-to-<name-to-info> from this reply. The Channels (and any
+        # missing LocalPresences) are only created once the whole reply is in.
+        connection = state.Connection(reply.params)
+        channels = new_channels.get(connection)
+        if channels is None:
+            channels = new_channels[connection] = {}
 
-                channel = reply.params.pop('channel')
-                new_channels[connection][channel] = state.Channel(local_presence, channel, reply.params, local_presence.channels.get(channel))
+        channels[reply.params.pop('channel')] = reply.params
+
+    def _channel_list(self, command, new_channels):
+        for (connection, channels) in new_channels.iteritems():
+            local_presence = self.get_local_presence(connection)
+            old_channels = local_presence.channels
+            for (channel, info) in channels.iteritems():
+                channels[channel] = state.Channel(local_presence, channel, info, old_channels.get(channel))
 
         # Go over every Connection, if it's in the new list, update it, otherwise clear it.
-        for (connection, presence) in self.local_presences.iteritems():
+        for (connection, local_presence) in self.local_presences.iteritems():
+            old_channels = local_presence.channels
             if connection in new_channels:
-                presence.channels = new_channels[connection]
+                local_presence.channels = new_channels[connection]
+            elif old_channels:
+                local_presence.channels = {}
             else:
-                presence.channels = {}
+                continue
+
+            # Like _channel_remove, forget the membership of the channels that are gone.
+            removed_channels = [channel for channel in old_channels.iterkeys() if channel not in local_presence.channels]
+            for channel in removed_channels:
+                for presence in old_channels[channel].presences.iterkeys():
+                    if presence in local_presence.presences:
+                        local_presence.presences[presence].channels.discard(channel)
+
+            if self._subscribers:
+                network, mypresence = connection
+                for channel in removed_channels:
+                    self._emit(delta.REMOVED, delta.CHANNEL, network, mypresence, channel)
+                for (channel, channel_obj) in local_presence.channels.iteritems():
+                    old_channel = old_channels.get(channel)
+                    if old_channel is None:
+                        self._emit(delta.ADDED, delta.CHANNEL, network, mypresence, channel, channel_obj.info)
+                    elif old_channel.info != channel_obj.info:
+                        self._emit(delta.CHANGED, delta.CHANNEL, network, mypresence, channel, channel_obj.info)
 
     def _channel_add(self, event):
         # Add a channel, retain any presences in it if it already exists.
         local_presence = self.get_local_presence(event.params)
         channel = event.params.pop('channel')
-        local_presence.channels[channel] = state.Channel(local_presence, channel, event.params, local_presence.channels.get(channel))
+        old_me = local_presence.channels.get(channel)
+        channel_obj = state.Channel(local_presence, channel, event.params, old_me)
+        local_presence.channels[channel] = channel_obj
+        event.bind(local_presence=local_presence, channel=channel_obj)
+
+        if self._subscribers:
+            network, mypresence = local_presence.connection
+            self._emit(delta.ADDED if old_me is None else delta.CHANGED, delta.CHANNEL,
+                       network, mypresence, channel, event.params)
 
     def _channel_remove(self, event):
         # Remove a channel, if it exists, and remove any presences presnece listed as being in it
@@ -374,32 +1201,45 @@ class StateKeeper(object):
         channel = event.params.pop('channel')
 
         channel_obj = local_presence.channels.pop(channel, None)
+        event.bind(local_presence=local_presence, channel=channel_obj)
 
         if channel_obj is not None:
             for presence in channel_obj.presences.iterkeys():
                 if presence in local_presence.presences:
-                    local_presence.presences[presence].channels.pop(channel, None)
+                    local_presence.presences[presence].channels.discard(channel)
+
+            if self._subscribers:
+                network, mypresence = local_presence.connection
+                self._emit(delta.REMOVED, delta.CHANNEL, network, mypresence, channel)
 
-    def _channel_presence_list(self, command):
+    def _channel_presence_list_more(self, command, reply, new_presences):
+        presence = reply.params.pop('presence')
+        new_presences[presence] = reply.params.pop('mode', '')
+
+    def _channel_presence_list(self, command, new_presences):
         # Replace the presencelist for a channel with these new ones.
         local_presence = self.get_local_presence(command.params)
-        channel = local_presence.get_channel(command.params.pop('channel'))
-
-        old_presences = set(channel.presences.iterkeys())
-        channel.presences = {}
+        channel_name = command.params['channel']
+        channel = self._get_channel(local_presence, channel_name)
 
+        old_presences = channel.presences
+        channel.presences = new_presences
 
-        for reply in command.replies:
-            if reply.command == reply.MORE:
-                presence = reply.params.pop('presence')
-                mode = reply.params.pop('mode', '')
-                channel.presences[presence] = mode
-                local_presence.get_presence(presence).channels.add(channel)
+        for presence in new_presences.iterkeys():
+            self._get_presence(local_presence, presence).channels.add(channel_name)
 
         # Remove channel from channel-list of presences which weren't present in the new list.
-        removed_presences = old_presences - set(channel.presences.iterkeys())
+        removed_presences = set(old_presences.iterkeys()) - set(new_presences.iterkeys())
         for presence in removed_presences:
-            local_presence.get_presence(presence).channels.discard(channel)
+            self._get_presence(local_presence, presence).channels.discard(channel_name)
+
+        if self._subscribers:
+            network, mypresence = local_presence.connection
+            for presence in removed_presences:
+                self._emit(delta.PARTED, delta.CHANNEL, network, mypresence, channel_name, presence)
+            for (presence, mode) in new_presences.iteritems():
+                if old_presences.get(presence) != mode:
+                    self._emit(delta.JOINED, delta.CHANNEL, network, mypresence, channel_name, (presence, mode))
 
     def _channel_presence_add(self, event):
         # Link a presence to a channel
@@ -407,8 +1247,16 @@ class StateKeeper(object):
         channel = event.params.pop('channel')
         presence = event.params.pop('presence')
 
-        local_presence.get_channel(channel).presences[presence] = ''
-        local_presence.get_presence(presence).channels.add(channel)
+        channel_obj = self._get_channel(local_presence, channel)
+        presence_obj = self._get_presence(local_presence, presence)
+        old_mode = channel_obj.presences.get(presence)
+        channel_obj.presences[presence] = ''
+        presence_obj.channels.add(channel)
+        event.bind(local_presence=local_presence, channel=channel_obj, presence=presence_obj)
+
+        if old_mode != '' and self._subscribers:
+            network, mypresence = local_presence.connection
+            self._emit(delta.JOINED, delta.CHANNEL, network, mypresence, channel, (presence, ''))
 
     def _channel_presence_remove(self, event):
         # Remove a link between a presence and a channel
@@ -416,5 +1264,12 @@ class StateKeeper(object):
         channel = event.params.pop('channel')
         presence = event.params.pop('presence')
 
-        local_presence.get_channel(channel).presences.pop(presence, None)
-        local_presence.get_presence(presence).channels.discard(channel)
+        channel_obj = self._get_channel(local_presence, channel)
+        presence_obj = self._get_presence(local_presence, presence)
+        old_mode = channel_obj.presences.pop(presence, None)
+        presence_obj.channels.discard(channel)
+        event.bind(local_presence=local_presence, channel=channel_obj, presence=presence_obj)
+
+        if old_mode is not None and self._subscribers:
+            network, mypresence = local_presence.connection
+            self._emit(delta.PARTED, delta.CHANNEL, network, mypresence, channel, presence)
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# pycecap
+# Copyright (c) 2009 Jørgen Tjernø <jorgenpt@gmail.com>
+#
+# This package is free software;  you can redistribute it and/or
+# modify it under the terms of the license found in the file
+# named COPYING that should have accompanied this file.
+#
+# THIS PACKAGE IS PROVIDED ``AS IS'' AND WITHOUT ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, WITHOUT LIMITATION, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE.
+
+'''Timing statistics for the stages of StateKeeper.parse.'''
+
+# Latency histograms have power-of-two buckets in microseconds: bucket i counts
+# durations below 2**i us, and the last bucket counts everything slower.
+BUCKETS = 24
+BUCKET_BOUNDS = [2 ** i / 1e6 for i in xrange(BUCKETS - 1)] + [float('inf')]
+
+STAGES = ('parse', 'state', 'dispatch')
+
+class StageStats(object):
+    '''Count, total time and latency histogram of one stage for one message name.'''
+
+    __slots__ = ('count', 'total', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.histogram = [0] * BUCKETS
+
+    def record(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        self.histogram[min(int(elapsed * 1e6).bit_length(), BUCKETS - 1)] += 1
+
+    def snapshot(self):
+        return {'count': self.count, 'total': self.total, 'histogram': list(self.histogram)}
+
+class Stats(object):
+    '''Statistics for all stages, by message kind ('event' or 'reply') and name.'''
+
+    def __init__(self):
+        self._stages = {}
+
+    def record(self, kind, name, stage, elapsed):
+        '''Record that the given stage of a message took `elapsed` seconds.'''
+
+        key = (kind, name, stage)
+        stats = self._stages.get(key)
+        if stats is None:
+            stats = self._stages[key] = StageStats()
+        stats.record(elapsed)
+
+    def clear(self):
+        self._stages.clear()
+
+    def snapshot(self):
+        '''Get a copy of the statistics as a dict.
+
+        The dict is keyed by kind, then name, then stage. Each stage has a 'count', the
+        'total' time in seconds, and a 'histogram' of counts per bucket (see BUCKET_BOUNDS).
+        '''
+
+        result = {}
+        for ((kind, name, stage), stats) in self._stages.iteritems():
+            result.setdefault(kind, {}).setdefault(name, {})[stage] = stats.snapshot()
+        return result
+
+    def prometheus(self, metric='pycecap_parse_seconds'):
+        '''Get the statistics in the Prometheus text exposition format, as a histogram.'''
+
+        lines = ['# HELP %s Time spent in each stage of StateKeeper.parse.' % metric,
+                 '# TYPE %s histogram' % metric]
+        for ((kind, name, stage), stats) in sorted(self._stages.iteritems()):
+            labels = 'kind="%s",name="%s",stage="%s"' % (kind, _label(name), stage)
+            cumulative = 0
+            for (bound, count) in zip(BUCKET_BOUNDS, stats.histogram):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_bucket{%s,le="%s"} %i' % (metric, labels, le, cumulative))
+            lines.append('%s_sum{%s} %r' % (metric, labels, stats.total))
+            lines.append('%s_count{%s} %i' % (metric, labels, stats.count))
+        return '\n'.join(lines) + '\n'
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,307 @@
+#!/usr/bin/python
+# vim: set fileencoding=utf-8 :
+#
+# pycecap
+# Copyright (c) 2009 Jørgen Tjernø <jorgenpt@gmail.com>
+#
+# This package is free software;  you can redistribute it and/or
+# modify it under the terms of the license found in the file
+# named COPYING that should have accompanied this file.
+#
+# THIS PACKAGE IS PROVIDED ``AS IS'' AND WITHOUT ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, WITHOUT LIMITATION, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE.
+
+'''Point-in-time, read-only copies of the state, for reading it from other threads.
+
+The state objects of a StateKeeper are changed in place as messages are parsed, so
+another thread can't safely iterate over them. A ViewPublisher keeps a read-only copy
+(a StateView) of the state, and replaces it with a new one after every chunk of data
+the StateKeeper is fed. Readers just pick up the current StateView: it never changes
+once published, so they need no locks, and the parsing thread never waits for them.
+
+A new StateView shares everything that didn't change with the previous one, so only
+the channels and presences touched since the last one are copied.
+'''
+
+import delta
+import state
+
+import sys
+import time
+
+class NetworkView(object):
+    '''Read-only copy of a Network.'''
+
+    __slots__ = ('network', 'info', 'gateways')
+
+    def __init__(self, network):
+        self.network = network.network
+        self.info = dict(network.info)
+        self.gateways = tuple(dict(gateway) for gateway in network.gateways)
+
+    def __repr__(self):
+        return 'NetworkView(%r, %r, <gateways=%r>)' % (self.network, self.info, self.gateways)
+
+class LocalPresenceView(object):
+    '''Read-only copy of a LocalPresence, with ChannelViews and PresenceViews by name.'''
+
+    __slots__ = ('connection', 'info', 'channels', 'presences')
+
+    def __init__(self, connection, info, channels, presences):
+        self.connection = connection
+        self.info = info
+        self.channels = channels
+        self.presences = presences
+
+    def __repr__(self):
+        return 'LocalPresenceView(%r, %r, <channels=%r, presences=%r>)' % (self.connection, self.info, self.channels, self.presences)
+
+class ChannelView(object):
+    '''Read-only copy of a Channel. The presences are a dict of name to mode.'''
+
+    __slots__ = ('connection', 'name', 'info', 'presences')
+
+    def __init__(self, connection, channel):
+        self.connection = connection
+        self.name = channel.name
+        self.info = dict(channel.info)
+        self.presences = dict(channel.presences)
+
+    def __repr__(self):
+        return 'ChannelView(%r, %r, %r, <presences=%r>)' % (self.connection, self.name, self.info, self.presences)
+
+class PresenceView(object):
+    '''Read-only copy of a Presence. The channels are a frozenset of names.'''
+
+    __slots__ = ('connection', 'name', 'info', 'channels')
+
+    def __init__(self, connection, presence):
+        self.connection = connection
+        self.name = presence.name
+        self.info = dict(presence.info)
+        self.channels = frozenset(presence.channels)
+
+    def __repr__(self):
+        return 'PresenceView(%r, %r, %r, <channels=%r>)' % (self.connection, self.name, self.info, self.channels)
+
+class StateView(object):
+    '''A read-only copy of the state of a StateKeeper at one point in time.
+
+    Attributes:
+        version: Number of StateViews published before this one.
+        published: When this StateView was published (time.time()).
+        networks: Dict of network name to NetworkView.
+        local_presences: LocalPresenceMap of Connection to LocalPresenceView.
+
+    None of this may be modified, it's shared with other StateViews.
+    '''
+
+    __slots__ = ('version', 'published', 'networks', 'local_presences')
+
+    def __init__(self, version, networks, local_presences):
+        self.version = version
+        self.published = time.time()
+        self.networks = networks
+        self.local_presences = local_presences
+
+    def find(self, network, mypresence, channel=None, presence=None):
+        '''Look up a LocalPresenceView, ChannelView or PresenceView by name, see StateKeeper.find.'''
+
+        local_presence = self.local_presences.lookup(network, mypresence)
+        if local_presence is None:
+            return None
+        if channel is not None:
+            return local_presence.channels.get(channel)
+        if presence is not None:
+            return local_presence.presences.get(presence)
+        return local_presence
+
+    def __repr__(self):
+        return 'StateView(%i, <networks=%i, local_presences=%i>)' % (self.version, len(self.networks), len(self.local_presences))
+
+# Marks a whole LocalPresence as changed in ViewPublisher._dirty.
+_ALL = None
+
+class ViewPublisher(object):
+    '''Publish StateViews of a StateKeeper for other threads to read.
+
+    A new StateView is published every time the StateKeeper flushes its deltas (after
+    every chunk passed to feed(), see StateKeeper.subscribe), at most every min_interval
+    seconds. Use view() from any thread to get the latest one.
+    '''
+
+    def __init__(self, keeper, min_interval=0):
+        '''Start publishing StateViews of the given StateKeeper.
+
+        Args:
+            keeper: The StateKeeper, which should only be used from one thread.
+            min_interval: Minimum number of seconds between two StateViews. Changes made
+                in between are picked up by the next one.
+        '''
+
+        self.keeper = keeper
+        self.min_interval = min_interval
+
+        self._current = StateView(0, {}, state.LocalPresenceMap())
+        self._reset = True
+        self._dirty_networks = set()
+        # Connection to [info changed, changed channel names, changed presence names], where
+        # either set may be _ALL.
+        self._dirty = {}
+
+        # With a batch size that's never reached, the deltas are only passed on when flushed.
+        keeper.subscribe(self._changed, batch=sys.maxint)
+        self.publish()
+
+    def view(self):
+        '''Get the latest published StateView. Safe to call from any thread.'''
+        return self._current
+
+    def close(self):
+        '''Stop publishing StateViews.'''
+        self.keeper.unsubscribe(self._changed)
+
+    def publish(self):
+        '''Publish a StateView of the current state right away. Call from the parsing thread.'''
+
+        self.keeper.flush_deltas()
+        self._publish()
+        return self._current
+
+    def _changed(self, deltas):
+        for change in deltas:
+            self._mark(change)
+
+        if not self.min_interval or time.time() - self._current.published >= self.min_interval:
+            self._publish()
+
+    def _mark(self, change):
+        kind, entity, network, mypresence, name, data = change
+        if kind == delta.RESET:
+            self._reset = True
+            return
+        if entity == delta.NETWORK or entity == delta.GATEWAY:
+            self._dirty_networks.add(network)
+            if kind == delta.REMOVED and entity == delta.NETWORK:
+                for local_presence in self._current.local_presences.on_network(network).itervalues():
+                    self._dirty[local_presence.connection] = [True, _ALL, _ALL]
+            return
+
+        connection = state.Connection(network, mypresence)
+        if entity == delta.LOCAL_PRESENCE:
+            if kind == delta.CHANGED:
+                self._dirty.setdefault(connection, [True, set(), set()])[0] = True
+            else:
+                self._dirty[connection] = [True, _ALL, _ALL]
+            return
+
+        dirty = self._dirty.get(connection)
+        if dirty is None:
+            dirty = self._dirty[connection] = [False, set(), set()]
+        channels, presences = dirty[1], dirty[2]
+        published = self._current.local_presences.get(connection)
+
+        if entity == delta.CHANNEL:
+            if channels is not _ALL:
+                channels.add(name)
+            if presences is _ALL:
+                return
+            if kind == delta.JOINED:
+                presences.add(data[0])
+            elif kind == delta.PARTED:
+                presences.add(data)
+            elif kind == delta.REMOVED and published is not None and name in published.channels:
+                # The members that were published have to forget the channel too, the
+                # ones that joined later are marked already.
+                presences.update(published.channels[name].presences)
+        elif entity == delta.PRESENCE:
+            if presences is not _ALL:
+                presences.add(name)
+                if kind == delta.RENAMED:
+                    presences.add(data)
+            if channels is _ALL:
+                return
+            if kind == delta.RENAMED:
+                # The channels list the presence by its new name now. The channels it was
+                # published in go by the old name, in case it's gone by the time we publish.
+                if published is not None and name in published.presences:
+                    channels.update(published.presences[name].channels)
+                presence_obj = self.keeper.find(network, mypresence, presence=data)
+                if presence_obj is not None:
+                    channels.update(presence_obj.channels)
+            elif kind == delta.REMOVED and published is not None and name in published.presences:
+                channels.update(published.presences[name].channels)
+
+    def _publish(self):
+        if not (self._reset or self._dirty_networks or self._dirty):
+            return
+
+        keeper = self.keeper
+        current = self._current
+
+        if self._reset:
+            networks = dict((name, NetworkView(network)) for (name, network) in keeper.networks.iteritems())
+            local_presences = state.LocalPresenceMap()
+            for (connection, local_presence) in keeper.local_presences.iteritems():
+                local_presences[connection] = self._copy(connection, local_presence, None, None)
+        else:
+            networks = current.networks
+            if self._dirty_networks:
+                networks = dict(networks)
+                for name in self._dirty_networks:
+                    network = keeper.networks.get(name)
+                    if network is None:
+                        networks.pop(name, None)
+                    else:
+                        networks[name] = NetworkView(network)
+
+            local_presences = current.local_presences
+            if self._dirty:
+                local_presences = local_presences.copy()
+                for (connection, dirty) in self._dirty.iteritems():
+                    live = keeper.local_presences.get(connection)
+                    if live is None:
+                        local_presences.pop(connection, None)
+                    else:
+                        local_presences[connection] = self._copy(connection, live, local_presences.get(connection), dirty)
+
+        self._current = StateView(current.version + 1, networks, local_presences)
+        self._reset = False
+        self._dirty_networks = set()
+        self._dirty = {}
+
+    def _copy(self, connection, live, published, dirty):
+        # Make a LocalPresenceView of live, reusing what's not dirty from the published one.
+        if published is None or dirty is None or dirty[1] is _ALL:
+            channels = dict((name, ChannelView(connection, channel)) for (name, channel) in live.channels.iteritems())
+        else:
+            channels = published.channels
+            if dirty[1]:
+                channels = dict(channels)
+                for name in dirty[1]:
+                    channel = live.channels.get(name)
+                    if channel is None:
+                        channels.pop(name, None)
+                    else:
+                        channels[name] = ChannelView(connection, channel)
+
+        if published is None or dirty is None or dirty[2] is _ALL:
+            presences = dict((name, PresenceView(connection, presence)) for (name, presence) in live.presences.iteritems())
+        else:
+            presences = published.presences
+            if dirty[2]:
+                presences = dict(presences)
+                for name in dirty[2]:
+                    presence = live.presences.get(name)
+                    if presence is None:
+                        presences.pop(name, None)
+                    else:
+                        presences[name] = PresenceView(connection, presence)
+
+        if published is not None and dirty is not None and not dirty[0]:
+            info = published.info
+        else:
+            info = dict(live.info)
+
+        return LocalPresenceView(connection, info, channels, presences)
@@ -1,31 +1,52 @@
 #!/usr/bin/python
 
+# Replay a traffic log (as written by test.py) and dump the resulting state.
+#
+# Reads the log from stdin if no file is given. Logs can be text or packed (see
+# convert_log.py). When replaying a file, checkpoints
+# are kept in <log>.ckpt, so replaying up to a line (--line) only replays the lines
+# after the nearest checkpoint.
+
 import pycecap
 
+from optparse import OptionParser
 from sys import stdin, stderr
 from pprint import pprint
-
-client = pycecap.StateKeeper()
-
-lineno = 0
-for line in stdin:
-    lineno = lineno + 1
-
+import time
+
+parser = OptionParser(usage='%prog [options] [log]')
+parser.add_option('-l', '--line', type='int', help='stop after replaying this line')
+parser.add_option('-i', '--interval', type='int', default=100000,
+                  help='lines between checkpoints, 0 to not write any (default: %default)')
+parser.add_option('-n', '--no-checkpoints', action='store_true', help='ignore existing checkpoints')
+parser.add_option('-q', '--quiet', action='store_true', help="don't dump the state")
+options, args = parser.parse_args()
+
+if args:
+    replayer = pycecap.Replayer(args[0], interval=options.interval)
     try:
-        line = line.rstrip('\n\r')
-        dir, message = line[:1], line[1:]
-
-        if not message:
-            continue
-
-        if dir == '<':
-            client.parse(message)
-        else:
-            command = pycecap.Command(message)
-            client._next_tag = int(command.tag)
-            client.presend(command)
+        client = replayer.replay(until=options.line, use_checkpoints=not options.no_checkpoints)
     except:
-        print >>stderr, "Crashed on input line %i" % lineno
+        print >>stderr, "Crashed on input line %i" % replayer.lineno
         raise
-
-pprint(client.__dict__)
+    lines, elapsed = replayer.lines, replayer.elapsed
+else:
+    client = pycecap.StateKeeper()
+
+    lineno = 0
+    start = time.time()
+    for line in stdin:
+        if options.line is not None and lineno >= options.line:
+            break
+        lineno = lineno + 1
+
+        try:
+            pycecap.replay_line(client, line.rstrip('\n\r'))
+        except:
+            print >>stderr, "Crashed on input line %i" % lineno
+            raise
+    lines, elapsed = lineno, time.time() - start
+
+if not options.quiet:
+    pprint(client.__dict__)
+print >>stderr, 'Replayed %i lines in %.2fs (%.0f lines/sec)' % (lines, elapsed, lines / elapsed if elapsed else 0)
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+
+# Replay every traffic log in logs/ (or the given logs) in parallel, and report
+# which ones failed, on what line, and how fast / how much memory each took.
+
+import pycecap
+
+from glob import glob
+from multiprocessing import Pool, cpu_count
+from optparse import OptionParser
+import resource
+import sys
+import traceback
+
+def replay_log(path):
+    '''Replay one log from the start, returning a dict describing the outcome.'''
+
+    replayer = pycecap.Replayer(path, interval=0)
+    result = {'log': path, 'ok': True, 'line': None, 'error': None}
+    try:
+        replayer.replay(use_checkpoints=False)
+    except Exception:
+        result.update(ok=False, line=replayer.lineno, error=traceback.format_exc())
+
+    # ru_maxrss is in KiB on Linux. Every log gets a fresh worker, so this is the peak for this log.
+    result.update(lines=replayer.lineno, elapsed=replayer.elapsed, throughput=replayer.throughput,
+                  peak_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    return result
+
+def main():
+    parser = OptionParser(usage='%prog [options] [log ...]')
+    parser.add_option('-j', '--jobs', type='int', default=cpu_count(),
+                      help='number of logs to replay at once (default: %default)')
+    parser.add_option('-v', '--verbose', action='store_true', help='print tracebacks of failed logs')
+    options, logs = parser.parse_args()
+
+    if not logs:
+        logs = sorted(glob('logs/*.log') + glob('logs/*.pylog'))
+    if not logs:
+        print >>sys.stderr, 'No logs to replay.'
+        return 1
+
+    pool = Pool(options.jobs, maxtasksperchild=1)
+    try:
+        results = sorted(pool.imap_unordered(replay_log, logs), key=lambda result: result['log'])
+    finally:
+        pool.terminate()
+
+    print '%-6s %-40s %10s %12s %10s' % ('', 'log', 'lines', 'lines/sec', 'peak MiB')
+    for result in results:
+        print '%-6s %-40s %10i %12.0f %10.1f' % ('ok' if result['ok'] else 'FAIL', result['log'], result['lines'],
+                                                 result['throughput'], result['peak_kb'] / 1024.0)
+
+    failed = [result for result in results if not result['ok']]
+    for result in failed:
+        print
+        print 'Failed on log: %s (crashed on input line %i)' % (result['log'], result['line'])
+        if options.verbose:
+            print result['error']
+
+    total_lines = sum(result['lines'] for result in results)
+    total_time = sum(result['elapsed'] for result in results)
+    print
+    print '%i logs, %i failed, %i lines, %.0f lines/sec per worker' % (
+        len(results), len(failed), total_lines, total_lines / total_time if total_time else 0)
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,25 +4,36 @@
 # Very dirty, but quick way of seeing if things are hooked
 # up like they should be.
 
-import pycecap 
+import pycecap
+from pycecap.packedlog import PackedLogWriter
 
 import os
 from pprint import pprint
 import select
 import subprocess
+import sys
 from sys import stdin
 
-log_name = 'logs/replay-%i.log' % os.getpid()
+# With --packed, write a compact packed log instead of a text log.
+packed = '--packed' in sys.argv[1:]
+if packed:
+    log_name = 'logs/replay-%i.pylog' % os.getpid()
+else:
+    log_name = 'logs/replay-%i.log' % os.getpid()
 
 def work(client, icecap, replay):
     rlist = [stdin, icecap.stdout]
     try:
-        ready, _, _ = select.select(rlist, [], [])
+        ready, _, _ = select.select(rlist, [], [], 5)
     except select.error:
         return False
     except KeyboardInterrupt:
         return False
 
+    if not ready and packed:
+        # Nothing happened for a while, don't leave the last lines unwritten.
+        replay.flush()
+
     for r in ready:
         line = r.readline().rstrip('\n\r')
         if not line:
@@ -36,13 +47,15 @@ def work(client, icecap, replay):
             else:
                 try:
                     command = client.presend(pycecap.Command(line))
-                    print >>replay, '>%s' % command
+                    if not packed:
+                        print >>replay, '>%s' % command
                     print '> %s' % command
                     icecap.stdin.write(str(command) + '\n')
                 except pycecap.InvalidMessageException:
                     print 'Invalid message'
         else:
-            print >>replay, '<%s' % line
+            if not packed:
+                print >>replay, '<%s' % line
             print '< %s' % line
             client.parse(line)
 
@@ -55,7 +68,12 @@ icecap = subprocess.Popen(['ssh', 'arach', 'icecapd'], stdin=subprocess.PIPE, st
 dir_name = os.path.dirname(log_name)
 if not os.path.isdir(dir_name):
     os.makedirs(dir_name)
-replay = open(log_name, 'w')
+if packed:
+    # The writer logs what the client parses and sends by itself.
+    replay = PackedLogWriter(log_name, flush_interval=5)
+    replay.attach(client)
+else:
+    replay = open(log_name, 'w')
 
 try:
     while work(client, icecap, replay):
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+# Shared helpers for the regression tests.
+#
+# Run the tests from the top of the tree: python -m unittest discover -s tests
+
+from StringIO import StringIO
+import os
+import sys
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import pycecap
+from traffic import TrafficGenerator
+
+def traffic(seed=0, networks=2, presences=200, channels=10, events=3000):
+    '''Get a small generated traffic log, as a list of lines (without newlines).'''
+
+    generator = TrafficGenerator(seed=seed, networks=networks, presences=presences,
+                                 channels=channels, events=events)
+    return list(generator.lines())
+
+def received(lines):
+    '''Get the data received from icecapd in a traffic log, as one string.'''
+
+    return ''.join(line[1:] + '\n' for line in lines if line.startswith('<'))
+
+def replay(lines, keeper=None):
+    '''Replay traffic log lines into a (new) StateKeeper, and return it.'''
+
+    if keeper is None:
+        keeper = pycecap.StateKeeper()
+    for line in lines:
+        pycecap.replay_line(keeper, line)
+    return keeper
+
+def signature(state):
+    '''Describe the state of a StateKeeper (or StateView, or ShardView) as comparable lists.
+
+    Both the channel members and the presences' channels are included, so a membership
+    that's only recorded on one side shows up.
+    '''
+
+    result = [sorted((name, dict(network.info), [dict(gateway) for gateway in network.gateways])
+                     for (name, network) in state.networks.iteritems())]
+    for connection in sorted(state.local_presences):
+        local_presence = state.local_presences[connection]
+        channels = sorted((name, dict(channel.info), sorted(channel.presences.iteritems()))
+                          for (name, channel) in local_presence.channels.iteritems())
+        presences = sorted((name, dict(presence.info), sorted(presence.channels))
+                           for (name, presence) in local_presence.presences.iteritems())
+        result.append((tuple(connection), dict(local_presence.info), channels, presences))
+    return result
+
+def snapshot(keeper):
+    '''Get a snapshot of a StateKeeper, as a file object to restore() from.'''
+
+    f = StringIO()
+    keeper.snapshot(f)
+    f.seek(0)
+    return f
+
+class CuriousKeeper(pycecap.StateKeeper):
+    '''A StateKeeper whose callback looks up the channel and presence of every message.'''
+
+    def on_msg(self, event):
+        event.channel
+        event.presence
+
+def strangers(network='network0', mypresence='me'):
+    '''Get msg events naming a channel and presence that were never announced.'''
+
+    return ('*;msg;network=%(n)s;mypresence=%(m)s;channel=#stranger;presence=stranger;msg=hi\n'
+            '*;msg;network=%(n)s;mypresence=%(m)s;presence=other_stranger;msg=hi\n'
+            % {'n': network, 'm': mypresence})
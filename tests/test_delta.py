@@ -0,0 +1,78 @@
+#!/usr/bin/python
+
+# Regression tests for the delta feed (pycecap/delta.py, StateKeeper.subscribe).
+
+import support
+from support import signature
+
+import unittest
+
+import pycecap
+from pycecap import delta
+
+CONNECTION = 'network=n;mypresence=me'
+
+class DeltaTest(unittest.TestCase):
+    def test_batches(self):
+        keeper = pycecap.StateKeeper()
+        single, batches = [], []
+        keeper.subscribe(single.append)
+        keeper.subscribe(batches.append, batch=3)
+        keeper.feed(support.received(support.traffic(events=200)))
+
+        self.assertTrue(single)
+        self.assertTrue(all(len(batch) <= 3 for batch in batches))
+        self.assertEqual(sum(batches, []), single)
+
+        keeper.unsubscribe(single.append)
+        count = len(single)
+        keeper.feed('*;network_init;network=other\n')
+        self.assertEqual(len(single), count)
+        self.assertEqual(batches[-1][-1], (delta.ADDED, delta.NETWORK, 'other', None, None, {}))
+
+    def test_events(self):
+        keeper = pycecap.StateKeeper()
+        changes = []
+        keeper.subscribe(changes.append)
+        keeper.feed('*;network_init;network=n\n'
+                    '*;local_presence_init;%(c)s\n'
+                    '*;channel_init;%(c)s;channel=#c\n'
+                    '*;presence_init;%(c)s;presence=A\n'
+                    '*;channel_presence_added;%(c)s;channel=#c;presence=A\n'
+                    '*;presence_changed;%(c)s;presence=A;name=B\n'
+                    '*;channel_presence_removed;%(c)s;channel=#c;presence=B\n'
+                    '*;presence_deinit;%(c)s;presence=B\n'
+                    '*;msg;%(c)s;channel=#c;presence=B;msg=hi\n' % {'c': CONNECTION})
+        self.assertEqual([change[:2] for change in changes], [
+            (delta.ADDED, delta.NETWORK),
+            (delta.ADDED, delta.LOCAL_PRESENCE),
+            (delta.ADDED, delta.CHANNEL),
+            (delta.ADDED, delta.PRESENCE),
+            (delta.JOINED, delta.CHANNEL),
+            (delta.RENAMED, delta.PRESENCE),
+            (delta.PARTED, delta.CHANNEL),
+            (delta.REMOVED, delta.PRESENCE),
+        ])
+        self.assertEqual(changes[4].data, ('A', ''))
+        self.assertEqual(changes[5].data, 'B')
+
+    def test_restore_resets(self):
+        keeper = support.replay(support.traffic(events=200))
+        changes = []
+        keeper.subscribe(changes.append)
+        keeper.restore(support.snapshot(keeper))
+        self.assertEqual(changes, [(delta.RESET, None, None, None, None, None)])
+
+    def test_callback_lookups(self):
+        # Channels and presences created by looking them up from a callback are announced.
+        keeper = support.CuriousKeeper()
+        mirror = pycecap.StateKeeper()
+        keeper.subscribe(mirror.apply_delta)
+        keeper.feed(support.received(support.traffic(events=500)) + support.strangers())
+
+        self.assertTrue(keeper.find('network0', 'me', channel='#stranger') is not None)
+        self.assertTrue(keeper.find('network0', 'me', presence='other_stranger') is not None)
+        self.assertEqual(signature(mirror), signature(keeper))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+
+# Regression tests for StateKeeper.feed() framing.
+
+import support
+from support import signature
+
+import random
+import unittest
+
+import pycecap
+
+class FailingKeeper(pycecap.StateKeeper):
+    '''Raises on the first network_init of the network named 'bad'.'''
+
+    failed = False
+
+    def on_network_init(self, event):
+        if 'bad' in self.networks and not self.failed:
+            self.failed = True
+            raise ValueError('bad network')
+
+class FeedTest(unittest.TestCase):
+    def setUp(self):
+        self.lines = support.traffic()
+        self.data = support.received(self.lines)
+        self.expected = signature(support.replay(line for line in self.lines if line.startswith('<')))
+
+    def feed_chunks(self, data, sizes):
+        keeper = pycecap.StateKeeper()
+        count = 0
+        position = 0
+        for size in sizes:
+            count += keeper.feed(data[position:position + size])
+            position += size
+            if position >= len(data):
+                break
+        self.assertTrue(position >= len(data))
+        return keeper, count
+
+    def test_random_chunks(self):
+        rng = random.Random(2)
+        lines = self.data.count('\n')
+        for _ in xrange(5):
+            keeper, count = self.feed_chunks(self.data, iter(lambda: rng.randint(1, 300), None))
+            self.assertEqual(count, lines)
+            self.assertEqual(signature(keeper), self.expected)
+
+    def test_single_bytes(self):
+        data = self.data[:5000]
+        data = data[:data.rindex('\n') + 1]
+        keeper, count = self.feed_chunks(data, iter(lambda: 1, None))
+        whole = pycecap.StateKeeper()
+        self.assertEqual(count, whole.feed(data))
+        self.assertEqual(signature(keeper), signature(whole))
+
+    def test_crlf_and_empty_lines(self):
+        keeper = pycecap.StateKeeper()
+        self.assertEqual(keeper.feed('*;network_init;network=a\r\n\n\r\n*;network_init;net'), 1)
+        self.assertEqual(keeper.feed('work=b\r'), 0)
+        self.assertEqual(keeper.feed('\n'), 1)
+        self.assertEqual(sorted(keeper.networks), ['a', 'b'])
+
+    def test_buffer_types(self):
+        keeper = pycecap.StateKeeper()
+        self.assertEqual(keeper.feed(memoryview('*;network_init;network=a\n')), 1)
+        self.assertEqual(keeper.feed(bytearray('*;network_init;network=b\n*;net')), 1)
+        self.assertEqual(keeper.feed(buffer('work_init;network=c\n')), 1)
+        self.assertEqual(sorted(keeper.networks), ['a', 'b', 'c'])
+
+    def test_parse_error_keeps_rest_of_chunk(self):
+        keeper = FailingKeeper()
+        self.assertRaises(ValueError, keeper.feed,
+                          '*;network_init;network=a\n*;network_init;network=bad\n'
+                          '*;network_init;network=c\n*;network_init;network=d\n*;net')
+        self.assertEqual(sorted(keeper.networks), ['a', 'bad'])
+        self.assertEqual(keeper.feed(''), 2)
+        self.assertEqual(keeper.feed('work_init;network=e\n'), 1)
+        self.assertEqual(sorted(keeper.networks), ['a', 'bad', 'c', 'd', 'e'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+# Regression tests for packed traffic logs (pycecap/packedlog.py).
+
+import support
+from support import signature
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import pycecap
+from pycecap.logreader import LogReader
+from pycecap.packedlog import PackedLogReader, PackedLogWriter, convert_log, is_packed_log
+
+class PackedLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.lines = support.traffic()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write_text(self, data, name='log'):
+        with open(self.path(name), 'wb') as f:
+            f.write(data)
+        return self.path(name)
+
+    def round_trip(self, data, **kwargs):
+        text = self.write_text(data)
+        convert_log(text, self.path('packed'), **kwargs)
+        self.assertTrue(is_packed_log(self.path('packed')))
+        convert_log(self.path('packed'), self.path('unpacked'))
+        with open(self.path('unpacked'), 'rb') as f:
+            return f.read()
+
+    def test_round_trip(self):
+        data = '\n'.join(self.lines) + '\n'
+        self.assertEqual(self.round_trip(data, block_lines=100), data)
+
+    def test_round_trip_edge_cases(self):
+        for data in ['', '\n', 'x', 'a\nb', 'a\r\n\nb\n\n', '<;\\.\n' * 3]:
+            self.assertEqual(self.round_trip(data, block_lines=2), data)
+
+    def test_lines_match_logreader(self):
+        text = self.write_text('\n'.join(self.lines) + '\n')
+        convert_log(text, self.path('packed'), block_lines=100)
+
+        reader = PackedLogReader(self.path('packed'))
+        self.assertTrue(reader.complete)
+        self.assertEqual(reader.line_count, len(self.lines))
+        for kwargs in ({}, {'direction': '>'}, {'events': ['msg', 'presence_changed']}):
+            self.assertEqual(list(reader.lines(**kwargs)), list(LogReader(text).lines(**kwargs)))
+        for start in (1, 99, 100, 101, 250, len(self.lines)):
+            self.assertEqual(list(reader.lines(start=start)), list(LogReader(text).lines())[start - 1:])
+
+    def test_unclosed_log(self):
+        writer = PackedLogWriter(self.path('packed'), block_lines=100)
+        for line in self.lines:
+            writer.write(line)
+        writer.flush()
+        # Cut the last block short, as if the writer crashed while writing it.
+        with open(self.path('packed'), 'rb') as f:
+            data = f.read()
+        with open(self.path('packed'), 'wb') as f:
+            f.write(data[:-10])
+
+        reader = PackedLogReader(self.path('packed'))
+        self.assertFalse(reader.complete)
+        count = len(self.lines) // 100 * 100
+        if count == len(self.lines):
+            count -= 100
+        self.assertEqual(reader.line_count, count)
+        self.assertEqual(list(reader.raw_lines()), self.lines[:count])
+
+    def test_attach(self):
+        keeper = pycecap.StateKeeper()
+        writer = PackedLogWriter(self.path('packed'), block_lines=100)
+        writer.attach(keeper)
+        # Toggling statistics must not drop the writer's hooks.
+        keeper.enable_stats()
+        for (index, line) in enumerate(self.lines):
+            if index == len(self.lines) // 2:
+                keeper.disable_stats()
+            pycecap.replay_line(keeper, line)
+        writer.close()
+
+        replayed = pycecap.Replayer(self.path('packed'), interval=0).replay()
+        self.assertEqual(signature(replayed), signature(keeper))
+        received = [line for line in self.lines if line.startswith('<')]
+        self.assertEqual([line for (_, line) in PackedLogReader(self.path('packed')).lines(direction='<')], received)
+
+    def test_replay_matches_text(self):
+        text = self.write_text('\n'.join(self.lines) + '\n')
+        convert_log(text, self.path('packed'), block_lines=100)
+        for until in (None, 1, 100, 101, 1000):
+            packed = pycecap.Replayer(self.path('packed'), interval=300).replay(until)
+            plain = pycecap.Replayer(text, interval=0).replay(until, use_checkpoints=False)
+            self.assertEqual(signature(packed), signature(plain))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+#!/usr/bin/python
+
+# Regression tests for the incrementally maintained StateIndex (pycecap/query.py).
+
+import support
+
+import random
+import unittest
+
+import pycecap
+
+INDEXES = ('_presences', '_by_name', '_by_host', '_by_suffix', '_modes', '_by_mode')
+
+class StateIndexTest(unittest.TestCase):
+    def assertIndexed(self, index):
+        fresh = pycecap.StateIndex(index.keeper)
+        fresh.close()
+        for name in INDEXES:
+            self.assertEqual(getattr(index, name), getattr(fresh, name), name)
+
+    def test_random_chunks(self):
+        keeper = pycecap.StateKeeper()
+        index = pycecap.StateIndex(keeper)
+        data = support.received(support.traffic(events=3000))
+        rng = random.Random(5)
+        position = 0
+        while position < len(data):
+            size = rng.randint(1, 20000)
+            keeper.feed(data[position:position + size])
+            position += size
+            self.assertIndexed(index)
+
+    def test_callback_lookups(self):
+        keeper = support.CuriousKeeper()
+        index = pycecap.StateIndex(keeper)
+        keeper.feed(support.received(support.traffic(events=500)) + support.strangers())
+
+        connection = ('network0', 'me')
+        self.assertEqual(index.presences_named('stranger'), [(connection, 'stranger')])
+        self.assertEqual(index.presences_named('other_stranger'), [(connection, 'other_stranger')])
+        self.assertIndexed(index)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+# Regression tests for replaying traffic logs with checkpoints (pycecap/replay.py).
+
+import support
+from support import signature
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import pycecap
+from pycecap.packedlog import convert_log
+
+class CheckpointTest(unittest.TestCase):
+    packed = False
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.lines = support.traffic()
+        self.log = os.path.join(self.directory, 'packed' if self.packed else 'log')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_log(self, lines):
+        text = os.path.join(self.directory, 'text')
+        with open(text, 'wb') as f:
+            f.write(''.join(line + '\n' for line in lines))
+        if self.packed:
+            convert_log(text, self.log, block_lines=100)
+        else:
+            os.rename(text, self.log)
+
+    def replay(self, until=None, use_checkpoints=True):
+        replayer = pycecap.Replayer(self.log, interval=500)
+        keeper = replayer.replay(until, use_checkpoints)
+        return keeper, replayer
+
+    def expected(self, lines, until=None):
+        return signature(support.replay(lines[:until]))
+
+    def test_checkpoints_match_full_replay(self):
+        self.write_log(self.lines)
+        self.replay()
+        for until in (1, 499, 500, 501, 1234, len(self.lines), None):
+            keeper, replayer = self.replay(until)
+            self.assertEqual(signature(keeper), self.expected(self.lines, until), until)
+        # The last one started from a checkpoint.
+        self.assertTrue(replayer.lines < len(self.lines))
+
+    def test_replaced_log(self):
+        self.write_log(self.lines)
+        self.replay()
+        self.write_log(['<*;network_init;network=other'])
+        keeper, replayer = self.replay()
+        self.assertEqual(sorted(keeper.networks), ['other'])
+        self.assertEqual(replayer.index.checkpoints, [])
+
+    def test_rewritten_log(self):
+        self.write_log(self.lines)
+        self.replay()
+        changed = list(self.lines)
+        changed[10] = changed[10].replace('network0', 'networkX')
+        self.write_log(changed)
+        keeper, replayer = self.replay(2000)
+        self.assertEqual(signature(keeper), self.expected(changed, 2000))
+        self.assertEqual(replayer.lines, 2000)
+
+    def test_appended_log(self):
+        half = len(self.lines) // 2
+        self.write_log(self.lines[:half])
+        self.replay()
+        self.write_log(self.lines)
+        keeper, replayer = self.replay()
+        self.assertEqual(signature(keeper), self.expected(self.lines))
+        self.assertTrue(replayer.lines <= len(self.lines) - half + 500)
+
+    def test_old_index_format(self):
+        with open(self.log + '.ckpt', 'wb') as f:
+            f.write(pycecap.CheckpointIndex.HEADER.pack(pycecap.CheckpointIndex.MAGIC, 1) + 'x' * 100)
+        self.write_log(self.lines)
+        keeper, replayer = self.replay()
+        self.assertEqual(signature(keeper), self.expected(self.lines))
+        self.assertEqual(pycecap.CheckpointIndex(self.log + '.ckpt').checkpoints, replayer.index.checkpoints)
+
+class PackedCheckpointTest(CheckpointTest):
+    packed = True
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/python
+
+# Regression tests for the staged handling of multi-line replies (pycecap/statekeeper.py).
+
+import support
+
+import time
+import unittest
+
+import pycecap
+
+SETUP = ('*;network_init;network=n\n'
+         '*;local_presence_init;network=n;mypresence=me\n'
+         '*;channel_init;network=n;mypresence=me;channel=#c\n')
+
+CHANNELS = ('%(tag)s;>;network=n;mypresence=me;channel=#c;topic=t\n'
+            '%(tag)s;>;network=n;mypresence=other;channel=#x\n')
+
+class ChannelListTest(unittest.TestCase):
+    def setUp(self):
+        self.keeper = pycecap.StateKeeper()
+        self.keeper.feed(SETUP)
+        self.before = support.signature(self.keeper)
+        self.changes = []
+        self.keeper.subscribe(self.changes.append)
+        self.command = self.keeper.presend('channel list', timeout=10)
+        self.keeper.feed(CHANNELS % {'tag': self.command.tag})
+
+    def assertUnchanged(self):
+        self.assertEqual(support.signature(self.keeper), self.before)
+        self.assertEqual(self.changes, [])
+        self.assertTrue(self.keeper.find('n', 'other') is None)
+
+    def test_partial_reply(self):
+        self.assertUnchanged()
+
+    def test_failed_reply(self):
+        self.keeper.feed('%s;-\n' % self.command.tag)
+        self.assertUnchanged()
+
+    def test_timed_out_reply(self):
+        self.assertEqual(self.keeper.expire(time.time() + 3600), 1)
+        self.assertUnchanged()
+
+    def test_complete_reply(self):
+        mirror = pycecap.StateKeeper()
+        mirror.feed(SETUP)
+        self.keeper.subscribe(mirror.apply_delta)
+        self.keeper.feed('%s;+\n' % self.command.tag)
+
+        self.assertEqual(self.keeper.find('n', 'me', channel='#c').info['topic'], 't')
+        self.assertTrue(self.keeper.find('n', 'other', channel='#x') is not None)
+        self.assertEqual(support.signature(mirror), support.signature(self.keeper))
+
+class TimeoutHandlerTest(unittest.TestCase):
+    def test_handler_added_after_dispatch(self):
+        class Keeper(pycecap.StateKeeper):
+            pass
+
+        keeper = Keeper()
+        first = keeper.presend('channel list', timeout=10)
+        keeper.presend('channel list', timeout=10)
+        self.assertEqual(keeper.expire(time.time() + 5), 0)
+        keeper.feed('%s;+\n' % first.tag)
+
+        timed_out = []
+        Keeper.command_channel_list_timeout = lambda self, command: timed_out.append(command.tag)
+        try:
+            self.assertEqual(keeper.expire(time.time() + 3600), 1)
+            self.assertEqual(timed_out, [str(int(first.tag) + 1)])
+        finally:
+            del Keeper.command_channel_list_timeout
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+# Regression tests for mirroring a StateKeeper from its deltas (StateKeeper.apply_delta)
+# and for merging the sessions of a Supervisor (pycecap/shard.py).
+
+import support
+from support import signature
+
+import random
+import unittest
+
+import pycecap
+from pycecap import delta
+from pycecap.shard import ShardView, _DELTAS, _SNAPSHOT
+
+def reply(keeper, command, params, replies):
+    '''Send a command, and feed it the given '>' replies and a '+'.'''
+
+    command = keeper.presend(command, params)
+    keeper.feed(''.join('%s;>;%s\n' % (command.tag, line) for line in replies) + '%s;+\n' % command.tag)
+
+class Mirror(object):
+    '''Keeps a StateKeeper in sync with another one through its deltas, like a Supervisor.'''
+
+    def __init__(self, keeper):
+        self.keeper = keeper
+        self.mirror = pycecap.StateKeeper()
+        keeper.subscribe(self.changed)
+
+    def changed(self, change):
+        if change[0] == delta.RESET:
+            self.mirror.restore(support.snapshot(self.keeper))
+        else:
+            self.mirror.apply_delta(change)
+
+class MirrorTest(unittest.TestCase):
+    def setUp(self):
+        self.keeper = pycecap.StateKeeper()
+        self.mirror = Mirror(self.keeper).mirror
+
+    def assertMirrored(self):
+        self.assertEqual(signature(self.mirror), signature(self.keeper))
+
+    def test_random_chunks(self):
+        data = support.received(support.traffic(events=5000))
+        rng = random.Random(3)
+        position = 0
+        while position < len(data):
+            size = rng.randint(1, 5000)
+            self.keeper.feed(data[position:position + size])
+            position += size
+            self.assertMirrored()
+
+    def test_list_replies_and_removals(self):
+        self.keeper.feed(support.received(support.traffic(events=500)))
+        reply(self.keeper, 'gateway list', None, ['network=network0;host=h1', 'network=network0;host=h2'])
+        self.assertMirrored()
+        reply(self.keeper, 'channel list', None, ['network=network0;mypresence=me;channel=#channel1;topic=t',
+                                                  'network=network0;mypresence=me;channel=#new'])
+        self.assertMirrored()
+        reply(self.keeper, 'channel names', {'network': 'network1', 'mypresence': 'me', 'channel': '#channel2'},
+              ['presence=nick1;mode=@', 'presence=someone'])
+        self.assertMirrored()
+        reply(self.keeper, 'presence list', None, ['network=network1;mypresence=me;nick=x'])
+        self.assertMirrored()
+        self.keeper.feed('*;channel_deinit;network=network1;mypresence=me;channel=#channel2\n'
+                         '*;presence_deinit;network=network1;mypresence=me;presence=nick3\n')
+        self.assertMirrored()
+        reply(self.keeper, 'network list', None, ['network=network1'])
+        self.assertMirrored()
+
+    def test_restore(self):
+        other = support.replay(support.traffic(seed=1, events=500))
+        self.keeper.feed(support.received(support.traffic(events=500)))
+        self.keeper.restore(support.snapshot(other))
+        self.assertMirrored()
+        self.keeper.feed('*;presence_changed;network=network0;mypresence=me;presence=nick1;name=renamed\n')
+        self.assertMirrored()
+
+    def test_shard_view(self):
+        # What the workers of a Supervisor send: deltas per flush, a snapshot on RESET.
+        view = ShardView(['a', 'b'])
+        keepers = {}
+        for (session, seed) in (('a', 0), ('b', 1)):
+            keeper = keepers[session] = pycecap.StateKeeper()
+            def changed(deltas, session=session, keeper=keeper):
+                if any(change[0] == delta.RESET for change in deltas):
+                    view.received((_SNAPSHOT, session, pycecap.snapshot.dumps(keeper)))
+                else:
+                    view.received((_DELTAS, session, [tuple(change) for change in deltas]))
+            keeper.subscribe(changed, batch=100)
+            keeper.feed(support.received(support.traffic(seed=seed, events=1000)))
+
+        for session in ('a', 'b'):
+            self.assertEqual(signature(view.sessions[session]), signature(keepers[session]))
+        self.assertEqual(sorted(view.networks), sorted(keepers['a'].networks))
+        self.assertTrue(view.local_presences.lookup('network0', 'me') is
+                        view.sessions['a'].local_presences.lookup('network0', 'me'))
+
+        keepers['a'].feed('*;network_init;network=only_b_knows_this_is_gone\n')
+        reply(keepers['a'], 'network list', None, ['network=network1'])
+        self.assertEqual(signature(view.sessions['a']), signature(keepers['a']))
+        self.assertTrue(view.local_presences.lookup('network0', 'me') is
+                        view.sessions['b'].local_presences.lookup('network0', 'me'))
+
+    def test_callback_lookups(self):
+        keeper = support.CuriousKeeper()
+        view = ShardView(['a'])
+        keeper.subscribe(lambda deltas: view.received((_DELTAS, 'a', [tuple(change) for change in deltas])),
+                         batch=100)
+        keeper.feed(support.received(support.traffic(events=500)) + support.strangers())
+        keeper.flush_deltas()
+        self.assertTrue(view.find('network0', 'me', presence='other_stranger') is not None)
+        self.assertEqual(signature(view.sessions['a']), signature(keeper))
+
+if __name__ == '__main__':
+    unittest.main()
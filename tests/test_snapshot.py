@@ -0,0 +1,50 @@
+#!/usr/bin/python
+
+# Regression tests for StateKeeper snapshots (pycecap/snapshot.py).
+
+import support
+from support import signature
+
+import marshal
+import unittest
+import zlib
+
+import pycecap
+from pycecap import snapshot
+
+class SnapshotTest(unittest.TestCase):
+    def test_round_trip(self):
+        keeper = support.replay(support.traffic())
+        restored = pycecap.StateKeeper()
+        restored.restore(support.snapshot(keeper))
+        self.assertEqual(signature(restored), signature(keeper))
+
+    def test_queued_commands(self):
+        keeper = pycecap.StateKeeper(max_in_flight=1)
+        sent = keeper.presend('network list', timeout=10)
+        queued = keeper.presend_many(['channel list', ('presence list', {'network': 'n'})])
+        self.assertEqual(keeper.queued(), 2)
+
+        for restored in (pycecap.StateKeeper(max_in_flight=1), keeper):
+            restored.restore(support.snapshot(keeper))
+            self.assertEqual(restored.queued(), 2)
+            self.assertEqual(restored.take_outbound(), '')
+
+            restored.feed('%s;+\n' % sent.tag)
+            self.assertEqual(restored.take_outbound(), '%s\n' % queued[0])
+            tags = [sent.tag] + [command.tag for command in queued]
+            self.assertFalse(restored.presend('gateway list').tag in tags)
+
+    def test_version_1(self):
+        keeper = support.replay(support.traffic(events=200))
+        keeper.presend_many(['channel list'])
+        data = marshal.loads(zlib.decompress(snapshot.dumps(keeper)[snapshot.HEADER.size:]))
+        old = snapshot.HEADER.pack(snapshot.MAGIC, 1) + zlib.compress(marshal.dumps(data[:4], 2))
+
+        restored = pycecap.StateKeeper()
+        snapshot.loads(restored, old)
+        self.assertEqual(signature(restored), signature(keeper))
+        self.assertEqual(restored.queued(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
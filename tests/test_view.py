@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+# Regression tests for the copy-on-write StateViews (pycecap/view.py).
+
+import support
+from support import signature
+
+import random
+import unittest
+
+import pycecap
+
+SETUP = ('*;network_init;network=n\n'
+         '*;local_presence_init;network=n;mypresence=me\n'
+         '*;channel_init;network=n;mypresence=me;channel=#c\n'
+         '*;channel_init;network=n;mypresence=me;channel=#d\n'
+         '*;presence_init;network=n;mypresence=me;presence=A\n'
+         '*;channel_presence_added;network=n;mypresence=me;channel=#c;presence=A\n')
+
+class ViewTest(unittest.TestCase):
+    def setUp(self):
+        self.keeper = pycecap.StateKeeper()
+        self.keeper.feed(SETUP)
+        self.publisher = pycecap.ViewPublisher(self.keeper)
+
+    def assertViewMatches(self):
+        self.assertEqual(signature(self.publisher.view()), signature(self.keeper))
+
+    def test_rename_then_deinit_in_one_chunk(self):
+        self.keeper.feed('*;presence_changed;network=n;mypresence=me;presence=A;name=B\n'
+                         '*;presence_deinit;network=n;mypresence=me;presence=B\n')
+        self.assertEqual(self.publisher.view().find('n', 'me', channel='#c').presences, {})
+        self.assertViewMatches()
+
+    def test_rename_then_part_in_one_chunk(self):
+        self.keeper.feed('*;presence_changed;network=n;mypresence=me;presence=A;name=B\n'
+                         '*;channel_presence_removed;network=n;mypresence=me;channel=#c;presence=B\n')
+        self.assertViewMatches()
+
+    def test_channel_deinit_updates_members(self):
+        self.keeper.feed('*;channel_deinit;network=n;mypresence=me;channel=#c\n')
+        self.assertEqual(self.publisher.view().find('n', 'me', presence='A').channels, frozenset())
+        self.assertViewMatches()
+
+    def test_published_views_never_change(self):
+        before = self.publisher.view()
+        expected = signature(before)
+        self.keeper.feed('*;presence_init;network=n;mypresence=me;presence=C\n'
+                         '*;channel_presence_added;network=n;mypresence=me;channel=#c;presence=C\n'
+                         '*;local_presence_deinit;network=n;mypresence=me\n')
+        self.assertEqual(signature(before), expected)
+        self.assertViewMatches()
+
+    def test_untouched_entities_are_shared(self):
+        before = self.publisher.view().find('n', 'me')
+        self.keeper.feed('*;channel_presence_added;network=n;mypresence=me;channel=#d;presence=A\n')
+        after = self.publisher.view().find('n', 'me')
+        self.assertTrue(after.channels['#c'] is before.channels['#c'])
+        self.assertFalse(after.channels['#d'] is before.channels['#d'])
+
+    def test_random_chunks(self):
+        keeper = pycecap.StateKeeper()
+        publisher = pycecap.ViewPublisher(keeper)
+        data = support.received(support.traffic(events=5000))
+        rng = random.Random(1)
+        position = 0
+        while position < len(data):
+            size = rng.randint(1, 4000)
+            keeper.feed(data[position:position + size])
+            position += size
+            self.assertEqual(signature(publisher.view()), signature(keeper))
+
+    def test_restore(self):
+        keeper = support.replay(support.traffic())
+        restored = pycecap.StateKeeper()
+        publisher = pycecap.ViewPublisher(restored)
+        restored.restore(support.snapshot(keeper))
+        publisher.publish()
+        self.assertEqual(signature(publisher.view()), signature(keeper))
+
+    def test_callback_lookups(self):
+        keeper = support.CuriousKeeper()
+        publisher = pycecap.ViewPublisher(keeper)
+        keeper.feed(support.received(support.traffic(events=500)))
+        publisher.view()
+        keeper.feed(support.strangers())
+        self.assertTrue(publisher.view().find('network0', 'me', channel='#stranger') is not None)
+        self.assertEqual(signature(publisher.view()), signature(keeper))
+
+if __name__ == '__main__':
+    unittest.main()